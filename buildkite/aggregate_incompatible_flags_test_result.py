@@ -199,7 +199,7 @@ def get_html_link_text(content, link):
 def needs_bazel_team_migrate(jobs):
     for job in jobs:
         pipeline, _ = get_pipeline_and_platform(job)
-        if bazelci.DOWNSTREAM_PROJECTS[pipeline].get("owned_by_bazel"):
+        if bazelci.downstream_projects()[pipeline].get("owned_by_bazel"):
             return True
     return False
 
@@ -289,7 +289,8 @@ def print_flags_need_to_migrate(failed_jobs_per_flag, details_per_flag):
             info_text = [f"* **{flag}** " + get_html_link_text(":github:", github_url)]
             jobs_per_pipeline = merge_jobs(jobs.values())
             for pipeline, platforms in jobs_per_pipeline.items():
-                bazel_mark = ":bazel:" if bazelci.DOWNSTREAM_PROJECTS[pipeline].get("owned_by_bazel") else ""
+                owned_by_bazel = bazelci.downstream_projects()[pipeline].get("owned_by_bazel")
+                bazel_mark = ":bazel:" if owned_by_bazel else ""
                 platforms_text = ", ".join(platforms)
                 info_text.append(f"  - {bazel_mark}**{pipeline}**: {platforms_text}")
             # Use flag as the context so that each flag gets a different info box.
@@ -518,7 +519,7 @@ def get_github_client():
 
 
 def get_project_details(project_label):
-    entry = bazelci.DOWNSTREAM_PROJECTS.get(project_label, {})
+    entry = bazelci.downstream_projects().get(project_label, {})
     full_repo = entry.get("git_repository", "")
     if not full_repo:
         raise bazelci.BuildkiteException(
@@ -18,13 +18,86 @@ Clones the repository and downloads available bazel binaries.
 """
 import argparse
 import bazelci
+import json
 import os
+import queue
+import shutil
+import subprocess
 import sys
+import tempfile
+import threading
 
 
 BB_ROOT = os.path.join(os.path.expanduser("~"), ".bazel-bench")
 # The path to the directory that stores the bazel binaries.
 BAZEL_BINARY_BASE_PATH = os.path.join(BB_ROOT, "bazel-bin")
+# The number of binaries that are downloaded at the same time.
+DEFAULT_MAX_PARALLEL_DOWNLOADS = 8
+
+WORK_QUEUE = queue.Queue()
+RESULTS = {}
+RESULTS_LOCK = threading.Lock()
+
+
+def worker():
+    while True:
+        item = WORK_QUEUE.get()
+        if not item:
+            break
+        try:
+            status = _download_and_verify(**item)
+        except Exception as e:
+            status = "failed: %s" % e
+        finally:
+            WORK_QUEUE.task_done()
+        with RESULTS_LOCK:
+            RESULTS[item["bazel_commit"]] = status
+
+
+def _published_sha256(binary_platform, bazel_commit):
+    """Returns the sha256 of the binary recorded by publish_binaries, if there is any."""
+    try:
+        output = subprocess.check_output(
+            [bazelci.gsutil_command(), "cat", bazelci.bazelci_builds_metadata_url(bazel_commit)],
+            stderr=subprocess.DEVNULL,
+            env=os.environ,
+        )
+    except subprocess.CalledProcessError:
+        return None
+    info = json.loads(output.decode("utf-8"))
+    return info.get("platforms", {}).get(binary_platform, {}).get("sha256")
+
+
+def _download_and_verify(binary_platform, bazel_commit, destination):
+    """Downloads a binary and only moves it to destination once it has been verified.
+
+    The binary is first downloaded into a staging directory next to destination, so that an
+    interrupted or corrupted download never shows up as a usable benchmark binary.
+    """
+    staging_dir = tempfile.mkdtemp(prefix=".staging-", dir=os.path.dirname(destination))
+    try:
+        try:
+            binary_path = bazelci.download_bazel_binary_at_commit(
+                staging_dir, binary_platform, bazel_commit
+            )
+        except bazelci.BuildkiteException:
+            return "not found"
+
+        actual_sha256 = bazelci.sha256_hexdigest(binary_path)
+        expected_sha256 = _published_sha256(binary_platform, bazel_commit)
+        if expected_sha256 and expected_sha256 != actual_sha256:
+            raise bazelci.BuildkiteException(
+                "sha256 mismatch (expected %s, got %s)" % (expected_sha256, actual_sha256)
+            )
+
+        os.rename(staging_dir, destination)
+        staging_dir = None
+        if expected_sha256:
+            return "ok (sha256 %s)" % actual_sha256
+        return "ok (sha256 %s, no published hash to verify against)" % actual_sha256
+    finally:
+        if staging_dir:
+            shutil.rmtree(staging_dir, ignore_errors=True)
 
 
 def main(argv=None):
@@ -34,6 +107,9 @@ def main(argv=None):
     parser = argparse.ArgumentParser(description="Bazel Bench Environment Setup")
     parser.add_argument("--platform", type=str)
     parser.add_argument("--bazel_commits", type=str)
+    parser.add_argument(
+        "--max_parallel_downloads", type=int, default=DEFAULT_MAX_PARALLEL_DOWNLOADS
+    )
     args = parser.parse_args(argv)
 
     bazel_commits = args.bazel_commits.split(",")
@@ -43,16 +119,44 @@ def main(argv=None):
         args.platform if args.platform in ["macos", "windows"] else bazelci.LINUX_BINARY_PLATFORM
     )
     bazel_bin_dir = BAZEL_BINARY_BASE_PATH + "/" + args.platform
+    os.makedirs(bazel_bin_dir, exist_ok=True)
 
+    # Put download instructions into the work queue.
     for bazel_commit in bazel_commits:
         destination = bazel_bin_dir + "/" + bazel_commit
         if os.path.exists(destination):
+            RESULTS[bazel_commit] = "already downloaded"
             continue
-        try:
-            bazelci.download_bazel_binary_at_commit(destination, binary_platform, bazel_commit)
-        except bazelci.BuildkiteException:
-            # Carry on.
-            bazelci.eprint("Binary for Bazel commit %s not found." % bazel_commit)
+        WORK_QUEUE.put(
+            {
+                "binary_platform": binary_platform,
+                "bazel_commit": bazel_commit,
+                "destination": destination,
+            }
+        )
+
+    # Spawn a bounded number of worker threads that download the binaries.
+    threads = []
+    for _ in range(min(WORK_QUEUE.qsize(), max(1, args.max_parallel_downloads))):
+        t = threading.Thread(target=worker)
+        t.start()
+        threads.append(t)
+
+    # Wait for all binaries to be downloaded.
+    WORK_QUEUE.join()
+
+    # Signal worker threads to exit.
+    for _ in range(len(threads)):
+        WORK_QUEUE.put(None)
+
+    # Wait for worker threads to exit.
+    for t in threads:
+        t.join()
+
+    # Carry on even if some binaries are missing, but report what happened to each commit.
+    bazelci.print_collapsed_group("Bazel binaries for %s" % args.platform)
+    for bazel_commit in bazel_commits:
+        bazelci.eprint("%s: %s" % (bazel_commit, RESULTS.get(bazel_commit, "unknown")))
 
 
 if __name__ == "__main__":
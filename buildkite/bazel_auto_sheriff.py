@@ -122,7 +122,7 @@ class BuildInfoAnalyzer(threading.Thread):
         self.main_result["state"] = get_project_state(self.main_result["tasks"])
 
         last_green_commit_url = bazelci.bazelci_last_green_commit_url(
-            bazelci.DOWNSTREAM_PROJECTS[self.project]["git_repository"], self.pipeline
+            bazelci.downstream_projects()[self.project]["git_repository"], self.pipeline
         )
         self.main_result["last_green_commit"] = bazelci.get_last_green_commit(last_green_commit_url)
 
@@ -596,7 +596,7 @@ def get_project_state(tasks):
 # }
 def get_downstream_result_by_project(downstream_build_info):
     config_to_project = {}
-    for project_name, project_info in bazelci.DOWNSTREAM_PROJECTS.items():
+    for project_name, project_info in bazelci.downstream_projects().items():
         config_to_project[project_info["http_config"]] = project_name
 
     downstream_result = {}
@@ -627,7 +627,7 @@ def main(argv=None):
     downstream_result = get_downstream_result_by_project(downstream_build_info)
 
     analyzers = []
-    for project_name, project_info in bazelci.DOWNSTREAM_PROJECTS.items():
+    for project_name, project_info in bazelci.downstream_projects().items():
         if "disabled_reason" not in project_info:
             analyzer = BuildInfoAnalyzer(project_name, project_info["pipeline_slug"], downstream_result[project_name])
             analyzers.append(analyzer)
@@ -17,18 +17,25 @@
 import argparse
 import base64
 import codecs
+import contextlib
+import csv
 import datetime
+import fnmatch
 import glob
+import gzip
 import hashlib
+import heapq
+import http
 import json
-import multiprocessing
+import math
 import os
 import os.path
+import queue
 import random
 import re
-import requests
 from shutil import copyfile
 import shutil
+import signal
 import stat
 import subprocess
 import sys
@@ -38,52 +45,49 @@ import time
 import urllib.error
 import urllib.request
 import uuid
-import yaml
 from urllib.request import url2pathname
-from urllib.parse import urlparse
+from urllib.parse import quote, urlparse
 
 # Initialize the random number generator.
 random.seed()
 
-BUILDKITE_ORG = os.environ["BUILDKITE_ORGANIZATION_SLUG"]
-THIS_IS_PRODUCTION = BUILDKITE_ORG == "bazel-untrusted"
-THIS_IS_TESTING = BUILDKITE_ORG == "bazel-testing"
-THIS_IS_TRUSTED = BUILDKITE_ORG == "bazel-trusted"
 THIS_IS_SPARTA = True
 
-CLOUD_PROJECT = "bazel-public" if THIS_IS_TRUSTED else "bazel-untrusted"
+# The time at which this script was started, which is appended to the URLs of files on GitHub so
+# that their latest version is fetched.
+START_TIME = int(time.time())
 
-GITHUB_BRANCH = {"bazel": "master", "bazel-trusted": "master", "bazel-testing": "testing"}[
-    BUILDKITE_ORG
-]
+# The bazelci.py URL that generated steps download. Overridden by --script.
+SCRIPT_URL = None
 
-SCRIPT_URL = "https://raw.githubusercontent.com/bazelbuild/continuous-integration/{}/buildkite/bazelci.py?{}".format(
-    GITHUB_BRANCH, int(time.time())
-)
+# Steps that are generated on Buildkite run bazelci.py and its helper scripts at the commit that
+# was current when the pipeline was generated. Set to False by --script.
+PIN_SCRIPTS = True
 
-INCOMPATIBLE_FLAG_VERBOSE_FAILURES_URL = "https://raw.githubusercontent.com/bazelbuild/continuous-integration/{}/buildkite/incompatible_flag_verbose_failures.py?{}".format(
-    GITHUB_BRANCH, int(time.time())
-)
+# The first job of a build that generates steps stores the commit that scripts are pinned to in
+# this Buildkite meta-data key, so that all jobs of the build use the same commit and only one
+# of them calls the (rate limited) GitHub API.
+SCRIPTS_COMMIT_METADATA_KEY = "bazelci-scripts-commit"
 
-AGGREGATE_INCOMPATIBLE_TEST_RESULT_URL = "https://raw.githubusercontent.com/bazelbuild/continuous-integration/{}/buildkite/aggregate_incompatible_flags_test_result.py?{}".format(
-    GITHUB_BRANCH, int(time.time())
+GITHUB_FILE_URL_TEMPLATE = (
+    "https://raw.githubusercontent.com/bazelbuild/continuous-integration/{}/buildkite/{}"
 )
 
-EMERGENCY_FILE_URL = "https://raw.githubusercontent.com/bazelbuild/continuous-integration/{}/buildkite/emergency.yml?{}".format(
-    GITHUB_BRANCH, int(time.time())
-)
+# The following settings depend on the Buildkite organization, which is only looked up when they
+# are used, so that this script can be imported and run without BUILDKITE_ORGANIZATION_SLUG.
+GITHUB_BRANCHES = {"bazel": "master", "bazel-trusted": "master", "bazel-testing": "testing"}
 
-FLAKY_TESTS_BUCKET = {
+FLAKY_TESTS_BUCKETS = {
     "bazel-testing": "gs://bazel-testing-buildkite-stats/flaky-tests-bep/",
     "bazel-trusted": "gs://bazel-buildkite-stats/flaky-tests-bep/",
     "bazel": "gs://bazel-buildkite-stats/flaky-tests-bep/",
-}[BUILDKITE_ORG]
+}
 
-KZIPS_BUCKET = {
+KZIPS_BUCKETS = {
     "bazel-testing": "gs://bazel-kzips-testing/",
     "bazel-trusted": "gs://bazel-kzips/",
     "bazel": "gs://bazel-kzips/",
-}[BUILDKITE_ORG]
+}
 
 # Projects can opt out of receiving GitHub issues from --notify by adding `"do_not_notify": True` to their respective downstream entry.
 DOWNSTREAM_PROJECTS_PRODUCTION = {
@@ -417,17 +421,17 @@ DOWNSTREAM_PROJECTS_TESTING = {
     "rules_scala": DOWNSTREAM_PROJECTS_PRODUCTION["rules_scala"],
 }
 
-DOWNSTREAM_PROJECTS = {
+DOWNSTREAM_PROJECTS_BY_ORG = {
     "bazel-testing": DOWNSTREAM_PROJECTS_TESTING,
     "bazel-trusted": {},
     "bazel": DOWNSTREAM_PROJECTS_PRODUCTION,
-}[BUILDKITE_ORG]
+}
 
-DOCKER_REGISTRY_PREFIX = {
+DOCKER_REGISTRY_PREFIXES = {
     "bazel-testing": "bazel-public/testing",
     "bazel-trusted": "bazel-public",
     "bazel": "bazel-public",
-}[BUILDKITE_ORG]
+}
 
 # A map containing all supported platform names as keys, with the values being
 # the platform name in a human readable format, and a the buildkite-agent's
@@ -438,7 +442,7 @@ PLATFORMS = {
         "emoji-name": ":centos: 7 (Java 8)",
         "downstream-root": "/var/lib/buildkite-agent/builds/${BUILDKITE_AGENT_NAME}/${BUILDKITE_ORGANIZATION_SLUG}-downstream-projects",
         "publish_binary": ["ubuntu1404", "centos7", "linux"],
-        "docker-image": f"gcr.io/{DOCKER_REGISTRY_PREFIX}/centos7-java8",
+        "docker-image": "centos7-java8",
         "python": "python3.6",
     },
     "debian10": {
@@ -446,7 +450,7 @@ PLATFORMS = {
         "emoji-name": ":debian: Buster (OpenJDK 11)",
         "downstream-root": "/var/lib/buildkite-agent/builds/${BUILDKITE_AGENT_NAME}/${BUILDKITE_ORGANIZATION_SLUG}-downstream-projects",
         "publish_binary": [],
-        "docker-image": f"gcr.io/{DOCKER_REGISTRY_PREFIX}/debian10-java11",
+        "docker-image": "debian10-java11",
         "python": "python3.7",
     },
     "ubuntu1604": {
@@ -454,7 +458,7 @@ PLATFORMS = {
         "emoji-name": ":ubuntu: 16.04 (OpenJDK 8)",
         "downstream-root": "/var/lib/buildkite-agent/builds/${BUILDKITE_AGENT_NAME}/${BUILDKITE_ORGANIZATION_SLUG}-downstream-projects",
         "publish_binary": ["ubuntu1604"],
-        "docker-image": f"gcr.io/{DOCKER_REGISTRY_PREFIX}/ubuntu1604-java8",
+        "docker-image": "ubuntu1604-java8",
         "python": "python3.6",
     },
     "ubuntu1804": {
@@ -462,7 +466,7 @@ PLATFORMS = {
         "emoji-name": ":ubuntu: 18.04 (OpenJDK 11)",
         "downstream-root": "/var/lib/buildkite-agent/builds/${BUILDKITE_AGENT_NAME}/${BUILDKITE_ORGANIZATION_SLUG}-downstream-projects",
         "publish_binary": ["ubuntu1804"],
-        "docker-image": f"gcr.io/{DOCKER_REGISTRY_PREFIX}/ubuntu1804-java11",
+        "docker-image": "ubuntu1804-java11",
         "python": "python3.6",
     },
     "ubuntu1804_nojava": {
@@ -470,7 +474,7 @@ PLATFORMS = {
         "emoji-name": ":ubuntu: 18.04 (no JDK)",
         "downstream-root": "/var/lib/buildkite-agent/builds/${BUILDKITE_AGENT_NAME}/${BUILDKITE_ORGANIZATION_SLUG}-downstream-projects",
         "publish_binary": [],
-        "docker-image": f"gcr.io/{DOCKER_REGISTRY_PREFIX}/ubuntu1804-nojava",
+        "docker-image": "ubuntu1804-nojava",
         "python": "python3.6",
     },
     "ubuntu2004": {
@@ -478,7 +482,7 @@ PLATFORMS = {
         "emoji-name": ":ubuntu: 20.04 (OpenJDK 11)",
         "downstream-root": "/var/lib/buildkite-agent/builds/${BUILDKITE_AGENT_NAME}/${BUILDKITE_ORGANIZATION_SLUG}-downstream-projects",
         "publish_binary": [],
-        "docker-image": f"gcr.io/{DOCKER_REGISTRY_PREFIX}/ubuntu2004-java11",
+        "docker-image": "ubuntu2004-java11",
         "python": "python3.8",
     },
     "ubuntu2004_nojava": {
@@ -486,7 +490,7 @@ PLATFORMS = {
         "emoji-name": ":ubuntu: 20.04 (no JDK)",
         "downstream-root": "/var/lib/buildkite-agent/builds/${BUILDKITE_AGENT_NAME}/${BUILDKITE_ORGANIZATION_SLUG}-downstream-projects",
         "publish_binary": [],
-        "docker-image": f"gcr.io/{DOCKER_REGISTRY_PREFIX}/ubuntu2004-nojava",
+        "docker-image": "ubuntu2004-nojava",
         "python": "python3.8",
     },
     "kythe_ubuntu2004": {
@@ -494,7 +498,7 @@ PLATFORMS = {
         "emoji-name": "Kythe (:ubuntu: 20.04, OpenJDK 11)",
         "downstream-root": "/var/lib/buildkite-agent/builds/${BUILDKITE_AGENT_NAME}/${BUILDKITE_ORGANIZATION_SLUG}-downstream-projects",
         "publish_binary": [],
-        "docker-image": f"gcr.io/{DOCKER_REGISTRY_PREFIX}/ubuntu2004-java11-kythe",
+        "docker-image": "ubuntu2004-java11-kythe",
         "python": "python3.8",
     },
     "macos": {
@@ -518,7 +522,7 @@ PLATFORMS = {
         "emoji-name": "RBE (:ubuntu: 16.04, OpenJDK 8)",
         "downstream-root": "/var/lib/buildkite-agent/builds/${BUILDKITE_AGENT_NAME}/${BUILDKITE_ORGANIZATION_SLUG}-downstream-projects",
         "publish_binary": [],
-        "docker-image": f"gcr.io/{DOCKER_REGISTRY_PREFIX}/ubuntu1604-java8",
+        "docker-image": "ubuntu1604-java8",
         "python": "python3.6",
     },
 }
@@ -543,8 +547,6 @@ CiQAry63sOlZtTNtuOT5DAOLkum0rGof+DOweppZY1aOWbat8zwSTQAL7Hu+rgHSOr6P4S1cu4YG
 EDql
 """.strip()
 
-BUILD_LABEL_PATTERN = re.compile(r"^Build label: (\S+)$", re.MULTILINE)
-
 BUILDIFIER_VERSION_ENV_VAR = "BUILDIFIER_VERSION"
 
 BUILDIFIER_WARNINGS_ENV_VAR = "BUILDIFIER_WARNINGS"
@@ -563,6 +565,121 @@ INDEX_UPLOAD_POLICY_IF_BUILD_SUCCESS = "IfBuildSuccess"
 
 INDEX_UPLOAD_POLICY_NEVER = "Never"
 
+# The number of downstream projects whose steps are generated concurrently when the downstream
+# pipeline doesn't use separate "Setup" jobs.
+DOWNSTREAM_PIPELINE_GENERATION_THREADS = 16
+
+# The name of the artifact that contains the phase timings of a runner job.
+PHASE_TRACE_FILENAME = "bazelci-phases.trace.json"
+
+# Limits for the failed actions that are shown in build annotations.
+FAILED_ACTIONS_MAX_COUNT = 10
+FAILED_ACTION_STDERR_MAX_BYTES = 4096
+
+# The name of the artifact that contains the remote cache metrics of a runner job.
+CACHE_METRICS_FILENAME = "bazelci-cache-metrics.json"
+
+# Silo keys whose remote cache hit ratio in the latest build is this much lower than their median
+# in earlier builds are reported by collect_cache_metrics.
+CACHE_HIT_RATIO_REGRESSION_THRESHOLD = 0.2
+
+# Tasks with "affected_targets_only" build and test all targets if more files than this changed,
+# or if the query for affected targets takes longer than this many seconds.
+AFFECTED_TARGETS_MAX_CHANGED_FILES = 500
+AFFECTED_TARGETS_QUERY_TIMEOUT_SECONDS = 300
+
+# Tasks with "order_tests_by_history" test targets that failed within this many seconds first.
+TEST_HISTORY_RECENT_FAILURE_SECONDS = 7 * 24 * 60 * 60
+
+# Test targets that haven't run for this many seconds are removed from the test history.
+TEST_HISTORY_MAX_AGE_SECONDS = 30 * 24 * 60 * 60
+
+# The Buildkite meta-data key under which runner jobs with "fail_fast" report the first definitive
+# test failure of a build, and how often other jobs check it while Bazel is running.
+FAIL_FAST_METADATA_KEY = "bazelci-fail-fast"
+FAIL_FAST_POLL_SECONDS = 15
+
+# Files that define external repositories. Changes to these files, and to files of the main
+# repository that they reference (such as lock files read by repository rules), can affect any
+# target.
+REPOSITORY_DEFINITION_FILES = ("WORKSPACE", "WORKSPACE.bazel", "WORKSPACE.bzlmod", "MODULE.bazel")
+
+# The pipeline generation job stores the last green commit that tasks with "affected_targets_only"
+# compare to in this Buildkite meta-data key. The last green commit can change while a build is
+# running, and all shards of a task must select their targets from the same set.
+AFFECTED_TARGETS_BASE_COMMIT_METADATA_KEY = "bazelci-affected-targets-base-commit"
+
+# Changes to these files can affect any target.
+AFFECTED_TARGETS_GLOBAL_FILES = REPOSITORY_DEFINITION_FILES + (".bazelrc", ".bazelversion")
+
+# Matches labels of files in the main repository, e.g. "//:requirements_lock.txt" or "@//a:go.mod".
+MAIN_REPOSITORY_FILE_LABEL_PATTERN = re.compile(r"""["']@{0,2}//([^:"']*):([^"']+)["']""")
+
+# Tasks with "affected_targets_only" pass explicit target labels to Bazel. Bazel fails if one of
+# them is incompatible with the platform, unless this flag (available since Bazel 7) is set.
+SKIP_INCOMPATIBLE_EXPLICIT_TARGETS_FLAG = "--skip_incompatible_explicit_targets"
+
+# If set, downstream projects are checked out into a pool of git worktrees instead of a single
+# clone, so that consecutive jobs at different commits don't thrash one working tree.
+WORKTREE_POOL_ENV_VAR = "USE_WORKTREE_POOL"
+
+WORKTREE_POOL_MAX_SLOTS = 4
+
+# An existing worktree is reused if it is at most this many commits away from the target commit,
+# even if the pool has room for a new one.
+WORKTREE_POOL_MAX_REUSE_DISTANCE = 200
+
+# Least recently used worktrees are deleted until the pool fits into this budget. The size of a
+# worktree includes the Bazel output bases of its workspaces.
+WORKTREE_POOL_DISK_BUDGET_BYTES = 30 * 1024 ** 3
+
+
+def buildkite_org():
+    org = os.getenv("BUILDKITE_ORGANIZATION_SLUG")
+    if not org:
+        raise BuildkiteException("BUILDKITE_ORGANIZATION_SLUG is not set.")
+    return org
+
+
+def this_is_testing():
+    return buildkite_org() == "bazel-testing"
+
+
+def this_is_trusted():
+    return buildkite_org() == "bazel-trusted"
+
+
+def cloud_project():
+    return "bazel-public" if this_is_trusted() else "bazel-untrusted"
+
+
+def github_branch():
+    return GITHUB_BRANCHES[buildkite_org()]
+
+
+def downstream_projects():
+    return DOWNSTREAM_PROJECTS_BY_ORG[buildkite_org()]
+
+
+def docker_image(platform):
+    return "gcr.io/{}/{}".format(
+        DOCKER_REGISTRY_PREFIXES[buildkite_org()], PLATFORMS[platform]["docker-image"]
+    )
+
+
+def github_file_url(name):
+    return "{}?{}".format(GITHUB_FILE_URL_TEMPLATE.format(github_branch(), name), START_TIME)
+
+
+def emergency_file_url():
+    return github_file_url("emergency.yml")
+
+
+def scripts_commit_url():
+    return "https://api.github.com/repos/bazelbuild/continuous-integration/commits/{}".format(
+        github_branch()
+    )
+
 
 class BuildkiteException(Exception):
     """
@@ -581,6 +698,16 @@ class BinaryUploadRaceException(Exception):
     pass
 
 
+class GcsException(BuildkiteException):
+    """
+    Raised when a request to the Cloud Storage JSON API fails.
+    """
+
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.status_code = status_code
+
+
 class BuildkiteClient(object):
 
     _ENCRYPTED_BUILDKITE_API_TOKEN = """
@@ -605,6 +732,10 @@ P9w8kNhEbw==
         "https://api.buildkite.com/v2/organizations/{}/pipelines/{}/builds/{}/jobs/{}/retry"
     )
 
+    _ARTIFACTS_URL_TEMPLATE = (
+        "https://api.buildkite.com/v2/organizations/{}/pipelines/{}/builds/{}/artifacts"
+    )
+
     def __init__(self, org, pipeline):
         self._org = org
         self._pipeline = pipeline
@@ -613,10 +744,10 @@ P9w8kNhEbw==
     def _get_buildkite_token(self):
         return decrypt_token(
             encrypted_token=self._ENCRYPTED_BUILDKITE_API_TESTING_TOKEN
-            if THIS_IS_TESTING
+            if this_is_testing()
             else self._ENCRYPTED_BUILDKITE_API_TOKEN,
             kms_key="buildkite-testing-api-token"
-            if THIS_IS_TESTING
+            if this_is_testing()
             else "buildkite-untrusted-api-token",
         )
 
@@ -668,6 +799,45 @@ P9w8kNhEbw==
     def get_build_log(self, job):
         return self._open_url(job["raw_log_url"])
 
+    def get_build_artifacts(self, build_number):
+        """Get the metadata of all artifacts of a build
+        See https://buildkite.com/docs/apis/rest-api/artifacts#list-artifacts-for-a-build
+
+        Parameters
+        ----------
+        build_number : the build number
+
+        Returns
+        -------
+        list of dict
+            the metadata for all artifacts of all jobs in the build
+        """
+        url = self._ARTIFACTS_URL_TEMPLATE.format(self._org, self._pipeline, build_number)
+        artifacts = []
+        page = 1
+        while True:
+            result = json.loads(self._open_url(url, [("per_page", 100), ("page", page)]))
+            artifacts += result
+            if len(result) < 100:
+                return artifacts
+            page += 1
+
+    def get_artifact(self, artifact):
+        """Download the content of an artifact returned by get_build_artifacts
+        See https://buildkite.com/docs/apis/rest-api/artifacts#download-an-artifact
+        """
+        return self._open_url(artifact["download_url"])
+
+    def download_artifact(self, artifact, destination):
+        """Download a (possibly binary) artifact returned by get_build_artifacts to a file"""
+        url = artifact["download_url"]
+        try:
+            with urllib.request.urlopen("{}?access_token={}".format(url, self._token)) as resp:
+                with open(destination, "wb") as f:
+                    shutil.copyfileobj(resp, f)
+        except urllib.error.HTTPError as ex:
+            raise BuildkiteException("Failed to open {}: {} - {}".format(url, ex.code, ex.reason))
+
     @staticmethod
     def _check_response(response, expected_status_code):
         if response.status_code != expected_status_code:
@@ -697,6 +867,8 @@ P9w8kNhEbw==
             "message": message if message else f"Trigger build at {commit}",
             "env": env,
         }
+        import requests
+
         response = requests.post(url + "?access_token=" + self._token, json=data)
         BuildkiteClient._check_response(response, requests.codes.created)
         return json.loads(response.text)
@@ -716,6 +888,8 @@ P9w8kNhEbw==
             the metadata for the job
         """
         url = self._RETRY_JOB_URL_TEMPLATE.format(self._org, self._pipeline, build_number, job_id)
+        import requests
+
         response = requests.put(url + "?access_token=" + self._token)
         BuildkiteClient._check_response(response, requests.codes.ok)
         return json.loads(response.text)
@@ -781,6 +955,135 @@ P9w8kNhEbw==
         return build_info
 
 
+class GcsClient(object):
+    """
+    A minimal client for the Cloud Storage JSON API.
+
+    Compared to gsutil this saves the startup time of a Python CLI for every operation, returns
+    generations as structured data and supports generation preconditions and server-side copies.
+    """
+
+    _OBJECT_URL_TEMPLATE = "https://storage.googleapis.com/storage/v1/b/{}/o/{}"
+
+    _UPLOAD_URL_TEMPLATE = "https://storage.googleapis.com/upload/storage/v1/b/{}/o"
+
+    _REWRITE_URL_TEMPLATE = "https://storage.googleapis.com/storage/v1/b/{}/o/{}/rewriteTo/b/{}/o/{}"
+
+    # Requests that time out or lose their connection are retried, so that a single stalled
+    # connection doesn't hang the job.
+    _TIMEOUT_SECONDS = 60
+
+    _ATTEMPTS = 3
+
+    def __init__(self):
+        self._token = None
+
+    def _get_access_token(self):
+        if not self._token:
+            self._token = (
+                subprocess.check_output(
+                    [gcloud_command(), "auth", "print-access-token"], env=os.environ
+                )
+                .decode("utf-8")
+                .strip()
+            )
+        return self._token
+
+    @staticmethod
+    def _split_url(gs_url):
+        parsed = urlparse(gs_url)
+        if parsed.scheme != "gs" or not parsed.netloc or not parsed.path[1:]:
+            raise BuildkiteException("Invalid Cloud Storage URL '{}'".format(gs_url))
+        return parsed.netloc, parsed.path[1:]
+
+    def _request(self, method, url, params=None, headers=None, data=None):
+        import requests
+
+        all_headers = {"Authorization": "Bearer " + self._get_access_token()}
+        all_headers.update(headers or {})
+        for attempt in range(self._ATTEMPTS):
+            try:
+                response = requests.request(
+                    method,
+                    url,
+                    params=params,
+                    headers=all_headers,
+                    data=data,
+                    timeout=self._TIMEOUT_SECONDS,
+                )
+                break
+            except (requests.Timeout, requests.ConnectionError) as ex:
+                if attempt + 1 == self._ATTEMPTS:
+                    raise GcsException("{} {} failed: {}".format(method, url, ex), None)
+                eprint("{} {} failed, retrying: {}".format(method, url, ex))
+                time.sleep(2 ** attempt)
+        if response.status_code != requests.codes.ok:
+            raise GcsException(
+                "{} {} failed: {} - {}".format(method, url, response.status_code, response.text),
+                response.status_code,
+            )
+        return response
+
+    def get_metadata(self, gs_url):
+        """Returns the metadata of an object, including its current generation.
+        See https://cloud.google.com/storage/docs/json_api/v1/objects/get
+        """
+        bucket, name = self._split_url(gs_url)
+        url = self._OBJECT_URL_TEMPLATE.format(bucket, quote(name, safe=""))
+        return self._request("GET", url).json()
+
+    def read(self, gs_url, generation=None):
+        """Returns the content of an object, optionally at a specific generation."""
+        bucket, name = self._split_url(gs_url)
+        params = {"alt": "media"}
+        if generation:
+            params["generation"] = generation
+        url = self._OBJECT_URL_TEMPLATE.format(bucket, quote(name, safe=""))
+        return self._request("GET", url, params=params).content
+
+    def write(self, gs_url, data, content_type, if_generation_match=None):
+        """Uploads data and returns the metadata of the new object.
+
+        If if_generation_match is set, the write fails with HTTP status 412 unless that is the
+        current generation of the object. "0" means that the object must not exist yet.
+        """
+        bucket, name = self._split_url(gs_url)
+        params = {"uploadType": "media", "name": name}
+        if if_generation_match is not None:
+            params["ifGenerationMatch"] = if_generation_match
+        url = self._UPLOAD_URL_TEMPLATE.format(bucket)
+        return self._request(
+            "POST", url, params=params, headers={"Content-Type": content_type}, data=data
+        ).json()
+
+    def copy(self, source_gs_url, dest_gs_url, source_generation=None):
+        """Copies an object without downloading it and returns the metadata of the copy."""
+        source_bucket, source_name = self._split_url(source_gs_url)
+        dest_bucket, dest_name = self._split_url(dest_gs_url)
+        url = self._REWRITE_URL_TEMPLATE.format(
+            source_bucket, quote(source_name, safe=""), dest_bucket, quote(dest_name, safe="")
+        )
+        params = {}
+        if source_generation:
+            params["sourceGeneration"] = source_generation
+        # Large objects may need several rewrite calls, which are chained via rewriteToken.
+        while True:
+            result = self._request("POST", url, params=params).json()
+            if result["done"]:
+                return result["resource"]
+            params["rewriteToken"] = result["rewriteToken"]
+
+
+_GCS_CLIENT = None
+
+
+def gcs_client():
+    global _GCS_CLIENT
+    if not _GCS_CLIENT:
+        _GCS_CLIENT = GcsClient()
+    return _GCS_CLIENT
+
+
 def decrypt_token(encrypted_token, kms_key):
     return (
         subprocess.check_output(
@@ -857,7 +1160,7 @@ def load_config(http_url, file_config, allow_imports=True):
     else:
         file_config = file_config or ".bazelci/presubmit.yml"
         with open(file_config, "r") as fd:
-            config = yaml.safe_load(fd)
+            config = load_yaml(fd)
 
     # Legacy mode means that there is exactly one task per platform (e.g. ubuntu1604_nojdk),
     # which means that we can get away with using the platform name as task ID.
@@ -884,7 +1187,7 @@ def load_config(http_url, file_config, allow_imports=True):
 def load_remote_yaml_file(http_url):
     with urllib.request.urlopen(http_url) as resp:
         reader = codecs.getreader("utf-8")
-        return yaml.safe_load(reader(resp))
+        return load_yaml(reader(resp))
 
 
 def load_imported_tasks(import_name, http_url, file_config):
@@ -945,6 +1248,42 @@ def bazelisk_flags():
     return ["--migrate"] if use_bazelisk_migrate() else []
 
 
+def reuse_downstream_results():
+    """
+    If REUSE_DOWNSTREAM_RESULTS is set, downstream tasks that already passed with the same
+    configuration, project commit and Bazel binary are not run again.
+    """
+    return bool(os.environ.get("REUSE_DOWNSTREAM_RESULTS"))
+
+
+def can_merge_build_and_test(
+    task_config, build_targets, test_targets, monitor_flaky_tests, save_but
+):
+    """
+    Returns whether the build and test steps of a task can run as a single `bazel test` call.
+
+    This is only enabled by the "merge_build_and_test" option, and only if the merged invocation
+    is equivalent to the separate ones: both steps must use the same targets in the same order
+    (otherwise tests that are only part of the build targets would run, too, and the order matters
+    for negative patterns) and the same flags.
+    """
+    if not task_config.get("merge_build_and_test", False):
+        return False
+    if not build_targets or build_targets != test_targets:
+        return False
+    # Flaky test monitoring disables the remote cache for tests, but not for builds, and
+    # Bazel binaries are uploaded between the build and the test step.
+    if monitor_flaky_tests or save_but:
+        return False
+    # Ordering tests by their history expands the test targets to individual tests.
+    if task_config.get("order_tests_by_history", False):
+        return False
+    include_json_profile = task_config.get("include_json_profile", [])
+    return ("build" in include_json_profile) == ("test" in include_json_profile) and (
+        task_config.get("build_flags") or []
+    ) == (task_config.get("test_flags") or [])
+
+
 def calculate_flags(task_config, task_config_key, json_profile_key, tmpdir, test_env_vars):
     include_json_profile = task_config.get("include_json_profile", [])
 
@@ -979,6 +1318,7 @@ def execute_commands(
     monitor_flaky_tests,
     incompatible_flags,
     bazel_version=None,
+    task_config_hash=None,
 ):
     # If we want to test incompatible flags, we ignore bazel_version and always use
     # the latest Bazel version through Bazelisk.
@@ -989,7 +1329,7 @@ def execute_commands(
         # However, we only use last_good_bazel for pipelines that do not
         # explicitly specify a version of Bazel.
         try:
-            emergency_settings = load_remote_yaml_file(EMERGENCY_FILE_URL)
+            emergency_settings = load_remote_yaml_file(emergency_file_url())
             bazel_version = emergency_settings.get("last_good_bazel")
         except urllib.error.HTTPError:
             # Ignore this error. The Setup step will have already complained about
@@ -1002,11 +1342,26 @@ def execute_commands(
     if use_bazel_at_commit and use_but:
         raise BuildkiteException("use_bazel_at_commit cannot be set when use_but is true")
 
+    # Downstream and incompatible flag jobs must not stop each other, since they test different
+    # projects or flags.
+    fail_fast = (
+        FailFast()
+        if task_config.get("fail_fast", False)
+        and not (git_repository or use_but or incompatible_flags)
+        else None
+    )
+
     tmpdir = tempfile.mkdtemp()
     sc_process = None
+    # Where the result of this downstream task is recorded if it passes.
+    result_url = None
+    phases = PhaseRecorder()
+    # Maps the name of each Bazel step to the remote cache metrics from its BEP.
+    cache_metrics = {}
     try:
         if platform == "macos":
-            activate_xcode(task_config)
+            with phases.phase("xcode"):
+                activate_xcode(task_config)
 
         # If the CI worker runs Bazelisk, we need to forward all required env variables to the test.
         # Otherwise any integration test that invokes Bazel (=Bazelisk in this case) will fail.
@@ -1014,22 +1369,38 @@ def execute_commands(
         if git_repo_location:
             os.chdir(git_repo_location)
         elif git_repository:
-            clone_git_repository(git_repository, platform, git_commit)
+            with phases.phase("clone"):
+                clone_git_repository(git_repository, platform, git_commit)
 
-        # We use one binary for all Linux platforms (because we also just release one binary for all
-        # Linux versions and we have to ensure that it works on all of them).
-        binary_platform = platform if platform in ["macos", "windows"] else LINUX_BINARY_PLATFORM
+        binary_platform = get_binary_platform(platform)
 
         if use_bazel_at_commit:
             print_collapsed_group(":gcloud: Downloading Bazel built at " + use_bazel_at_commit)
-            bazel_binary = download_bazel_binary_at_commit(
-                tmpdir, binary_platform, use_bazel_at_commit
-            )
+            with phases.phase("download bazel"):
+                bazel_binary = download_bazel_binary_at_commit(
+                    tmpdir, binary_platform, use_bazel_at_commit
+                )
             os.environ["USE_BAZEL_VERSION"] = bazel_binary
         elif use_but:
             print_collapsed_group(":gcloud: Downloading Bazel Under Test")
-            bazel_binary = download_bazel_binary(tmpdir, binary_platform)
+            with phases.phase("download bazel"):
+                bazel_binary = download_bazel_binary(tmpdir, binary_platform)
             os.environ["USE_BAZEL_VERSION"] = bazel_binary
+            if (
+                task_config_hash
+                and git_repository
+                and git_commit
+                and reuse_downstream_results()
+                and not incompatible_flags
+                and not os.getenv("BUILDKITE_PARALLEL_JOB_COUNT")
+            ):
+                result_url = downstream_result_url(
+                    task_config_hash, platform, git_repository, git_commit, bazel_binary
+                )
+                result = read_gcs_text(result_url)
+                if result:
+                    annotate_reused_downstream_result(json.loads(result))
+                    return
         else:
             bazel_binary = "bazel"
             if bazel_version:
@@ -1051,22 +1422,26 @@ def execute_commands(
         if use_bazelisk_migrate() and platform == "windows":
             os.environ["BAZELISK_SHUTDOWN"] = "1"
 
-        cmd_exec_func = execute_batch_commands if platform == "windows" else execute_shell_commands
-        cmd_exec_func(task_config.get("setup", None))
+        with phases.phase("setup"):
+            cmd_exec_func = (
+                execute_batch_commands if platform == "windows" else execute_shell_commands
+            )
+            cmd_exec_func(task_config.get("setup", None))
 
-        # Allow the config to override the current working directory.
-        required_prefix = os.getcwd()
-        requested_working_dir = os.path.abspath(task_config.get("working_directory", ""))
-        if os.path.commonpath([required_prefix, requested_working_dir]) != required_prefix:
-            raise BuildkiteException("working_directory refers to a path outside the workspace")
-        os.chdir(requested_working_dir)
+            # Allow the config to override the current working directory.
+            required_prefix = os.getcwd()
+            requested_working_dir = os.path.abspath(task_config.get("working_directory", ""))
+            if os.path.commonpath([required_prefix, requested_working_dir]) != required_prefix:
+                raise BuildkiteException("working_directory refers to a path outside the workspace")
+            os.chdir(requested_working_dir)
 
-        if platform == "windows":
-            execute_batch_commands(task_config.get("batch_commands", None))
-        else:
-            execute_shell_commands(task_config.get("shell_commands", None))
+            if platform == "windows":
+                execute_batch_commands(task_config.get("batch_commands", None))
+            else:
+                execute_shell_commands(task_config.get("shell_commands", None))
 
-        bazel_version = print_bazel_version_info(bazel_binary, platform)
+        with phases.phase("version info"):
+            bazel_version = print_bazel_version_info(bazel_binary, platform)
 
         print_environment_variables_info()
 
@@ -1075,44 +1450,85 @@ def execute_commands(
             for flag in incompatible_flags:
                 eprint(flag + "\n")
 
-        execute_bazel_run(
-            bazel_binary, platform, task_config.get("run_targets", None), incompatible_flags
-        )
+        with phases.phase("run targets"):
+            execute_bazel_run(
+                bazel_binary, platform, task_config.get("run_targets", None), incompatible_flags
+            )
 
         if task_config.get("sauce"):
+            # The tunnel comes up while Bazel analyzes and builds, since only tests need it.
             sc_process = start_sauce_connect_proxy(platform, tmpdir)
 
         if needs_clean:
-            execute_bazel_clean(bazel_binary, platform)
+            with phases.phase("clean"):
+                execute_bazel_clean(bazel_binary, platform)
 
-        build_targets, test_targets, index_targets = calculate_targets(
-            task_config, platform, bazel_binary, build_only, test_only
+        # Downstream and incompatible flag jobs test the Bazel binary, not the change.
+        affected_targets_only = task_config.get("affected_targets_only", False) and not (
+            git_repository or use_but or incompatible_flags
         )
+        with phases.phase("calculate targets"):
+            build_targets, test_targets, index_targets = calculate_targets(
+                task_config,
+                platform,
+                bazel_binary,
+                build_only,
+                test_only,
+                affected_targets_only=affected_targets_only,
+            )
+        # Affected targets are passed as explicit labels, which must not fail the build if they
+        # are incompatible with the platform.
+        affected_targets_flags = (
+            [SKIP_INCOMPATIBLE_EXPLICIT_TARGETS_FLAG]
+            if affected_targets_only and skips_incompatible_explicit_targets(bazel_binary, platform)
+            else []
+        )
+
+        if can_merge_build_and_test(
+            task_config, build_targets, test_targets, monitor_flaky_tests, save_but
+        ):
+            # The test invocation builds all targets, so that Bazel only analyzes them once.
+            eprint("Building and testing all targets in a single Bazel invocation")
+            build_targets = []
+            merge_build_and_test = True
+        else:
+            merge_build_and_test = False
 
         if build_targets:
             build_flags, json_profile_out_build = calculate_flags(
                 task_config, "build_flags", "build", tmpdir, test_env_vars
             )
+            build_flags += affected_targets_flags
+            build_bep_file = os.path.join(tmpdir, "build_bep.json")
+            if fail_fast:
+                fail_fast.check()
             try:
-                execute_bazel_build(
-                    bazel_version,
-                    bazel_binary,
-                    platform,
-                    build_flags,
-                    build_targets,
-                    None,
-                    incompatible_flags,
-                )
+                with phases.phase("build"):
+                    execute_bazel_build(
+                        bazel_version,
+                        bazel_binary,
+                        platform,
+                        build_flags,
+                        build_targets,
+                        build_bep_file,
+                        incompatible_flags,
+                        fail_fast=fail_fast,
+                    )
                 if save_but:
-                    upload_bazel_binary(platform)
+                    with phases.phase("upload"):
+                        upload_bazel_binary(platform)
             finally:
+                annotate_failed_actions(build_bep_file, "build")
+                cache_metrics["build"] = cache_metrics_from_bep(build_bep_file)
                 if json_profile_out_build:
-                    upload_json_profile(json_profile_out_build, tmpdir)
+                    with phases.phase("upload"):
+                        upload_json_profile(json_profile_out_build, tmpdir)
 
         if test_targets:
             test_flags, json_profile_out_test = calculate_flags(
                 task_config, "test_flags", "test", tmpdir, test_env_vars
             )
+            test_flags += affected_targets_flags
             if not is_windows():
                 # On platforms that support sandboxing (Linux, MacOS) we have
                 # to allow access to Bazelisk's cache directory.
@@ -1123,32 +1539,72 @@ def execute_commands(
                 os.makedirs(bazelisk_cache_dir, mode=0o755, exist_ok=True)
                 test_flags.append("--sandbox_writable_path={}".format(bazelisk_cache_dir))
 
+            first_test_targets = []
+            test_history_url = None
+            pipeline_slug = os.getenv("BUILDKITE_PIPELINE_SLUG")
+            if (
+                task_config.get("order_tests_by_history", False)
+                and task_config_hash
+                and pipeline_slug
+            ):
+                test_history_url = bazelci_test_history_url(pipeline_slug, task_config_hash)
+                with phases.phase("order tests"):
+                    first_test_targets, test_targets = order_test_targets(
+                        bazel_binary, platform, test_targets, test_history_url
+                    )
+
             test_bep_file = os.path.join(tmpdir, "test_bep.json")
             stop_request = threading.Event()
+            # Test logs of the second batch of an ordered test run are uploaded while it runs, too.
             upload_thread = threading.Thread(
-                target=upload_test_logs_from_bep, args=(test_bep_file, tmpdir, stop_request)
+                target=upload_test_logs_from_bep,
+                args=(
+                    [test_bep_file, second_batch_bep_file(test_bep_file)],
+                    tmpdir,
+                    stop_request,
+                ),
             )
+            if sc_process:
+                with phases.phase("sauce connect"):
+                    wait_for_sauce_connect_proxy(sc_process, tmpdir)
+            if fail_fast:
+                fail_fast.check()
             try:
                 upload_thread.start()
                 try:
-                    execute_bazel_test(
-                        bazel_version,
-                        bazel_binary,
-                        platform,
-                        test_flags,
-                        test_targets,
-                        test_bep_file,
-                        monitor_flaky_tests,
-                        incompatible_flags,
-                    )
+                    with phases.phase("test"):
+                        execute_bazel_test(
+                            bazel_version,
+                            bazel_binary,
+                            platform,
+                            test_flags,
+                            test_targets,
+                            test_bep_file,
+                            monitor_flaky_tests,
+                            incompatible_flags,
+                            build_tests_only=not merge_build_and_test,
+                            first_targets=first_test_targets,
+                            fail_fast=fail_fast,
+                        )
                     if monitor_flaky_tests:
-                        upload_bep_logs_for_flaky_tests(test_bep_file)
+                        with phases.phase("upload"):
+                            upload_bep_logs_for_flaky_tests(test_bep_file)
                 finally:
                     if json_profile_out_test:
-                        upload_json_profile(json_profile_out_test, tmpdir)
+                        with phases.phase("upload"):
+                            upload_json_profile(json_profile_out_test, tmpdir)
+                            upload_json_profile(
+                                second_batch_json_profile(json_profile_out_test), tmpdir
+                            )
             finally:
                 stop_request.set()
-                upload_thread.join()
+                with phases.phase("upload"):
+                    upload_thread.join()
+                annotate_failed_actions(test_bep_file, "test")
+                cache_metrics["test"] = cache_metrics_from_bep(test_bep_file)
+                if test_history_url:
+                    with phases.phase("upload"):
+                        update_test_history(test_history_url, test_bep_file)
 
         if index_targets:
             index_flags, json_profile_out_index = calculate_flags(
@@ -1156,21 +1612,23 @@ def execute_commands(
             )
             index_upload_policy = task_config.get("index_upload_policy", "IfBuildSuccess")
             index_upload_gcs = task_config.get("index_upload_gcs", False)
+            index_bep_file = os.path.join(tmpdir, "index_bep.json")
 
             try:
                 should_upload_kzip = (
                     True if index_upload_policy == INDEX_UPLOAD_POLICY_ALWAYS else False
                 )
                 try:
-                    execute_bazel_build_with_kythe(
-                        bazel_version,
-                        bazel_binary,
-                        platform,
-                        index_flags,
-                        index_targets,
-                        None,
-                        incompatible_flags,
-                    )
+                    with phases.phase("kythe index"):
+                        execute_bazel_build_with_kythe(
+                            bazel_version,
+                            bazel_binary,
+                            platform,
+                            index_flags,
+                            index_targets,
+                            index_bep_file,
+                            incompatible_flags,
+                        )
 
                     if index_upload_policy == INDEX_UPLOAD_POLICY_IF_BUILD_SUCCESS:
                         should_upload_kzip = True
@@ -1181,19 +1639,359 @@ def execute_commands(
 
                 if should_upload_kzip:
                     try:
-                        merge_and_upload_kythe_kzip(platform, index_upload_gcs)
+                        with phases.phase("upload"):
+                            merge_and_upload_kythe_kzip(platform, index_upload_gcs)
                     except subprocess.CalledProcessError:
                         raise BuildkiteException("Failed to upload kythe kzip")
             finally:
+                # The index build doesn't use the remote cache, so its cache metrics don't matter.
+                annotate_failed_actions(index_bep_file, "index")
                 if json_profile_out_index:
-                    upload_json_profile(json_profile_out_index, tmpdir)
+                    with phases.phase("upload"):
+                        upload_json_profile(json_profile_out_index, tmpdir)
 
+        if result_url:
+            record_downstream_result(result_url, git_commit)
     finally:
         terminate_background_process(sc_process)
+        publish_cache_metrics(cache_metrics, platform, tmpdir)
+        publish_phase_timings(phases, platform, tmpdir)
         if tmpdir:
             shutil.rmtree(tmpdir)
 
 
+class PhaseRecorder(object):
+    """
+    Records how long the phases of a runner job take.
+
+    The result can be written in the Chrome trace format, which is also used by Bazel's --profile
+    and can be loaded into chrome://tracing.
+    """
+
+    def __init__(self):
+        self._start = time.time()
+        self._events = []
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self._events.append((name, start - self._start, time.time() - start))
+
+    def durations(self):
+        """Returns the total duration of every phase in seconds, in order of first appearance."""
+        durations = {}
+        for name, _, duration in self._events:
+            durations[name] = durations.get(name, 0) + duration
+        return durations
+
+    def summary(self):
+        return ", ".join(
+            "{} {:.1f}s".format(name, duration) for name, duration in self.durations().items()
+        ) + " (total {:.1f}s)".format(time.time() - self._start)
+
+    def write_trace(self, path, metadata):
+        trace_events = [
+            {"name": "thread_name", "ph": "M", "pid": 1, "tid": 0, "args": {"name": "bazelci"}}
+        ]
+        for name, start, duration in self._events:
+            trace_events.append(
+                {
+                    "name": name,
+                    "cat": "bazelci phase",
+                    "ph": "X",
+                    "ts": int(start * 1000000),
+                    "dur": int(duration * 1000000),
+                    "pid": 1,
+                    "tid": 0,
+                }
+            )
+        other_data = dict(metadata, start_time=self._start)
+        with open(path, mode="w", encoding="utf-8") as f:
+            json.dump({"otherData": other_data, "traceEvents": trace_events}, f)
+
+
+def phase_durations_from_trace(trace):
+    """Returns the total duration in seconds of every phase in a trace written by PhaseRecorder."""
+    durations = {}
+    for event in trace.get("traceEvents", []):
+        if event.get("ph") == "X":
+            name = event["name"]
+            durations[name] = durations.get(name, 0) + event["dur"] / 1000000
+    return durations
+
+
+def percentile(values, p):
+    # Nearest-rank percentile, which only returns values that were actually observed.
+    ordered = sorted(values)
+    rank = max(1, int(math.ceil(p / 100 * len(ordered))))
+    return ordered[rank - 1]
+
+
+def iter_recent_json_artifacts(pipelines, build_count, filename):
+    """
+    Yields (pipeline, build, content) for every JSON artifact with the given file name in the
+    build_count most recent builds of each of the given pipelines. Artifacts that cannot be
+    downloaded or parsed are skipped.
+    """
+    for pipeline in pipelines:
+        client = BuildkiteClient(org=buildkite_org(), pipeline=pipeline)
+        builds = []
+        page = 1
+        while len(builds) < build_count:
+            result = client.get_build_info_list([("per_page", 100), ("page", page)])
+            builds += result
+            if len(result) < 100:
+                break
+            page += 1
+
+        for build in builds[:build_count]:
+            eprint("Collecting {} of {} build {}".format(filename, pipeline, build["number"]))
+            for artifact in client.get_build_artifacts(build["number"]):
+                if os.path.basename(artifact["path"]) != filename:
+                    continue
+                try:
+                    content = json.loads(client.get_artifact(artifact))
+                except (BuildkiteException, ValueError) as ex:
+                    eprint("Skipping {}: {}".format(artifact["download_url"], ex))
+                    continue
+                yield pipeline, build, content
+
+
+def collect_phase_timings(pipelines, build_count, output_file):
+    """
+    Aggregates the phase traces of the most recent builds of the given pipelines into a CSV file.
+
+    The file contains one row per pipeline, platform and phase, which makes it easy to see how
+    much agent time goes into e.g. checkouts or uploads.
+    """
+    samples = {}
+    for pipeline, _, trace in iter_recent_json_artifacts(
+        pipelines, build_count, PHASE_TRACE_FILENAME
+    ):
+        platform = trace.get("otherData", {}).get("platform") or "unknown"
+        for phase, seconds in phase_durations_from_trace(trace).items():
+            samples.setdefault((pipeline, platform, phase), []).append(seconds)
+
+    totals = {}
+    for (pipeline, platform, _), values in samples.items():
+        totals[(pipeline, platform)] = totals.get((pipeline, platform), 0) + sum(values)
+
+    with open(output_file, mode="w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(
+            [
+                "pipeline",
+                "platform",
+                "phase",
+                "jobs",
+                "total_seconds",
+                "share_of_total",
+                "p50_seconds",
+                "p95_seconds",
+                "max_seconds",
+            ]
+        )
+        for (pipeline, platform, phase), values in sorted(samples.items()):
+            total = sum(values)
+            writer.writerow(
+                [
+                    pipeline,
+                    platform,
+                    phase,
+                    len(values),
+                    "%.1f" % total,
+                    "%.4f" % (total / totals[(pipeline, platform)] if total else 0),
+                    "%.1f" % percentile(values, 50),
+                    "%.1f" % percentile(values, 95),
+                    "%.1f" % max(values),
+                ]
+            )
+    eprint("Wrote {} rows to {}".format(len(samples), output_file))
+
+
+def cache_silo_key_for_metrics(platform):
+    # Jobs without a remote cache or with RBE are grouped by their platform instead.
+    if cloud_project() not in ["bazel-untrusted"] or platform.startswith("rbe_"):
+        return platform
+    return platform_cache_silo_key(platform)
+
+
+def publish_cache_metrics(cache_metrics, platform, tmpdir):
+    """
+    Uploads the remote cache metrics of the Bazel invocations of this job (a dict from step
+    name to the result of cache_metrics_from_bep) and adds them to the build annotations.
+    """
+    cache_metrics = {step: m for step, m in cache_metrics.items() if m}
+    if not cache_metrics:
+        return
+    print_collapsed_group(":floppy_disk: Remote cache metrics")
+    lines = ["{}: {}".format(step, format_cache_metrics(m)) for step, m in cache_metrics.items()]
+    eprint("\n".join(lines))
+    if not os.getenv("BUILDKITE_JOB_ID"):
+        return
+
+    # This runs after the job's real work, whose errors must not be masked.
+    try:
+        data = {
+            "pipeline": os.getenv("BUILDKITE_PIPELINE_SLUG"),
+            "build_number": os.getenv("BUILDKITE_BUILD_NUMBER"),
+            "job_id": os.getenv("BUILDKITE_JOB_ID"),
+            "label": os.getenv("BUILDKITE_LABEL"),
+            "platform": platform,
+            # Runs xcode-select etc. on macOS.
+            "silo_key": cache_silo_key_for_metrics(platform),
+            "steps": cache_metrics,
+        }
+        with open(os.path.join(tmpdir, CACHE_METRICS_FILENAME), mode="w", encoding="utf-8") as f:
+            json.dump(data, f)
+        execute_command(
+            ["buildkite-agent", "artifact", "upload", CACHE_METRICS_FILENAME],
+            fail_if_nonzero=False,
+            cwd=tmpdir,
+        )
+        execute_command(
+            [
+                "buildkite-agent",
+                "annotate",
+                "--append",
+                "--style=info",
+                "--context=ctx-remote-cache",
+                "- **{}**: {}\n".format(data["label"], "; ".join(lines)),
+            ],
+            fail_if_nonzero=False,
+        )
+    except (OSError, subprocess.CalledProcessError) as ex:
+        eprint("Failed to publish remote cache metrics: {}".format(ex))
+
+
+def collect_cache_metrics(pipelines, build_count, output_file):
+    """
+    Aggregates the remote cache metrics of the most recent builds of the given pipelines per
+    cache silo key, and writes them into a CSV file.
+
+    Silo keys whose hit ratio in the latest build dropped noticeably compared to the earlier
+    builds are reported, and annotated if running on Buildkite. Returns the list of these keys.
+    """
+    # Maps (silo key, platform) to a dict from build (newest first) to [hits, actions, bytes].
+    samples = {}
+    for pipeline, build, data in iter_recent_json_artifacts(
+        pipelines, build_count, CACHE_METRICS_FILENAME
+    ):
+        key = (data.get("silo_key") or "unknown", data.get("platform") or "unknown")
+        build_key = (build["created_at"], pipeline, build["number"])
+        totals = samples.setdefault(key, {}).setdefault(build_key, [0, 0, 0])
+        for metrics in data.get("steps", {}).values():
+            totals[0] += metrics["remote_cache_hits"]
+            totals[1] += metrics["actions"]
+            totals[2] += metrics.get("bytes_downloaded") or 0
+
+    def ratio(values):
+        actions = sum(v[1] for v in values)
+        return sum(v[0] for v in values) / actions if actions else 0
+
+    regressions = []
+    with open(output_file, mode="w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(
+            [
+                "silo_key",
+                "platform",
+                "builds",
+                "actions",
+                "hit_ratio",
+                "latest_hit_ratio",
+                "median_hit_ratio",
+                "mib_downloaded",
+                "regressed",
+            ]
+        )
+        for (silo_key, platform), builds in sorted(samples.items()):
+            ordered = [builds[b] for b in sorted(builds, reverse=True)]
+            latest = ratio(ordered[:1])
+            median = percentile([ratio([v]) for v in ordered[1:]], 50) if len(ordered) > 1 else None
+            regressed = (
+                median is not None and median - latest > CACHE_HIT_RATIO_REGRESSION_THRESHOLD
+            )
+            if regressed:
+                regressions.append(silo_key)
+                eprint(
+                    "Remote cache hit ratio of {} ({}) dropped from {:.0%} to {:.0%}".format(
+                        silo_key, platform, median, latest
+                    )
+                )
+            writer.writerow(
+                [
+                    silo_key,
+                    platform,
+                    len(ordered),
+                    sum(v[1] for v in ordered),
+                    "%.4f" % ratio(ordered),
+                    "%.4f" % latest,
+                    "" if median is None else "%.4f" % median,
+                    "%.1f" % (sum(v[2] for v in ordered) / 1024 / 1024),
+                    regressed,
+                ]
+            )
+    eprint("Wrote {} rows to {}".format(len(samples), output_file))
+
+    if regressions and os.getenv("BUILDKITE_JOB_ID"):
+        execute_command(
+            [
+                "buildkite-agent",
+                "annotate",
+                "--style=warning",
+                "--context=ctx-remote-cache-regressions",
+                "The remote cache hit ratio dropped for the following silo keys:\n\n"
+                + "\n".join("- {}".format(k) for k in regressions),
+            ],
+            fail_if_nonzero=False,
+        )
+    return regressions
+
+
+def publish_phase_timings(phases, platform, tmpdir):
+    """
+    Uploads the phase timings of this job as a trace artifact and adds a one-line summary to
+    the build annotations. Failures are only logged, since they must not affect the job result.
+    """
+    print_collapsed_group(":stopwatch: Phase timings")
+    summary = phases.summary()
+    eprint(summary)
+    if not os.getenv("BUILDKITE_JOB_ID"):
+        return
+
+    metadata = {
+        "pipeline": os.getenv("BUILDKITE_PIPELINE_SLUG"),
+        "build_number": os.getenv("BUILDKITE_BUILD_NUMBER"),
+        "job_id": os.getenv("BUILDKITE_JOB_ID"),
+        "label": os.getenv("BUILDKITE_LABEL"),
+        "platform": platform,
+    }
+    try:
+        phases.write_trace(os.path.join(tmpdir, PHASE_TRACE_FILENAME), metadata)
+        execute_command(
+            ["buildkite-agent", "artifact", "upload", PHASE_TRACE_FILENAME],
+            fail_if_nonzero=False,
+            cwd=tmpdir,
+        )
+        execute_command(
+            [
+                "buildkite-agent",
+                "annotate",
+                "--append",
+                "--style=info",
+                "--context=ctx-phase-timings",
+                "- **{}**: {}\n".format(metadata["label"], summary),
+            ],
+            fail_if_nonzero=False,
+        )
+    except OSError as ex:
+        eprint("Failed to publish phase timings: {}".format(ex))
+
+
 def activate_xcode(task_config):
     # Get the Xcode version from the config.
     xcode_version = task_config.get("xcode_version", DEFAULT_XCODE_VERSION)
@@ -1240,6 +2038,12 @@ def tests_with_status(bep_file, status):
 
 
 def start_sauce_connect_proxy(platform, tmpdir):
+    """
+    Starts Sauce Connect Proxy in the background without waiting for the tunnel to come up.
+
+    Only tests need the tunnel, so callers should do as much work as possible before calling
+    wait_for_sauce_connect_proxy().
+    """
     print_collapsed_group(":saucelabs: Starting Sauce Connect Proxy")
     os.environ["SAUCE_USERNAME"] = "bazel_rules_webtesting"
     os.environ["SAUCE_ACCESS_KEY"] = saucelabs_token()
@@ -1250,16 +2054,29 @@ def start_sauce_connect_proxy(platform, tmpdir):
         cmd = ["sauce-connect.exe", "-i", os.environ["TUNNEL_IDENTIFIER"], "-f", readyfile]
     else:
         cmd = ["sc", "-i", os.environ["TUNNEL_IDENTIFIER"], "-f", readyfile]
-    sc_process = execute_command_background(cmd)
+    return execute_command_background(cmd)
+
+
+def wait_for_sauce_connect_proxy(sc_process, tmpdir, timeout=60):
+    readyfile = os.path.join(tmpdir, "sc_is_ready")
     wait_start = time.time()
     while not os.path.exists(readyfile):
-        if time.time() - wait_start > 60:
+        if sc_process.poll() is not None:
+            raise BuildkiteException(
+                "Sauce Connect Proxy exited with code {} before it was ready".format(
+                    sc_process.returncode
+                )
+            )
+        if time.time() - wait_start > timeout:
             raise BuildkiteException(
-                "Sauce Connect Proxy is still not ready after 60 seconds, aborting!"
+                "Sauce Connect Proxy is still not ready after {} seconds, aborting!".format(timeout)
             )
-        time.sleep(1)
-    print("Sauce Connect Proxy is ready, continuing...")
-    return sc_process
+        time.sleep(0.5)
+    print(
+        "Sauce Connect Proxy is ready after waiting {:.1f}s, continuing...".format(
+            time.time() - wait_start
+        )
+    )
 
 
 def saucelabs_token():
@@ -1277,19 +2094,38 @@ def has_flaky_tests(bep_file):
 
 def print_bazel_version_info(bazel_binary, platform):
     print_collapsed_group(":information_source: Bazel Info")
-    version_output = execute_command_and_get_output(
-        [bazel_binary]
-        + common_startup_flags(platform)
-        + ["--nomaster_bazelrc", "--bazelrc=/dev/null", "version"]
-    )
-    execute_command(
-        [bazel_binary]
-        + common_startup_flags(platform)
-        + ["--nomaster_bazelrc", "--bazelrc=/dev/null", "info"]
-    )
+    info = get_bazel_info(bazel_binary, platform)
+    for key, value in sorted(info.items()):
+        eprint("{}: {}".format(key, value))
+
+    # "bazel info release" prints e.g. "release 3.7.0", or "development version".
+    release = info.get("release", "")
+    return release[len("release ") :] if release.startswith("release ") else "unreleased binary"
 
-    match = BUILD_LABEL_PATTERN.search(version_output)
-    return match.group(1) if match else "unreleased binary"
+
+# Maps (bazel_binary, platform, workspace) to the parsed output of `bazel info`.
+_BAZEL_INFO_CACHE = {}
+
+
+def get_bazel_info(bazel_binary, platform):
+    """
+    Returns all `bazel info` keys and values for the current workspace.
+
+    Every Bazel client invocation costs seconds on some platforms, so `bazel info` only runs once
+    per binary and workspace, and all callers share its result.
+    """
+    key = (bazel_binary, platform, os.getcwd())
+    if key not in _BAZEL_INFO_CACHE:
+        output = execute_command_and_get_output(
+            [bazel_binary] + common_startup_flags(platform) + ["info"], print_output=False
+        )
+        info = {}
+        for line in output.splitlines():
+            name, separator, value = line.partition(": ")
+            if separator:
+                info[name.strip()] = value.strip()
+        _BAZEL_INFO_CACHE[key] = info
+    return _BAZEL_INFO_CACHE[key]
 
 
 def print_environment_variables_info():
@@ -1326,7 +2162,7 @@ def merge_and_upload_kythe_kzip(platform, index_upload_gcs):
 
     if index_upload_gcs:
         pipeline = os.getenv("BUILDKITE_PIPELINE_SLUG")
-        destination = KZIPS_BUCKET + pipeline + "/" + final_kzip_name
+        destination = KZIPS_BUCKETS[buildkite_org()] + pipeline + "/" + final_kzip_name
         print("Uploading to GCS {}".format(destination))
         execute_command([gsutil_command(), "cp", final_kzip_name, destination])
 
@@ -1342,6 +2178,12 @@ def download_binary(dest_dir, platform, binary_name):
     return bazel_binary_path
 
 
+def get_binary_platform(platform):
+    # We use one binary for all Linux platforms (because we also just release one binary for all
+    # Linux versions and we have to ensure that it works on all of them).
+    return platform if platform in ["macos", "windows"] else LINUX_BINARY_PLATFORM
+
+
 def download_bazel_binary(dest_dir, platform):
     binary_name = "bazel.exe" if platform == "windows" else "bazel"
     return download_binary(dest_dir, platform, binary_name)
@@ -1395,40 +2237,243 @@ def clone_git_repository(git_repository, platform, git_commit=None):
         "Fetching %s sources at %s" % (project_name, git_commit if git_commit else "HEAD")
     )
 
+    timings = []
+
+    def git(step, args, fail_if_nonzero=True):
+        start = time.time()
+        try:
+            return execute_command(["git"] + args, fail_if_nonzero=fail_if_nonzero)
+        finally:
+            timings.append((step, time.time() - start))
+
     mirror_path = get_mirror_path(git_repository, platform)
 
     if not os.path.exists(clone_path):
         if os.path.exists(mirror_path):
-            execute_command(
-                ["git", "clone", "-v", "--reference", mirror_path, git_repository, clone_path]
-            )
+            git("clone", ["clone", "-v", "--reference", mirror_path, git_repository, clone_path])
         else:
-            execute_command(["git", "clone", "-v", git_repository, clone_path])
+            # Without a local mirror we only download the blobs that are actually checked out.
+            git("clone", ["clone", "-v", "--filter=blob:none", git_repository, clone_path])
 
     os.chdir(clone_path)
-    execute_command(["git", "remote", "set-url", "origin", git_repository])
-    execute_command(["git", "clean", "-fdqx"])
-    execute_command(["git", "submodule", "foreach", "--recursive", "git clean -fdqx"])
-    execute_command(["git", "fetch", "origin"])
+    git("set-url", ["remote", "set-url", "origin", git_repository])
     if git_commit:
-        # sync to a specific commit of this repository
-        execute_command(["git", "reset", git_commit, "--hard"])
+        # Only fetch the commit we need, and skip the fetch entirely if we already have it.
+        if git("check", ["cat-file", "-e", git_commit + "^{commit}"], fail_if_nonzero=False):
+            if git("fetch", ["fetch", "--no-tags", "origin", git_commit], fail_if_nonzero=False):
+                # Not every server lets clients fetch arbitrary commits.
+                git("fetch", ["fetch", "origin"])
+        target = git_commit
     else:
+        git("fetch", ["fetch", "origin"])
         # sync to the latest commit of HEAD. Unlikely git pull this also works after a force push.
-        remote_head = (
+        target = (
             subprocess.check_output(["git", "symbolic-ref", "refs/remotes/origin/HEAD"])
             .decode("utf-8")
             .rstrip()
         )
-        execute_command(["git", "reset", remote_head, "--hard"])
-    execute_command(["git", "submodule", "sync", "--recursive"])
-    execute_command(["git", "submodule", "update", "--init", "--recursive", "--force"])
-    execute_command(["git", "submodule", "foreach", "--recursive", "git reset --hard"])
-    execute_command(["git", "clean", "-fdqx"])
-    execute_command(["git", "submodule", "foreach", "--recursive", "git clean -fdqx"])
+
+    if use_worktree_pool():
+        start = time.time()
+        target = (
+            subprocess.check_output(["git", "rev-parse", target + "^{commit}"])
+            .decode("utf-8")
+            .strip()
+        )
+        clone_path = checkout_worktree_from_pool(clone_path, target)
+        timings.append(("worktree pool", time.time() - start))
+        os.chdir(clone_path)
+
+    git("reset", ["reset", target, "--hard"])
+    git("clean", ["clean", "-fdqx"])
+
+    if os.path.exists(".gitmodules"):
+        git("submodule sync", ["submodule", "sync", "--recursive"])
+        git(
+            "submodule update",
+            ["submodule", "update", "--init", "--recursive", "--force", "--jobs=8"],
+        )
+        git(
+            "submodule clean",
+            ["submodule", "foreach", "--recursive", "git reset --hard && git clean -fdqx"],
+        )
+
+    eprint(
+        "Checkout of %s took %.1fs (%s)"
+        % (
+            project_name,
+            sum(duration for _, duration in timings),
+            ", ".join("%s: %.1fs" % (step, duration) for step, duration in timings),
+        )
+    )
     return clone_path
 
 
+def use_worktree_pool():
+    return bool(os.environ.get(WORKTREE_POOL_ENV_VAR))
+
+
+def checkout_worktree_from_pool(clone_path, git_commit):
+    """
+    Returns a worktree of the repository at clone_path that should be used for git_commit.
+
+    Every worktree ("slot") remembers the commit it was last used for. We pick the slot that is
+    closest to git_commit in the commit graph, so that Bazel can build incrementally in it.
+    The caller is responsible for actually resetting the worktree to git_commit.
+    """
+    pool_dir = clone_path + "-worktrees"
+    state_file = os.path.join(pool_dir, "pool.json")
+    os.makedirs(pool_dir, exist_ok=True)
+    execute_command(["git", "worktree", "prune"], cwd=clone_path)
+
+    state = {}
+    if os.path.exists(state_file):
+        try:
+            with open(state_file, encoding="utf-8") as f:
+                state = json.load(f)
+        except ValueError as ex:
+            # E.g. truncated by a killed job. We cannot tell which commits the existing slots are
+            # at, so we rebuild the pool from scratch instead of failing every following job.
+            eprint("Rebuilding worktree pool since %s is corrupt: %s" % (state_file, ex))
+            for name in os.listdir(pool_dir):
+                if os.path.isdir(os.path.join(pool_dir, name)):
+                    remove_worktree(clone_path, os.path.join(pool_dir, name))
+    state = {
+        name: slot for name, slot in state.items() if os.path.isdir(os.path.join(pool_dir, name))
+    }
+
+    best_name, best_distance = None, None
+    for name, slot in state.items():
+        distance = commit_distance(clone_path, slot["commit"], git_commit)
+        if distance is not None and (best_distance is None or distance < best_distance):
+            best_name, best_distance = name, distance
+
+    pool_is_full = len(state) >= WORKTREE_POOL_MAX_SLOTS
+    if best_name and (pool_is_full or best_distance <= WORKTREE_POOL_MAX_REUSE_DISTANCE):
+        eprint("Reusing worktree %s (%d commits away)" % (best_name, best_distance))
+    else:
+        if pool_is_full:
+            evicted = min(state, key=lambda n: state[n]["last_used"])
+            remove_worktree(clone_path, os.path.join(pool_dir, evicted))
+            del state[evicted]
+        best_name = next(
+            "slot-%d" % i for i in range(WORKTREE_POOL_MAX_SLOTS + 1) if "slot-%d" % i not in state
+        )
+        execute_command(
+            [
+                "git",
+                "worktree",
+                "add",
+                "--detach",
+                "--no-checkout",
+                os.path.join(pool_dir, best_name),
+                git_commit,
+            ],
+            cwd=clone_path,
+        )
+
+    state[best_name] = {"commit": git_commit, "last_used": time.time()}
+
+    # Evict the least recently used slots until the pool fits into the disk budget.
+    sizes = {name: worktree_size(os.path.join(pool_dir, name)) for name in state}
+    for name in sorted(state, key=lambda n: state[n]["last_used"]):
+        if sum(sizes.values()) <= WORKTREE_POOL_DISK_BUDGET_BYTES or name == best_name:
+            break
+        remove_worktree(clone_path, os.path.join(pool_dir, name))
+        del state[name]
+        del sizes[name]
+
+    with open(state_file, mode="w", encoding="utf-8") as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    return os.path.join(pool_dir, best_name)
+
+
+def commit_distance(repo_path, commit_a, commit_b):
+    """
+    Returns the number of commits that are reachable from exactly one of the given commits,
+    or None if that cannot be determined (e.g. because a commit is gone after a force push).
+    """
+    try:
+        output = subprocess.check_output(
+            ["git", "rev-list", "--count", "%s...%s" % (commit_a, commit_b)],
+            cwd=repo_path,
+            stderr=subprocess.DEVNULL,
+        )
+    except subprocess.CalledProcessError:
+        return None
+    return int(output.decode("utf-8").strip())
+
+
+def remove_worktree(repo_path, worktree_path):
+    # Every workspace in a worktree has its own output base, which is usually much larger than
+    # the checkout and would be leaked otherwise.
+    for output_base in worktree_output_bases(worktree_path):
+        remove_output_base(output_base)
+    eprint("Removing worktree %s" % worktree_path)
+    if execute_command(
+        ["git", "worktree", "remove", "--force", worktree_path],
+        fail_if_nonzero=False,
+        cwd=repo_path,
+    ):
+        shutil.rmtree(worktree_path, ignore_errors=True)
+        execute_command(["git", "worktree", "prune"], cwd=repo_path)
+
+
+def worktree_output_bases(worktree_path):
+    """
+    Returns the Bazel output bases of the workspaces in the given worktree, which are found through
+    their bazel-out convenience symlinks (pointing to <output_base>/execroot/<name>/bazel-out).
+    """
+    output_bases = set()
+    for root, dirs, _ in os.walk(worktree_path):
+        if "bazel-out" not in dirs or not os.path.islink(os.path.join(root, "bazel-out")):
+            continue
+        target = os.path.realpath(os.path.join(root, "bazel-out"))
+        parts = target.split(os.sep)
+        if "execroot" in parts:
+            output_bases.add(os.sep.join(parts[: len(parts) - 1 - parts[::-1].index("execroot")]))
+    return output_bases
+
+
+def remove_output_base(output_base):
+    eprint("Removing Bazel output base %s" % output_base)
+    # Stop the server first, since it keeps files of the output base open.
+    try:
+        with open(os.path.join(output_base, "server", "server.pid.txt")) as f:
+            os.kill(int(f.read().strip()), signal.SIGTERM)
+    except (OSError, ValueError):
+        pass
+
+    def make_writable_and_retry(function, path, _):
+        # Bazel makes the files of the output base read-only.
+        try:
+            os.chmod(os.path.dirname(path), stat.S_IRWXU)
+            os.chmod(path, stat.S_IRWXU)
+            function(path)
+        except OSError:
+            pass
+
+    shutil.rmtree(output_base, onerror=make_writable_and_retry)
+
+
+def worktree_size(worktree_path):
+    return directory_size(worktree_path) + sum(
+        directory_size(output_base) for output_base in worktree_output_bases(worktree_path)
+    )
+
+
+def directory_size(path):
+    # Symlinks (e.g. bazel-out) are not followed, since they point into Bazel's output base.
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
 def execute_batch_commands(commands):
     if not commands:
         return
@@ -1479,35 +2524,57 @@ def execute_bazel_run(bazel_binary, platform, targets, incompatible_flags):
 
 def remote_caching_flags(platform):
     # Only enable caching for untrusted and testing builds.
-    if CLOUD_PROJECT not in ["bazel-untrusted"]:
+    if cloud_project() not in ["bazel-untrusted"]:
         return []
 
-    platform_cache_key = [BUILDKITE_ORG.encode("utf-8")]
+    if platform == "macos":
+        # Use a local cache server for our macOS machines.
+        flags = ["--remote_cache=http://100.107.73.148"]
+    else:
+        # Use RBE for caching builds running on GCE.
+        flags = [
+            "--google_default_credentials",
+            "--remote_cache=remotebuildexecution.googleapis.com",
+            "--remote_instance_name=projects/{}/instances/default_instance".format(cloud_project()),
+        ]
+
+    flags += [
+        "--remote_timeout=60",
+        "--remote_max_connections=200",
+        '--remote_default_platform_properties=properties:{name:"cache-silo-key" value:"%s"}'
+        % platform_cache_silo_key(platform),
+    ]
+
+    return flags
+
+
+# Maps platform names to their cache silo keys, which don't change during a run.
+_PLATFORM_CACHE_SILO_KEYS = {}
+
+
+def platform_cache_silo_key(platform):
+    if platform in _PLATFORM_CACHE_SILO_KEYS:
+        return _PLATFORM_CACHE_SILO_KEYS[platform]
+
+    platform_cache_key = [buildkite_org().encode("utf-8")]
     # Whenever the remote cache was known to have been poisoned increase the number below
     platform_cache_key += ["cache-poisoning-20201011".encode("utf-8")]
 
     if platform == "macos":
+        xcode_path = subprocess.check_output(["/usr/bin/xcode-select", "-p"])
         platform_cache_key += [
             # macOS version:
             subprocess.check_output(["/usr/bin/sw_vers", "-productVersion"]),
             # Path to Xcode:
-            subprocess.check_output(["/usr/bin/xcode-select", "-p"]),
+            xcode_path,
             # Xcode version:
-            subprocess.check_output(["/usr/bin/xcodebuild", "-version"]),
+            xcode_version_output(xcode_path.decode("utf-8").strip()),
         ]
-        # Use a local cache server for our macOS machines.
-        flags = ["--remote_cache=http://100.107.73.148"]
     else:
         platform_cache_key += [
             # Platform name:
             platform.encode("utf-8")
         ]
-        # Use RBE for caching builds running on GCE.
-        flags = [
-            "--google_default_credentials",
-            "--remote_cache=remotebuildexecution.googleapis.com",
-            "--remote_instance_name=projects/{}/instances/default_instance".format(CLOUD_PROJECT),
-        ]
 
     platform_cache_digest = hashlib.sha256()
     for key in platform_cache_key:
@@ -1515,14 +2582,50 @@ def remote_caching_flags(platform):
         platform_cache_digest.update(key)
         platform_cache_digest.update(b":")
 
-    flags += [
-        "--remote_timeout=60",
-        "--remote_max_connections=200",
-        '--remote_default_platform_properties=properties:{name:"cache-silo-key" value:"%s"}'
-        % platform_cache_digest.hexdigest(),
-    ]
+    _PLATFORM_CACHE_SILO_KEYS[platform] = platform_cache_digest.hexdigest()
+    return _PLATFORM_CACHE_SILO_KEYS[platform]
 
-    return flags
+
+def xcode_version_output(xcode_path):
+    """
+    Returns the output of `xcodebuild -version` for the Xcode at xcode_path.
+
+    xcodebuild can take several seconds to start, so its output is cached on disk for as long as
+    the Xcode installation at that path stays unmodified.
+    """
+    # A cache path or key that cannot be determined is treated like a cache miss.
+    home = os.path.expanduser("~")
+    cache_file = (
+        os.path.join(home, "Library", "Caches", "bazelci", "xcode_versions.json")
+        if os.path.isabs(home)
+        else None
+    )
+    try:
+        cache_key = "{}@{}".format(xcode_path, os.stat(xcode_path).st_mtime)
+    except OSError:
+        cache_key = None
+    cache = {}
+    if cache_file and cache_key:
+        try:
+            with open(cache_file, encoding="utf-8") as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            pass
+        if cache_key in cache:
+            return cache[cache_key].encode("utf-8")
+
+    output = subprocess.check_output(["/usr/bin/xcodebuild", "-version"])
+    if not cache_file or not cache_key:
+        return output
+    # Entries for other Xcode installations are kept, since agents switch between them.
+    cache[cache_key] = output.decode("utf-8")
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        with open(cache_file, mode="w", encoding="utf-8") as f:
+            json.dump(cache, f, indent=2, sort_keys=True)
+    except OSError as ex:
+        eprint("Failed to cache the Xcode version in {}: {}".format(cache_file, ex))
+    return output
 
 
 def remote_enabled(flags):
@@ -1536,7 +2639,7 @@ def remote_enabled(flags):
 
 
 def concurrent_jobs(platform):
-    return "75" if platform.startswith("rbe_") else str(multiprocessing.cpu_count())
+    return "75" if platform.startswith("rbe_") else str(os.cpu_count())
 
 
 def concurrent_test_jobs(platform):
@@ -1683,10 +2786,7 @@ def compute_flags(
                 home = "/var/lib/buildkite-agent"
             aggregated_flags[i] = flag.replace("$HOME", home)
         if "$OUTPUT_BASE" in flag:
-            output_base = execute_command_and_get_output(
-                [bazel_binary] + common_startup_flags(platform) + ["info", "output_base"],
-                print_output=False,
-            ).strip()
+            output_base = get_bazel_info(bazel_binary, platform)["output_base"]
             aggregated_flags[i] = flag.replace("$OUTPUT_BASE", output_base)
 
     return aggregated_flags
@@ -1710,7 +2810,14 @@ def kythe_build_flags():
 
 
 def execute_bazel_build(
-    bazel_version, bazel_binary, platform, flags, targets, bep_file, incompatible_flags
+    bazel_version,
+    bazel_binary,
+    platform,
+    flags,
+    targets,
+    bep_file,
+    incompatible_flags,
+    fail_fast=None,
 ):
     print_collapsed_group(":bazel: Computing flags for build step")
     aggregated_flags = compute_flags(
@@ -1726,14 +2833,16 @@ def execute_bazel_build(
 
     print_expanded_group(":bazel: Build ({})".format(bazel_version))
     try:
-        execute_command(
+        execute_bazel_command(
             [bazel_binary]
             + bazelisk_flags()
             + common_startup_flags(platform)
             + ["build"]
             + aggregated_flags
             + ["--"]
-            + targets
+            + targets,
+            bep_file,
+            fail_fast,
         )
     except subprocess.CalledProcessError as e:
         handle_bazel_failure(e, "build")
@@ -1769,7 +2878,9 @@ def execute_bazel_build_with_kythe(
     )
 
 
-def calculate_targets(task_config, platform, bazel_binary, build_only, test_only):
+def calculate_targets(
+    task_config, platform, bazel_binary, build_only, test_only, affected_targets_only=False
+):
     build_targets = [] if test_only else task_config.get("build_targets", [])
     test_targets = [] if build_only else task_config.get("test_targets", [])
     index_targets = [] if (build_only or test_only) else task_config.get("index_targets", [])
@@ -1792,9 +2903,18 @@ def calculate_targets(task_config, platform, bazel_binary, build_only, test_only
     test_targets = [x.strip() for x in test_targets if x.strip() != "--"]
     index_targets = [x.strip() for x in index_targets if x.strip() != "--"]
 
+    if affected_targets_only and (build_targets or test_targets):
+        build_targets, test_targets = select_affected_targets(
+            bazel_binary,
+            platform,
+            build_targets,
+            test_targets,
+            task_config.get("affected_targets_global_files", []),
+        )
+
     shard_id = int(os.getenv("BUILDKITE_PARALLEL_JOB", "-1"))
     shard_count = int(os.getenv("BUILDKITE_PARALLEL_JOB_COUNT", "-1"))
-    if shard_id > -1 and shard_count > -1:
+    if shard_id > -1 and shard_count > -1 and test_targets:
         print_collapsed_group(
             ":female-detective: Calculating targets for shard {}/{}".format(
                 shard_id + 1, shard_count
@@ -1853,6 +2973,333 @@ def get_targets_for_shard(test_targets, shard_id, shard_count):
     return sorted(test_targets)[shard_id::shard_count]
 
 
+def order_test_targets(bazel_binary, platform, test_targets, history_url):
+    """
+    Returns the test targets that failed recently and the remaining test targets, according to
+    the test history at history_url.
+    """
+    history = read_gcs_text(history_url)
+    if not history:
+        eprint("No test history found at {}".format(history_url))
+        return [], test_targets
+    history = json.loads(history)
+
+    print_collapsed_group(":hourglass: Ordering test targets by their history")
+    test_targets = expand_test_target_patterns(bazel_binary, platform, test_targets)
+    test_targets = [t for t in test_targets if t]
+    return split_test_targets_by_history(test_targets, history, time.time())
+
+
+def split_test_targets_by_history(test_targets, history, now):
+    # Bazel schedules test actions by the action graph, not by their order on the command line, so
+    # only running the recently failed targets in a separate invocation makes them finish earlier.
+    recently_failed = set(
+        t
+        for t in test_targets
+        if now - history.get(t, {}).get("last_failure", 0) < TEST_HISTORY_RECENT_FAILURE_SECONDS
+    )
+    return (
+        sorted(recently_failed),
+        sorted(t for t in test_targets if t not in recently_failed),
+    )
+
+
+def test_results_from_bep(bep_file):
+    """Returns a map of test targets to their overall status and run time in seconds."""
+    results = {}
+    for event in iter_bep_events(bep_file):
+        summary = event.get("testSummary")
+        if not summary:
+            continue
+        if "totalRunDuration" in summary:
+            duration = float(summary["totalRunDuration"].rstrip("s"))
+        else:
+            duration = int(summary.get("totalRunDurationMillis", 0)) / 1000
+        results[event["id"]["testSummary"]["label"]] = (summary.get("overallStatus"), duration)
+    return results
+
+
+def merge_test_history(history, results, now):
+    for target, (status, duration) in results.items():
+        entry = history.setdefault(target, {})
+        entry["duration"] = duration
+        entry["last_seen"] = now
+        if status in ("FAILED", "TIMEOUT"):
+            entry["last_failure"] = now
+    for target in list(history):
+        if now - history[target].get("last_seen", 0) > TEST_HISTORY_MAX_AGE_SECONDS:
+            del history[target]
+
+
+def update_test_history(history_url, bep_file):
+    results = test_results_from_bep(bep_file)
+    if not results:
+        return
+    client = gcs_client()
+    try:
+        # Shards of the same task update the history concurrently.
+        for _ in range(5):
+            try:
+                generation = client.get_metadata(history_url)["generation"]
+                history = json.loads(client.read(history_url, generation=generation))
+            except GcsException as ex:
+                if ex.status_code != http.HTTPStatus.NOT_FOUND:
+                    raise
+                generation, history = "0", {}
+
+            merge_test_history(history, results, time.time())
+            try:
+                client.write(
+                    history_url,
+                    json.dumps(history, sort_keys=True).encode("utf-8"),
+                    content_type="application/json",
+                    if_generation_match=generation,
+                )
+                return
+            except GcsException as ex:
+                if ex.status_code != http.HTTPStatus.PRECONDITION_FAILED:
+                    raise
+        eprint("Failed to update the test history: too many concurrent updates")
+    except (GcsException, OSError, subprocess.CalledProcessError) as ex:
+        eprint("Failed to update the test history: {}".format(ex))
+
+
+def select_affected_targets(
+    bazel_binary, platform, build_targets, test_targets, global_file_patterns=()
+):
+    """
+    Returns the build and test targets that are affected by the files that changed since the merge
+    base (for pull requests) or the last green commit.
+
+    Falls back to the given targets if the changed files cannot be determined, if there are too
+    many of them, if they may affect every target (including files that were deleted or that match
+    global_file_patterns), if querying the affected targets fails, or if Bazel cannot skip
+    incompatible targets that are passed explicitly.
+    """
+    print_collapsed_group(":mag: Calculating affected targets")
+    if not skips_incompatible_explicit_targets(bazel_binary, platform):
+        annotate_affected_targets(
+            "building and testing all targets: this Bazel version doesn't support {}".format(
+                SKIP_INCOMPATIBLE_EXPLICIT_TARGETS_FLAG
+            )
+        )
+        return build_targets, test_targets
+
+    base_commit = affected_targets_base_commit()
+    if not base_commit:
+        annotate_affected_targets("building and testing all targets: no base commit to compare to")
+        return build_targets, test_targets
+
+    changed_files, reason = changed_files_since(base_commit, global_file_patterns)
+    if reason:
+        annotate_affected_targets("building and testing all targets: " + reason)
+        return build_targets, test_targets
+
+    try:
+        affected_build_targets = query_affected_targets(
+            bazel_binary, platform, build_targets, changed_files, tests_only=False
+        )
+        affected_test_targets = query_affected_targets(
+            bazel_binary, platform, test_targets, changed_files, tests_only=True
+        )
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as ex:
+        annotate_affected_targets("building and testing all targets: query failed ({})".format(ex))
+        return build_targets, test_targets
+
+    summary = "building {} and testing {} targets affected by {} files changed since {}".format(
+        len(affected_build_targets), len(affected_test_targets), len(changed_files), base_commit
+    )
+    details = "\n".join(
+        ["", "<details><summary>Affected targets</summary>", "", "```"]
+        + sorted(set(affected_build_targets + affected_test_targets))
+        + ["```", "</details>", ""]
+    )
+    annotate_affected_targets(summary, details)
+    return affected_build_targets, affected_test_targets
+
+
+def skips_incompatible_explicit_targets(bazel_binary, platform):
+    # "bazel info release" prints e.g. "release 7.1.0", or "development version".
+    release = get_bazel_info(bazel_binary, platform).get("release", "")
+    match = re.match(r"release (\d+)\.", release)
+    return not match or int(match.group(1)) >= 7
+
+
+def affected_targets_base_commit():
+    base_branch = os.getenv("BUILDKITE_PULL_REQUEST_BASE_BRANCH")
+    # The merge base of a pull request only changes if the pull request changes, which starts a
+    # new build.
+    if os.getenv("BUILDKITE_PULL_REQUEST", "false") != "false" and base_branch:
+        try:
+            execute_command(["git", "fetch", "origin", base_branch])
+            return execute_command_and_get_output(
+                ["git", "merge-base", "HEAD", "FETCH_HEAD"], print_output=False
+            ).strip()
+        except subprocess.CalledProcessError:
+            return None
+
+    base_commit = get_build_metadata(AFFECTED_TARGETS_BASE_COMMIT_METADATA_KEY)
+    if base_commit:
+        return base_commit
+    if os.getenv("BUILDKITE_PARALLEL_JOB_COUNT"):
+        # Shards that resolve the last green commit on their own may compare to different commits.
+        eprint("The build has no base commit for affected targets, which sharded tasks require")
+        return None
+    return last_green_commit_of_pipeline()
+
+
+def last_green_commit_of_pipeline():
+    git_repository = os.getenv("BUILDKITE_REPO")
+    pipeline_slug = os.getenv("BUILDKITE_PIPELINE_SLUG")
+    if not git_repository or not pipeline_slug:
+        return None
+    return get_last_green_commit(bazelci_last_green_commit_url(git_repository, pipeline_slug))
+
+
+def store_affected_targets_base_commit():
+    """Resolves the last green commit once per build, so that all jobs compare to the same one."""
+    if not os.getenv("BUILDKITE_JOB_ID"):
+        return
+    base_commit = last_green_commit_of_pipeline()
+    if base_commit:
+        set_build_metadata(AFFECTED_TARGETS_BASE_COMMIT_METADATA_KEY, base_commit)
+
+
+def changed_files_since(base_commit, global_file_patterns=()):
+    """
+    Returns the files that changed between base_commit and HEAD, relative to the current directory,
+    and the reason why all targets must be built instead (or None).
+
+    Deleted files may have been part of a glob(), which a query cannot tell, so they affect all
+    targets, just like files that are referenced by WORKSPACE or MODULE.bazel files or that match
+    one of global_file_patterns.
+    """
+    try:
+        prefix = execute_command_and_get_output(
+            ["git", "rev-parse", "--show-prefix"], print_output=False
+        ).strip()
+        output = execute_command_and_get_output(
+            ["git", "diff", "--name-only", "--no-renames", base_commit, "HEAD"],
+            print_output=False,
+        )
+    except subprocess.CalledProcessError:
+        return None, "cannot diff against {}".format(base_commit)
+
+    global_files = repository_rule_input_files()
+    changed_files = []
+    for path in output.splitlines():
+        if path.startswith(".bazelci/"):
+            return None, "the CI configuration changed"
+        if not path.startswith(prefix):
+            # Changes outside of the workspace of this task.
+            continue
+        path = path[len(prefix) :]
+        if (
+            os.path.basename(path) in AFFECTED_TARGETS_GLOBAL_FILES
+            or path.endswith((".bzl", ".MODULE.bazel"))
+            or path in global_files
+            or any(fnmatch.fnmatch(path, p) for p in global_file_patterns)
+        ):
+            return None, "{} changed".format(path)
+        if not os.path.exists(path):
+            return None, "{} was deleted".format(path)
+        changed_files.append(path)
+
+    if len(changed_files) > AFFECTED_TARGETS_MAX_CHANGED_FILES:
+        return None, "more than {} files changed".format(AFFECTED_TARGETS_MAX_CHANGED_FILES)
+    return changed_files, None
+
+
+def repository_rule_input_files():
+    """
+    Returns the paths of the files of the main repository that are referenced by the WORKSPACE or
+    MODULE.bazel files in the current directory, such as lock files that repository rules read.
+    These files have no reverse dependencies in the target graph.
+    """
+    files = set()
+    for name in REPOSITORY_DEFINITION_FILES:
+        try:
+            with open(name, encoding="utf-8", errors="replace") as f:
+                content = f.read()
+        except OSError:
+            continue
+        for package, target in MAIN_REPOSITORY_FILE_LABEL_PATTERN.findall(content):
+            files.add(os.path.join(package, target).replace(os.sep, "/"))
+    return files
+
+
+def package_of(path):
+    """Returns the package directory that contains the given file, or None."""
+    directory = os.path.dirname(path)
+    while True:
+        if any(os.path.exists(os.path.join(directory, b)) for b in ("BUILD", "BUILD.bazel")):
+            return directory
+        if not directory:
+            return None
+        directory = os.path.dirname(directory)
+
+
+def query_affected_targets(bazel_binary, platform, targets, changed_files, tests_only):
+    included_targets, excluded_targets = partition_targets(targets)
+    # Files outside of any package cannot be referenced by targets.
+    changed_files = [f for f in changed_files if package_of(f) is not None]
+    if not included_targets or not changed_files:
+        return []
+
+    sources = []
+    for path in changed_files:
+        if os.path.basename(path) in ("BUILD", "BUILD.bazel"):
+            # All rules of a package may change if its BUILD file changes.
+            sources.append("//{}:all".format(os.path.dirname(path)))
+        else:
+            # Bazel resolves file paths to the labels of the corresponding source files.
+            sources.append(path)
+
+    universe = "set({})".format(" ".join("'{}'".format(t) for t in included_targets))
+    if excluded_targets:
+        universe += " except set({})".format(" ".join("'{}'".format(t) for t in excluded_targets))
+    affected = "kind(rule, rdeps({}, set({})))".format(
+        universe, " ".join("'{}'".format(s) for s in sources)
+    )
+    if tests_only:
+        affected = "tests({})".format(affected)
+    query = "{} except attr(\"tags\", \"manual\", {})".format(affected, universe)
+
+    eprint("Querying affected targets")
+    # Bazel fails if a changed file isn't a source file of its package, e.g. because no target
+    # references it. All targets are used then, since the result would be incomplete.
+    process = subprocess.run(
+        [bazel_binary]
+        + common_startup_flags(platform)
+        + ["--nomaster_bazelrc", "--bazelrc=/dev/null", "query", query],
+        env=os.environ,
+        stdout=subprocess.PIPE,
+        errors="replace",
+        universal_newlines=True,
+        timeout=AFFECTED_TARGETS_QUERY_TIMEOUT_SECONDS,
+    )
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, process.args)
+    return [t for t in process.stdout.strip().split("\n") if t]
+
+
+def annotate_affected_targets(summary, details=""):
+    eprint(summary + details)
+    if not os.getenv("BUILDKITE_JOB_ID"):
+        return
+    execute_command(
+        [
+            "buildkite-agent",
+            "annotate",
+            "--append",
+            "--style=info",
+            "--context=ctx-affected-targets",
+            "- **{}**: {}\n{}".format(os.getenv("BUILDKITE_LABEL"), summary, details),
+        ],
+        fail_if_nonzero=False,
+    )
+
+
 def execute_bazel_test(
     bazel_version,
     bazel_binary,
@@ -1862,10 +3309,21 @@ def execute_bazel_test(
     bep_file,
     monitor_flaky_tests,
     incompatible_flags,
+    build_tests_only=True,
+    first_targets=None,
+    fail_fast=False,
 ):
+    """
+    Runs `bazel test` for the given targets.
+
+    If first_targets is set, these targets are tested in a separate invocation before the others,
+    so that their failures are reported early. With fail_fast (a FailFast instance), the other
+    targets are not tested if the first ones fail, and Bazel is stopped once another job of the
+    build reports a test failure.
+    """
     aggregated_flags = [
         "--flaky_test_attempts=3",
-        "--build_tests_only",
+        "--build_tests_only" if build_tests_only else "--nobuild_tests_only",
         "--local_test_jobs=" + concurrent_test_jobs(platform),
     ]
     # Don't enable remote caching if the user enabled remote execution / caching themselves
@@ -1884,18 +3342,56 @@ def execute_bazel_test(
     )
 
     print_expanded_group(":bazel: Test ({})".format(bazel_version))
+    command = [bazel_binary] + bazelisk_flags() + common_startup_flags(platform) + ["test"]
+    failure = None
+    if first_targets:
+        eprint("Testing {} recently failed targets first".format(len(first_targets)))
+        try:
+            execute_bazel_command(
+                command + aggregated_flags + ["--"] + first_targets, bep_file, fail_fast
+            )
+        except subprocess.CalledProcessError as e:
+            if fail_fast:
+                handle_bazel_failure(e, "test")
+            failure = e
+        if not targets:
+            if failure:
+                handle_bazel_failure(failure, "test")
+            return
+        # The events of the second invocation are appended to the BEP file of the first one.
+        # Its JSON profile is written to a separate file, since profiles cannot be merged.
+        rest_bep_file = second_batch_bep_file(bep_file)
+        aggregated_flags = [
+            "--build_event_json_file=" + rest_bep_file
+            if flag == "--build_event_json_file=" + bep_file
+            else "--profile=" + second_batch_json_profile(flag[len("--profile=") :])
+            if flag.startswith("--profile=")
+            else flag
+            for flag in aggregated_flags
+        ]
     try:
-        execute_command(
-            [bazel_binary]
-            + bazelisk_flags()
-            + common_startup_flags(platform)
-            + ["test"]
-            + aggregated_flags
-            + ["--"]
-            + targets
+        execute_bazel_command(
+            command + aggregated_flags + ["--"] + targets,
+            rest_bep_file if first_targets else bep_file,
+            fail_fast,
         )
     except subprocess.CalledProcessError as e:
-        handle_bazel_failure(e, "test")
+        failure = failure or e
+    finally:
+        if first_targets and os.path.exists(rest_bep_file):
+            with open(rest_bep_file, "rb") as src, open(bep_file, "ab") as dest:
+                shutil.copyfileobj(src, dest)
+    if failure:
+        handle_bazel_failure(failure, "test")
+
+
+def second_batch_bep_file(bep_file):
+    return bep_file + ".rest"
+
+
+def second_batch_json_profile(json_profile_path):
+    # Keeps the .profile.gz extension, which compare_json_profiles looks for.
+    return json_profile_path.replace(".profile.gz", "-rest.profile.gz")
 
 
 def get_json_profile_flags(out_file):
@@ -1916,32 +3412,37 @@ def upload_bep_logs_for_flaky_tests(test_bep_file):
                 gsutil_command(),
                 "cp",
                 test_bep_file,
-                FLAKY_TESTS_BUCKET + pipeline_slug + "/" + build_number + ".json",
+                FLAKY_TESTS_BUCKETS[buildkite_org()] + pipeline_slug + "/" + build_number + ".json",
             ]
         )
 
 
-def upload_test_logs_from_bep(bep_file, tmpdir, stop_request):
+def upload_test_logs_from_bep(bep_files, tmpdir, stop_request):
     uploaded_targets = set()
     while True:
         done = stop_request.isSet()
-        if os.path.exists(bep_file):
-            all_test_logs = test_logs_for_status(bep_file, status=["FAILED", "TIMEOUT", "FLAKY"])
-            test_logs_to_upload = [
-                (target, files) for target, files in all_test_logs if target not in uploaded_targets
-            ]
+        all_test_logs = []
+        for bep_file in bep_files:
+            if os.path.exists(bep_file):
+                all_test_logs += test_logs_for_status(
+                    bep_file, status=["FAILED", "TIMEOUT", "FLAKY"]
+                )
+        # A target appears twice once the second BEP file has been appended to the first one.
+        test_logs_to_upload = list(
+            {t: files for t, files in all_test_logs if t not in uploaded_targets}.items()
+        )
 
-            if test_logs_to_upload:
-                files_to_upload = rename_test_logs_for_upload(test_logs_to_upload, tmpdir)
-                cwd = os.getcwd()
-                try:
-                    os.chdir(tmpdir)
-                    test_logs = [os.path.relpath(file, tmpdir) for file in files_to_upload]
-                    test_logs = sorted(test_logs)
-                    execute_command(["buildkite-agent", "artifact", "upload", ";".join(test_logs)])
-                finally:
-                    uploaded_targets.update([target for target, _ in test_logs_to_upload])
-                    os.chdir(cwd)
+        if test_logs_to_upload:
+            files_to_upload = rename_test_logs_for_upload(test_logs_to_upload, tmpdir)
+            cwd = os.getcwd()
+            try:
+                os.chdir(tmpdir)
+                test_logs = [os.path.relpath(file, tmpdir) for file in files_to_upload]
+                test_logs = sorted(test_logs)
+                execute_command(["buildkite-agent", "artifact", "upload", ";".join(test_logs)])
+            finally:
+                uploaded_targets.update([target for target, _ in test_logs_to_upload])
+                os.chdir(cwd)
         if done:
             break
         time.sleep(5)
@@ -1952,6 +3453,297 @@ def upload_json_profile(json_profile_path, tmpdir):
         return
     print_collapsed_group(":gcloud: Uploading JSON Profile")
     execute_command(["buildkite-agent", "artifact", "upload", json_profile_path], cwd=tmpdir)
+    annotate_json_profile(json_profile_path)
+
+
+def iter_json_profile_events(json_profile_path):
+    """
+    Yields the events of a (possibly gzipped) Bazel JSON trace profile one by one.
+
+    Profiles can be hundreds of megabytes, so the file is decoded incrementally instead of being
+    loaded into memory as a whole.
+    """
+    opener = gzip.open if json_profile_path.endswith(".gz") else open
+    decoder = json.JSONDecoder()
+    with opener(json_profile_path, mode="rt", encoding="utf-8") as f:
+        buf = ""
+        # Skip everything up to the start of the "traceEvents" array.
+        while True:
+            start = buf.find('"traceEvents"')
+            bracket = buf.find("[", start) if start >= 0 else -1
+            if bracket >= 0:
+                buf = buf[bracket + 1 :]
+                break
+            chunk = f.read(65536)
+            if not chunk:
+                return
+            buf += chunk
+
+        # Decode events in place, since slicing the buffer after every event is quadratic.
+        pos = 0
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n,":
+                pos += 1
+            if buf.startswith("]", pos):
+                return
+            try:
+                event, pos = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # The next event is incomplete, so we need more data.
+                chunk = f.read(65536)
+                if not chunk:
+                    return
+                buf = buf[pos:] + chunk
+                pos = 0
+                continue
+            yield event
+
+
+def analyze_json_profile(json_profile_path, top_n=5):
+    """
+    Summarizes a Bazel JSON trace profile.
+
+    Returns a dict with the wall time, the duration of each build phase, the critical path and
+    its longest components, the total action time per mnemonic and per target, the number of
+    remote cache lookups and the CPU usage of Bazel. All durations are in seconds.
+
+    Remote cache hits cannot be derived from a profile: a hit may download several outputs, or
+    none with --remote_download_minimal. They are reported from the BEP instead (see
+    cache_metrics_from_bep).
+    """
+    first_ts, last_ts = None, None
+    phase_markers = []
+    critical_path_seconds = 0
+    critical_path = []
+    mnemonics = {}
+    targets = {}
+    cache_checks = 0
+    cpu_samples, cpu_sum, cpu_max = 0, 0.0, 0.0
+
+    for event in iter_json_profile_events(json_profile_path):
+        phase = event.get("ph")
+        category = event.get("cat")
+        if phase == "X":
+            ts = event.get("ts", 0)
+            duration = event.get("dur", 0)
+            first_ts = ts if first_ts is None else min(first_ts, ts)
+            last_ts = ts + duration if last_ts is None else max(last_ts, ts + duration)
+
+            seconds = duration / 1000000
+            if category == "critical path component":
+                critical_path_seconds += seconds
+                heapq.heappush(critical_path, (seconds, event.get("name", "")))
+                if len(critical_path) > top_n:
+                    heapq.heappop(critical_path)
+            elif category == "action processing":
+                # Older Bazel versions don't record the mnemonic, so we fall back to the first
+                # word of the progress message (e.g. "Compiling").
+                args = event.get("args") or {}
+                mnemonic = args.get("mnemonic") or event.get("name", "?").split(" ", 1)[0]
+                count, total = mnemonics.get(mnemonic, (0, 0))
+                mnemonics[mnemonic] = (count + 1, total + seconds)
+                if args.get("target"):
+                    targets[args["target"]] = targets.get(args["target"], 0) + seconds
+            elif category == "remote action cache check":
+                cache_checks += 1
+        elif category == "build phase marker":
+            phase_markers.append((event.get("ts", 0), event.get("name", "")))
+        elif phase == "C" and event.get("name") == "CPU usage (Bazel)":
+            try:
+                cpu = float((event.get("args") or {}).get("cpu", 0))
+            except ValueError:
+                continue
+            cpu_samples += 1
+            cpu_sum += cpu
+            cpu_max = max(cpu_max, cpu)
+
+    # Every build phase lasts until the next one starts, and the last one until the end.
+    phase_markers.sort()
+    phases = {}
+    for i, (ts, name) in enumerate(phase_markers):
+        end = phase_markers[i + 1][0] if i + 1 < len(phase_markers) else (last_ts or ts)
+        phases[name] = phases.get(name, 0) + max(0, end - ts) / 1000000
+
+    slowest_mnemonics = sorted(mnemonics.items(), key=lambda item: item[1][1], reverse=True)
+    return {
+        "wall_seconds": (last_ts - first_ts) / 1000000 if first_ts is not None else 0,
+        "phases": phases,
+        "critical_path_seconds": critical_path_seconds,
+        "critical_path": sorted(critical_path, reverse=True),
+        "mnemonics": [
+            (mnemonic, count, total) for mnemonic, (count, total) in slowest_mnemonics[:top_n]
+        ],
+        "mnemonic_seconds": {mnemonic: total for mnemonic, (_, total) in mnemonics.items()},
+        "target_seconds": targets,
+        "remote_cache_checks": cache_checks,
+        "cpu_average": cpu_sum / cpu_samples if cpu_samples else None,
+        "cpu_max": cpu_max if cpu_samples else None,
+    }
+
+
+def format_json_profile_summary(title, summary):
+    lines = [
+        "**{}**: wall time {:.0f}s, critical path {:.0f}s".format(
+            title, summary["wall_seconds"], summary["critical_path_seconds"]
+        )
+    ]
+    if summary["cpu_average"] is not None:
+        lines[0] += ", Bazel CPU usage {:.1f} cores on average ({:.1f} max)".format(
+            summary["cpu_average"], summary["cpu_max"]
+        )
+    if summary["remote_cache_checks"]:
+        lines[0] += ", {} remote cache lookups".format(summary["remote_cache_checks"])
+    if summary["mnemonics"]:
+        lines.append(
+            "- Slowest mnemonics: "
+            + ", ".join(
+                "{} {:.0f}s ({} actions)".format(mnemonic, total, count)
+                for mnemonic, count, total in summary["mnemonics"]
+            )
+        )
+    if summary["critical_path"]:
+        lines.append(
+            "- Longest critical path actions: "
+            + ", ".join(
+                "`{}` {:.1f}s".format(name, seconds) for seconds, name in summary["critical_path"]
+            )
+        )
+    return "\n".join(lines) + "\n"
+
+
+def format_json_profile_diff(title, baseline, current, top_n=10):
+    """Returns a Markdown table of the largest differences between two analyzed profiles."""
+
+    def rows(section, before, after, limit=None):
+        deltas = {n: after.get(n, 0) - before.get(n, 0) for n in set(before) | set(after)}
+        names = sorted(deltas, key=lambda n: (-abs(deltas[n]), n))
+        return [
+            "| {} | {} | {:.1f}s | {:.1f}s | {:+.1f}s |".format(
+                section, name, before.get(name, 0), after.get(name, 0), deltas[name]
+            )
+            for name in names[:limit]
+        ]
+
+    lines = [
+        "**{}** compared to the last green run:".format(title),
+        "",
+        "| | | Last green | Current | Delta |",
+        "|---|---|---|---|---|",
+    ]
+    lines += rows(
+        "Total",
+        {"wall time": baseline["wall_seconds"], "critical path": baseline["critical_path_seconds"]},
+        {"wall time": current["wall_seconds"], "critical path": current["critical_path_seconds"]},
+    )
+    lines += rows("Phase", baseline["phases"], current["phases"])
+    lines += rows("Mnemonic", baseline["mnemonic_seconds"], current["mnemonic_seconds"], top_n)
+    lines += rows("Target", baseline["target_seconds"], current["target_seconds"], top_n)
+    return "\n".join(lines) + "\n"
+
+
+def compare_json_profiles(build_number, project_name=None, max_builds=20):
+    """
+    Compares the JSON profiles of all jobs in a build with those of the last green run of the
+    same job on the default branch, and publishes the differences as an annotation.
+
+    If project_name is set, only jobs of that (downstream) project are considered.
+    """
+    pipeline_slug = os.getenv("BUILDKITE_PIPELINE_SLUG")
+    client = BuildkiteClient(org=buildkite_org(), pipeline=pipeline_slug)
+    build = client.get_build_info(build_number)
+
+    def profiles_by_job_name(build_info):
+        job_names = {
+            job["id"]: job.get("name")
+            for job in build_info["jobs"]
+            if job.get("state") == "passed" or build_info["number"] == build["number"]
+        }
+        profiles = {}
+        for artifact in client.get_build_artifacts(build_info["number"]):
+            job_name = job_names.get(artifact["job_id"])
+            if job_name and artifact["path"].endswith(".profile.gz"):
+                profiles[(job_name, os.path.basename(artifact["path"]))] = artifact
+        return profiles
+
+    current_profiles = {
+        key: artifact
+        for key, artifact in profiles_by_job_name(build).items()
+        if not project_name or key[0].startswith(project_name + " (")
+    }
+    if not current_profiles:
+        eprint("No JSON profiles found in build {}".format(build_number))
+        return
+
+    baseline_profiles = {}
+    default_branch = os.getenv("BUILDKITE_PIPELINE_DEFAULT_BRANCH") or "master"
+    previous_builds = client.get_build_info_list(
+        [("branch", default_branch), ("per_page", max_builds)]
+    )
+    for previous_build in previous_builds:
+        if previous_build["number"] >= build["number"]:
+            continue
+        if all(key in baseline_profiles for key in current_profiles):
+            break
+        for key, artifact in profiles_by_job_name(previous_build).items():
+            if key in current_profiles and key not in baseline_profiles:
+                baseline_profiles[key] = artifact
+
+    texts = []
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for (job_name, filename), artifact in sorted(current_profiles.items()):
+            if (job_name, filename) not in baseline_profiles:
+                eprint("No last green profile for {} ({})".format(job_name, filename))
+                continue
+            summaries = []
+            for i, a in enumerate((baseline_profiles[(job_name, filename)], artifact)):
+                path = os.path.join(tmpdir, "{}-{}".format(i, filename))
+                client.download_artifact(a, path)
+                summaries.append(analyze_json_profile(path))
+                os.remove(path)
+            title = "{} ({})".format(job_name, filename.split(".", 1)[0])
+            texts.append(format_json_profile_diff(title, *summaries))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    for text in texts:
+        eprint(text)
+        execute_command(
+            [
+                "buildkite-agent",
+                "annotate",
+                "--append",
+                "--style=info",
+                "--context=ctx-json-profile-diff",
+                text,
+            ],
+            fail_if_nonzero=False,
+        )
+
+
+def annotate_json_profile(json_profile_path):
+    try:
+        summary = analyze_json_profile(json_profile_path)
+    except (OSError, EOFError, ValueError) as ex:
+        eprint("Failed to analyze {}: {}".format(json_profile_path, ex))
+        return
+
+    # E.g. "build.profile.gz" -> "build"
+    profile_key = os.path.basename(json_profile_path).split(".", 1)[0]
+    title = "{} ({})".format(os.getenv("BUILDKITE_LABEL", "JSON profile"), profile_key)
+    text = format_json_profile_summary(title, summary)
+    eprint(text)
+    execute_command(
+        [
+            "buildkite-agent",
+            "annotate",
+            "--append",
+            "--style=info",
+            "--context=ctx-json-profile-{}".format(os.getenv("BUILDKITE_JOB_ID", "")),
+            text,
+        ],
+        fail_if_nonzero=False,
+    )
 
 
 def rename_test_logs_for_upload(test_logs, tmpdir):
@@ -1987,8 +3779,12 @@ def test_label_to_path(tmpdir, label, attempt):
     return os.path.join(tmpdir, path)
 
 
-def test_logs_for_status(bep_file, status):
-    targets = []
+def iter_bep_events(bep_file):
+    """
+    Yields the events of a JSON build event protocol file.
+
+    The file may still be written by Bazel, so parsing stops silently at an incomplete event.
+    """
     with open(bep_file, encoding="utf-8") as f:
         raw_data = f.read()
     decoder = json.JSONDecoder()
@@ -1996,10 +3792,19 @@ def test_logs_for_status(bep_file, status):
     pos = 0
     while pos < len(raw_data):
         try:
-            bep_obj, size = decoder.raw_decode(raw_data[pos:])
+            # Don't slice raw_data, since copying the rest of the file for every event would make
+            # parsing large files quadratic.
+            bep_obj, end = decoder.raw_decode(raw_data, pos)
         except ValueError as e:
             eprint("JSON decoding error: " + str(e))
-            return targets
+            return
+        yield bep_obj
+        pos = end + 1
+
+
+def test_logs_for_status(bep_file, status):
+    targets = []
+    for bep_obj in iter_bep_events(bep_file):
         if "testSummary" in bep_obj:
             test_target = bep_obj["id"]["testSummary"]["label"]
             test_status = bep_obj["testSummary"]["overallStatus"]
@@ -2009,10 +3814,126 @@ def test_logs_for_status(bep_file, status):
                 for output in outputs:
                     test_logs.append(url2pathname(urlparse(output["uri"]).path))
                 targets.append((test_target, test_logs))
-        pos += size + 1
     return targets
 
 
+def cache_metrics_from_bep(bep_file):
+    """
+    Returns the remote cache statistics of the invocation in a BEP file, or None if the file
+    contains no build metrics (e.g. because Bazel crashed).
+    """
+    if not os.path.exists(bep_file):
+        return None
+    for bep_obj in iter_bep_events(bep_file):
+        if "buildMetrics" not in bep_obj:
+            continue
+        # The protobuf JSON mapping represents 64-bit integers as strings.
+        metrics = bep_obj["buildMetrics"]
+        runners = {
+            r.get("name"): int(r.get("count", 0))
+            for r in metrics.get("actionSummary", {}).get("runnerCount", [])
+        }
+        network = metrics.get("networkMetrics", {}).get("systemNetworkStats", {})
+        return {
+            # Internal actions (e.g. symlinks) never go to the remote cache.
+            "actions": runners.get("total", 0) - runners.get("internal", 0),
+            "remote_cache_hits": runners.get("remote cache hit", 0)
+            + runners.get("disk cache hit", 0),
+            "bytes_downloaded": int(network["bytesRecv"]) if "bytesRecv" in network else None,
+        }
+    return None
+
+
+def failed_actions_from_bep(bep_file):
+    """Returns the label, mnemonic, exit code and stderr URI of all failed actions in a BEP file."""
+    failed_actions = []
+    if not os.path.exists(bep_file):
+        return failed_actions
+    for bep_obj in iter_bep_events(bep_file):
+        action = bep_obj.get("action")
+        if not action or action.get("success"):
+            continue
+        failed_actions.append(
+            {
+                "label": action.get("label")
+                or bep_obj.get("id", {}).get("actionCompleted", {}).get("label"),
+                "mnemonic": action.get("type", "?"),
+                "exit_code": action.get("exitCode"),
+                "stderr": (action.get("stderr") or {}).get("uri"),
+            }
+        )
+    return failed_actions
+
+
+def read_action_stderr(uri, max_bytes=FAILED_ACTION_STDERR_MAX_BYTES):
+    """Returns the end of a local action stderr file, or None if it's not available locally."""
+    if not uri or not uri.startswith("file://"):
+        return None
+    path = url2pathname(urlparse(uri).path)
+    try:
+        with open(path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            f.seek(max(0, size - max_bytes))
+            data = f.read().decode("utf-8", "replace")
+    except OSError:
+        return None
+    if size > max_bytes:
+        data = "[...]" + data[data.find("\n") :]
+    # Remove ANSI color codes, since they are not rendered in annotations.
+    return re.sub(r"\x1b\[[0-9;]*m", "", data).strip()
+
+
+def annotate_failed_actions(bep_file, step):
+    """Adds the stderr of the failed actions of a Bazel invocation to the build annotations."""
+    failed_actions = failed_actions_from_bep(bep_file)
+    if not failed_actions:
+        return
+
+    label = os.getenv("BUILDKITE_LABEL", "")
+    sections = []
+    for action in failed_actions[:FAILED_ACTIONS_MAX_COUNT]:
+        header = "**{}** {}: `{}` action for `{}` failed with exit code {}".format(
+            label, step, action["mnemonic"], action["label"], action["exit_code"]
+        )
+        stderr = read_action_stderr(action["stderr"])
+        if stderr:
+            header += "\n\n```\n{}\n```".format(stderr.replace("```", "` ` `"))
+        sections.append(header)
+    if len(failed_actions) > FAILED_ACTIONS_MAX_COUNT:
+        sections.append(
+            "and {} more failed actions".format(len(failed_actions) - FAILED_ACTIONS_MAX_COUNT)
+        )
+    text = "\n\n".join(sections) + "\n"
+
+    print_collapsed_group(":rotating_light: Failed actions")
+    eprint(text)
+    if not os.getenv("BUILDKITE_JOB_ID"):
+        return
+    execute_command(
+        [
+            "buildkite-agent",
+            "annotate",
+            "--append",
+            "--style=error",
+            "--context=ctx-failed-actions-{}".format(os.getenv("BUILDKITE_JOB_ID")),
+            text,
+        ],
+        fail_if_nonzero=False,
+    )
+
+
+def format_cache_metrics(metrics):
+    text = "{} of {} actions were remote cache hits ({:.0%})".format(
+        metrics["remote_cache_hits"],
+        metrics["actions"],
+        metrics["remote_cache_hits"] / metrics["actions"] if metrics["actions"] else 0,
+    )
+    if metrics["bytes_downloaded"] is not None:
+        text += ", {:.1f} MiB downloaded".format(metrics["bytes_downloaded"] / 1024 / 1024)
+    return text
+
+
 def execute_command_and_get_output(args, shell=False, fail_if_nonzero=True, print_output=True):
     eprint(" ".join(args))
     process = subprocess.run(
@@ -2043,6 +3964,11 @@ def execute_command_background(args):
     return subprocess.Popen(args, env=os.environ)
 
 
+def wait_for_background_process(process):
+    if process.wait() != 0:
+        raise subprocess.CalledProcessError(process.returncode, process.args)
+
+
 def terminate_background_process(process):
     if process:
         process.terminate()
@@ -2052,10 +3978,102 @@ def terminate_background_process(process):
             process.kill()
 
 
+def execute_bazel_command(args, bep_file, fail_fast=None):
+    if fail_fast:
+        fail_fast.execute_command(args, bep_file)
+    else:
+        execute_command(args)
+
+
+class FailFast(object):
+    """
+    Shares the first definitive test failure of a build between its runner jobs via Buildkite
+    meta-data, so that the other jobs can stop early.
+
+    Flaky tests don't count as failures. Retried jobs ignore failures of other jobs, so that a
+    build can still turn green (and update the last green commit) after failed jobs are retried.
+    """
+
+    def __init__(self):
+        self._job_id = os.getenv("BUILDKITE_JOB_ID")
+        self._reported = False
+        self._ignore_other_jobs = os.getenv("BUILDKITE_RETRY_COUNT", "0") != "0"
+
+    def report_failures(self, bep_file):
+        if self._reported or not self._job_id or not os.path.exists(bep_file):
+            return
+        failed_tests = [
+            target
+            for target, (status, _) in test_results_from_bep(bep_file).items()
+            if status in ("FAILED", "TIMEOUT")
+        ]
+        if not failed_tests:
+            return
+        self._reported = True
+        failure = {
+            "job_id": self._job_id,
+            "label": os.getenv("BUILDKITE_LABEL"),
+            "target": failed_tests[0],
+        }
+        execute_command(
+            ["buildkite-agent", "meta-data", "set", FAIL_FAST_METADATA_KEY, json.dumps(failure)],
+            fail_if_nonzero=False,
+        )
+
+    def failure_of_other_job(self):
+        """Returns a description of a failure that another job reported, or None."""
+        if self._ignore_other_jobs or not self._job_id:
+            return None
+        # Called every few seconds, so the command isn't logged.
+        process = subprocess.run(
+            ["buildkite-agent", "meta-data", "get", FAIL_FAST_METADATA_KEY, "--default", ""],
+            env=os.environ,
+            stdout=subprocess.PIPE,
+            universal_newlines=True,
+        )
+        try:
+            failure = json.loads(process.stdout) if process.stdout.strip() else None
+        except ValueError:
+            return None
+        if not failure or failure["job_id"] == self._job_id:
+            return None
+        return "{} failed in {}".format(failure["target"], failure["label"])
+
+    def check(self):
+        failure = self.failure_of_other_job()
+        if failure:
+            raise BuildkiteException("Stopped early (fail_fast) since {}".format(failure))
+
+    def execute_command(self, args, bep_file):
+        eprint(" ".join(args))
+        process = subprocess.Popen(args, env=os.environ)
+        while True:
+            try:
+                returncode = process.wait(timeout=FAIL_FAST_POLL_SECONDS)
+                break
+            except subprocess.TimeoutExpired:
+                self.report_failures(bep_file)
+                failure = self.failure_of_other_job()
+                if failure:
+                    if is_windows():
+                        terminate_background_process(process)
+                    else:
+                        # Bazel cancels the running command cleanly on SIGINT.
+                        process.send_signal(signal.SIGINT)
+                        try:
+                            process.wait(timeout=60)
+                        except subprocess.TimeoutExpired:
+                            process.kill()
+                    raise BuildkiteException("Stopped early (fail_fast) since {}".format(failure))
+        self.report_failures(bep_file)
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, args)
+
+
 def create_step(label, commands, platform, shards=1):
     if "docker-image" in PLATFORMS[platform]:
         step = create_docker_step(
-            label, image=PLATFORMS[platform]["docker-image"], commands=commands
+            label, image=docker_image(platform), commands=commands
         )
     else:
         step = {
@@ -2128,6 +4146,33 @@ def print_project_pipeline(
     incompatible_flags,
     notify,
 ):
+    pipeline_steps = create_project_pipeline_steps(
+        configs=configs,
+        project_name=project_name,
+        http_config=http_config,
+        file_config=file_config,
+        git_repository=git_repository,
+        monitor_flaky_tests=monitor_flaky_tests,
+        use_but=use_but,
+        incompatible_flags=incompatible_flags,
+        notify=notify,
+    )
+    is_downstream_project = (use_but or incompatible_flags) and git_repository and project_name
+    print_pipeline_steps(pipeline_steps, handle_emergencies=not is_downstream_project)
+
+
+def create_project_pipeline_steps(
+    configs,
+    project_name,
+    http_config,
+    file_config,
+    git_repository,
+    monitor_flaky_tests,
+    use_but,
+    incompatible_flags,
+    notify,
+):
+    """Returns the steps of the pipeline for a project (or a downstream project) configuration."""
     task_configs = configs.get("tasks", None)
     if not task_configs:
         raise BuildkiteException("{0} pipeline configuration is empty.".format(project_name))
@@ -2143,6 +4188,11 @@ def print_project_pipeline(
     # In Bazel Downstream Project pipelines, git_repository and project_name must be specified.
     is_downstream_project = (use_but or incompatible_flags) and git_repository and project_name
 
+    if not is_downstream_project and any(
+        c.get("affected_targets_only") for c in task_configs.values()
+    ):
+        store_affected_targets_base_commit()
+
     buildifier_config = configs.get("buildifier")
     # Skip Buildifier when we test downstream projects.
     if buildifier_config and not is_downstream_project:
@@ -2183,12 +4233,13 @@ def print_project_pipeline(
     git_commit = None
     if is_downstream_project:
         last_green_commit_url = bazelci_last_green_commit_url(
-            git_repository, DOWNSTREAM_PROJECTS[project_name]["pipeline_slug"]
+            git_repository, downstream_projects()[project_name]["pipeline_slug"]
         )
         git_commit = get_last_green_commit(last_green_commit_url)
 
     config_hashes = set()
     skipped_due_to_bazel_version = []
+    reused_results = []
     for task, task_config in task_configs.items():
         platform = get_platform_for_task(task, task_config)
         task_name = task_config.get("name")
@@ -2219,6 +4270,24 @@ def print_project_pipeline(
         except ValueError:
             raise BuildkiteException("Task {} has invalid shard value '{}'".format(task, shards))
 
+        # Sharded jobs only run a part of the tests, so their results cannot be reused.
+        if is_downstream_project and use_but and git_commit and shards == 1:
+            result = (
+                find_reusable_downstream_result(h, platform, git_repository, git_commit)
+                if reuse_downstream_results()
+                else None
+            )
+            if result:
+                reused_results.append(
+                    "- {}: passed in [{} #{}]({})".format(
+                        create_label(platform, project_name, task_name=task_name),
+                        result["pipeline"],
+                        result["build_number"],
+                        result["job_url"],
+                    )
+                )
+                continue
+
         step = runner_step(
             platform=platform,
             task=task,
@@ -2251,9 +4320,27 @@ def print_project_pipeline(
             )
         )
 
+    if reused_results:
+        lines = [
+            "The following tasks were not run again since they already passed with the same "
+            "configuration, project commit and Bazel binary:",
+            "",
+        ]
+        pipeline_steps.append(
+            create_step(
+                label=":recycle: Reused results of {} tasks".format(len(reused_results)),
+                commands=[
+                    "buildkite-agent annotate --append --style=info '{}' --context 'ctx-reused-results'".format(
+                        "\n".join(lines + reused_results) + "\n"
+                    )
+                ],
+                platform=DEFAULT_PLATFORM,
+            )
+        )
+
     pipeline_slug = os.getenv("BUILDKITE_PIPELINE_SLUG")
     all_downstream_pipeline_slugs = []
-    for _, config in DOWNSTREAM_PROJECTS.items():
+    for _, config in downstream_projects().items():
         all_downstream_pipeline_slugs.append(config["pipeline_slug"])
     # We update last green commit in the following cases:
     #   1. This job runs on master, stable or main branch (could be a custom build launched manually)
@@ -2286,6 +4373,11 @@ def print_project_pipeline(
             )
         )
 
+    # Compare the JSON profiles with those of the last green build once all tasks are done.
+    # Downstream pipelines contain many projects, so they run a single comparison at the end.
+    if not is_downstream_project and json_profiles_enabled(task_configs):
+        pipeline_steps += create_json_profile_comparison_steps()
+
     if "validate_config" in configs:
         pipeline_steps += create_config_validation_steps()
 
@@ -2296,7 +4388,7 @@ def print_project_pipeline(
         number = os.getenv("BUILDKITE_BUILD_NUMBER")
         pipeline_steps += get_steps_for_aggregating_migration_results(number, notify)
 
-    print_pipeline_steps(pipeline_steps, handle_emergencies=not is_downstream_project)
+    return pipeline_steps
 
 
 def show_gerrit_review_link(git_repository, pipeline_steps):
@@ -2339,6 +4431,111 @@ def hash_task_config(task_name, task_config):
     return m.digest()
 
 
+def downstream_result_key(task_config_hash, git_repository, git_commit, bazel_sha256):
+    """Returns the key under which a passing result of a downstream task is recorded."""
+    key = hashlib.sha256()
+    for part in (task_config_hash.hex(), git_repository, git_commit, bazel_sha256):
+        key.update(part.encode("utf-8") + b"\0")
+    return key.hexdigest()
+
+
+def read_gcs_text(gs_url):
+    """Returns the content of a Cloud Storage object, or None if it cannot be read."""
+    try:
+        return gcs_client().read(gs_url).decode("utf-8")
+    except GcsException as ex:
+        if ex.status_code != http.HTTPStatus.NOT_FOUND:
+            eprint("Failed to read {}: {}".format(gs_url, ex))
+    except (OSError, subprocess.CalledProcessError) as ex:
+        eprint("Failed to read {}: {}".format(gs_url, ex))
+    return None
+
+
+# Caches the SHA-256 of the Bazel binaries that were built at a commit, per binary platform.
+_BAZEL_BINARY_HASHES = {}
+
+
+def find_reusable_downstream_result(task_config_hash, platform, git_repository, git_commit):
+    """
+    Returns the record of an earlier passing job of a downstream task with the same configuration,
+    project commit and Bazel binary, or None.
+
+    When the pipeline is generated, the Bazel binary hasn't been built yet. Jobs record the hash of
+    the binary they downloaded, so it is known for Bazel commits that were tested before.
+    """
+    bazel_git_commit = os.getenv("BUILDKITE_COMMIT")
+    if not bazel_git_commit:
+        return None
+    hash_key = (bazel_git_commit, get_binary_platform(platform))
+    if hash_key not in _BAZEL_BINARY_HASHES:
+        _BAZEL_BINARY_HASHES[hash_key] = read_gcs_text(bazelci_downstream_bazel_hash_url(*hash_key))
+    bazel_sha256 = _BAZEL_BINARY_HASHES[hash_key]
+    if not bazel_sha256:
+        return None
+
+    result_key = downstream_result_key(task_config_hash, git_repository, git_commit, bazel_sha256)
+    result = read_gcs_text(bazelci_downstream_result_url(result_key))
+    return json.loads(result) if result else None
+
+
+def downstream_result_url(task_config_hash, platform, git_repository, git_commit, bazel_binary):
+    """
+    Records the hash of the Bazel binary that was built at the current commit and returns where
+    the result of the current downstream job is recorded.
+    """
+    bazel_sha256 = sha256_hexdigest(bazel_binary)
+    hash_url = bazelci_downstream_bazel_hash_url(
+        os.getenv("BUILDKITE_COMMIT"), get_binary_platform(platform)
+    )
+    try:
+        gcs_client().write(
+            hash_url, bazel_sha256.encode("utf-8"), "text/plain", if_generation_match="0"
+        )
+    except GcsException as ex:
+        if ex.status_code != http.HTTPStatus.PRECONDITION_FAILED:
+            eprint("Failed to record the Bazel binary hash: {}".format(ex))
+    except (OSError, subprocess.CalledProcessError) as ex:
+        eprint("Failed to record the Bazel binary hash: {}".format(ex))
+
+    result_key = downstream_result_key(task_config_hash, git_repository, git_commit, bazel_sha256)
+    return bazelci_downstream_result_url(result_key)
+
+
+def record_downstream_result(result_url, git_commit):
+    result = {
+        "pipeline": os.getenv("BUILDKITE_PIPELINE_SLUG"),
+        "build_number": os.getenv("BUILDKITE_BUILD_NUMBER"),
+        "job_url": "{}#{}".format(os.getenv("BUILDKITE_BUILD_URL"), os.getenv("BUILDKITE_JOB_ID")),
+        "bazel_commit": os.getenv("BUILDKITE_COMMIT"),
+        "git_commit": git_commit,
+    }
+    try:
+        gcs_client().write(result_url, json.dumps(result).encode("utf-8"), "application/json")
+    except (GcsException, OSError, subprocess.CalledProcessError) as ex:
+        eprint("Failed to record the result of this job: {}".format(ex))
+
+
+def annotate_reused_downstream_result(result):
+    text = "- {}: passed in [{} #{}]({})\n".format(
+        os.getenv("BUILDKITE_LABEL"), result["pipeline"], result["build_number"], result["job_url"]
+    )
+    print_expanded_group(":recycle: Reusing the result of an earlier job")
+    eprint(text)
+    if not os.getenv("BUILDKITE_JOB_ID"):
+        return
+    execute_command(
+        [
+            "buildkite-agent",
+            "annotate",
+            "--append",
+            "--style=info",
+            "--context=ctx-reused-results",
+            text,
+        ],
+        fail_if_nonzero=False,
+    )
+
+
 def get_platform_for_task(task, task_config):
     # Most pipeline configurations have exactly one task per platform, which makes it
     # convenient to use the platform name as task ID. Consequently, we use the
@@ -2371,19 +4568,37 @@ def create_config_validation_steps():
 
 
 def print_pipeline_steps(pipeline_steps, handle_emergencies=True):
+    """
+    Prints the pipeline with the given steps for `buildkite-agent pipeline upload`.
+
+    Steps are generated by the create_*_pipeline_steps() functions, which don't print anything.
+    If handle_emergencies is true, the emergency announcement (if any) is added as the first step.
+    """
     if handle_emergencies:
         emergency_step = create_emergency_announcement_step_if_necessary()
         if emergency_step:
-            pipeline_steps.insert(0, emergency_step)
+            pipeline_steps = [emergency_step] + pipeline_steps
+
+    print(dump_yaml({"steps": pipeline_steps}))
 
-    print(yaml.dump({"steps": pipeline_steps}))
+
+# Caches the emergency announcement step, since the emergency file only needs to be fetched once
+# per invocation.
+_EMERGENCY_ANNOUNCEMENT_STEPS = {}
 
 
 def create_emergency_announcement_step_if_necessary():
+    url = emergency_file_url()
+    if url not in _EMERGENCY_ANNOUNCEMENT_STEPS:
+        _EMERGENCY_ANNOUNCEMENT_STEPS[url] = create_emergency_announcement_step()
+    return _EMERGENCY_ANNOUNCEMENT_STEPS[url]
+
+
+def create_emergency_announcement_step():
     style = "error"
     message, issue_url, last_good_bazel = None, None, None
     try:
-        emergency_settings = load_remote_yaml_file(EMERGENCY_FILE_URL)
+        emergency_settings = load_remote_yaml_file(emergency_file_url())
         message = emergency_settings.get("message")
         issue_url = emergency_settings.get("issue_url")
         last_good_bazel = emergency_settings.get("last_good_bazel")
@@ -2445,24 +4660,275 @@ def runner_step(
         command += " --incompatible_flag=" + flag
     label = create_label(platform, project_name, task_name=task_name)
     return create_step(
-        label=label, commands=[fetch_bazelcipy_command(), command], platform=platform, shards=shards
+        label=label,
+        commands=[fetch_bazelcipy_command(platform), command],
+        platform=platform,
+        shards=shards,
     )
 
 
-def fetch_bazelcipy_command():
-    return "curl -sS {0} -o bazelci.py".format(SCRIPT_URL)
+def fetch_bazelcipy_command(platform=DEFAULT_PLATFORM):
+    script_url = SCRIPT_URL or github_file_url("bazelci.py")
+    return fetch_script_command("bazelci.py", script_url, platform)
 
 
 def fetch_incompatible_flag_verbose_failures_command():
-    return "curl -sS {0} -o incompatible_flag_verbose_failures.py".format(
-        INCOMPATIBLE_FLAG_VERBOSE_FAILURES_URL
+    return fetch_script_command(
+        "incompatible_flag_verbose_failures.py",
+        github_file_url("incompatible_flag_verbose_failures.py"),
+        DEFAULT_PLATFORM,
     )
 
 
 def fetch_aggregate_incompatible_flags_test_result_command():
-    return "curl -sS {0} -o aggregate_incompatible_flags_test_result.py".format(
-        AGGREGATE_INCOMPATIBLE_TEST_RESULT_URL
+    return fetch_script_command(
+        "aggregate_incompatible_flags_test_result.py",
+        github_file_url("aggregate_incompatible_flags_test_result.py"),
+        DEFAULT_PLATFORM,
+    )
+
+
+# Copies a script from the script cache of the agent into the working directory, and downloads it
+# on a cache miss. Cache entries are named after the SHA-256 of the script, so a corrupt entry is
+# replaced instead of being used. The code is passed to `python -c "..."` by every shell we use,
+# so it must not contain double quotes or characters that are expanded in them ($, %, `).
+SCRIPT_CACHE_BOOTSTRAP = ";".join(
+    [
+        "import hashlib,os,urllib.request",
+        "d=os.path.join(os.path.expanduser('~'),'.cache','bazelci','scripts')",
+        "p=os.path.join(d,'{sha256}')",
+        "c=open(p,'rb').read() if os.path.exists(p) else b''",
+        "h=hashlib.sha256(c).hexdigest()=='{sha256}'",
+        "c=c if h else urllib.request.urlopen('{url}').read()",
+        "assert hashlib.sha256(c).hexdigest()=='{sha256}','Unexpected checksum of {name}'",
+        "h or os.makedirs(d,exist_ok=True)",
+        "t=p+'.'+str(os.getpid())",
+        "h or open(t,'wb').write(c)",
+        "h or os.replace(t,p)",
+        "open('{name}','wb').write(c)",
+    ]
+)
+
+
+def fetch_script_command(name, url, platform):
+    """
+    Returns the command that puts the script with the given name into the working directory.
+
+    Inside Buildkite, steps use a cached copy of the script at a pinned commit. Otherwise, or if
+    the script cannot be pinned, the latest version is downloaded from url.
+    """
+    pinned = pinned_script(name) if PIN_SCRIPTS and os.getenv("BUILDKITE") == "true" else None
+    if not pinned:
+        return "curl -sS {0} -o {1}".format(url, name)
+    pinned_url, sha256 = pinned
+    return '{} -c "{}"'.format(
+        PLATFORMS[platform]["python"],
+        SCRIPT_CACHE_BOOTSTRAP.format(name=name, url=pinned_url, sha256=sha256),
+    )
+
+
+# Maps script names to their pinned URL and SHA-256, or to None if they couldn't be pinned.
+_PINNED_SCRIPTS = {}
+
+# Guards _PINNED_SCRIPTS and _SCRIPTS_COMMITS, since steps of downstream projects are generated by
+# several threads. Reentrant, since pinned_script() calls scripts_commit().
+_SCRIPT_PINNING_LOCK = threading.RLock()
+
+
+def pinned_script(name):
+    """
+    Returns the URL and SHA-256 of the given script at the commit that scripts are pinned to in
+    this build, or None if no commit could be resolved.
+
+    Raises a BuildkiteException if the script cannot be downloaded at that commit, since other jobs
+    of the build already use it.
+    """
+    with _SCRIPT_PINNING_LOCK:
+        if name not in _PINNED_SCRIPTS:
+            commit = scripts_commit()
+            if commit:
+                url = GITHUB_FILE_URL_TEMPLATE.format(commit, name)
+                try:
+                    with urllib.request.urlopen(url, timeout=10) as resp:
+                        _PINNED_SCRIPTS[name] = (url, hashlib.sha256(resp.read()).hexdigest())
+                except OSError as ex:
+                    raise BuildkiteException(
+                        "Failed to pin {} to commit {}: {}".format(name, commit, ex)
+                    )
+            else:
+                _PINNED_SCRIPTS[name] = None
+        return _PINNED_SCRIPTS[name]
+
+
+# Caches the commit that scripts are pinned to, which is resolved once per invocation, even if
+# several threads generate steps at the same time.
+_SCRIPTS_COMMITS = {}
+
+
+def scripts_commit():
+    """
+    Returns the commit that scripts are pinned to in the current build, or None if it cannot be
+    resolved.
+
+    Only the first job of a build that generates steps resolves the commit on GitHub. It passes
+    the commit to all later jobs via Buildkite meta-data.
+    """
+    url = scripts_commit_url()
+    with _SCRIPT_PINNING_LOCK:
+        if url not in _SCRIPTS_COMMITS:
+            commit = get_build_metadata(SCRIPTS_COMMIT_METADATA_KEY) or resolve_scripts_commit(url)
+            if commit:
+                set_build_metadata(SCRIPTS_COMMIT_METADATA_KEY, commit)
+            else:
+                annotate_unpinned_scripts(url)
+            _SCRIPTS_COMMITS[url] = commit
+        return _SCRIPTS_COMMITS[url]
+
+
+def resolve_scripts_commit(url):
+    headers = {"Accept": "application/vnd.github.VERSION.sha"}
+    # Unauthenticated requests are limited to 60 per hour and IP address.
+    if os.getenv("GITHUB_TOKEN"):
+        headers["Authorization"] = "token " + os.getenv("GITHUB_TOKEN")
+    try:
+        request = urllib.request.Request(url, headers=headers)
+        with urllib.request.urlopen(request, timeout=10) as resp:
+            commit = resp.read().decode("utf-8").strip()
+    except OSError as ex:
+        eprint("Failed to resolve {}: {}".format(url, ex))
+        return None
+    if not re.match(r"^[0-9a-f]{40}$", commit):
+        eprint("Unexpected response from {}: {}".format(url, commit))
+        return None
+    return commit
+
+
+def annotate_unpinned_scripts(url):
+    message = (
+        "Could not resolve the commit of the Bazel CI scripts ({}), so steps download their latest "
+        "version instead. Jobs of this build may run different versions of the scripts.".format(url)
     )
+    eprint(message)
+    execute_command(
+        [
+            "buildkite-agent",
+            "annotate",
+            "--style=warning",
+            "--context=ctx-unpinned-scripts",
+            message,
+        ],
+        fail_if_nonzero=False,
+    )
+
+
+def get_build_metadata(key):
+    """Returns the value of the given Buildkite meta-data key of the current build, or None."""
+    try:
+        process = subprocess.run(
+            ["buildkite-agent", "meta-data", "get", key, "--default", ""],
+            env=os.environ,
+            stdout=subprocess.PIPE,
+            universal_newlines=True,
+        )
+    except OSError:
+        return None
+    return (process.stdout.strip() or None) if process.returncode == 0 else None
+
+
+def set_build_metadata(key, value):
+    execute_command(["buildkite-agent", "meta-data", "set", key, value], fail_if_nonzero=False)
+
+
+def json_profiles_enabled(task_configs):
+    return any(c.get("include_json_profile") for c in task_configs.values())
+
+
+def create_json_profile_comparison_steps():
+    return [
+        {"wait": None, "continue_on_failure": True},
+        create_step(
+            label=":chart_with_upwards_trend: Compare JSON profiles with last green build",
+            commands=[
+                fetch_bazelcipy_command(),
+                PLATFORMS[DEFAULT_PLATFORM]["python"] + " bazelci.py compare_json_profiles",
+            ],
+            platform=DEFAULT_PLATFORM,
+        ),
+    ]
+
+
+def create_downstream_project_steps(projects, incompatible_flags):
+    """
+    Returns the steps of all given downstream projects, which replaces one "Setup" job per
+    project. The configurations and last green commits of the projects are fetched concurrently.
+
+    If the steps of a project cannot be generated here, the project gets a regular "Setup" step,
+    so that the error is reported in its own job and doesn't affect other projects.
+
+    The second return value tells whether any project uploads JSON profiles.
+    """
+    work_queue = queue.Queue()
+    results = {}
+    profiled_projects = set()
+
+    def worker():
+        while True:
+            project = work_queue.get()
+            if project is None:
+                break
+            config = downstream_projects()[project]
+            try:
+                configs = fetch_configs(config.get("http_config"), config.get("file_config"))
+                results[project] = create_project_pipeline_steps(
+                    configs=configs,
+                    project_name=project,
+                    http_config=config.get("http_config"),
+                    file_config=config.get("file_config"),
+                    git_repository=config["git_repository"],
+                    monitor_flaky_tests=False,
+                    use_but=incompatible_flags is None,
+                    incompatible_flags=incompatible_flags,
+                    notify=False,
+                )
+                if json_profiles_enabled(configs.get("tasks") or {}):
+                    profiled_projects.add(project)
+            except Exception as ex:
+                eprint("Failed to generate the steps for {}: {}".format(project, ex))
+                results[project] = [
+                    upload_project_pipeline_step(
+                        project_name=project,
+                        git_repository=config["git_repository"],
+                        http_config=config.get("http_config", None),
+                        file_config=config.get("file_config", None),
+                        incompatible_flags=incompatible_flags,
+                    )
+                ]
+            finally:
+                work_queue.task_done()
+
+    # Pins bazelci.py, which every project step downloads, before the workers start, so that they
+    # don't all wait for the same GitHub requests.
+    fetch_bazelcipy_command()
+
+    for project in projects:
+        work_queue.put(project)
+
+    threads = []
+    for _ in range(min(DOWNSTREAM_PIPELINE_GENERATION_THREADS, len(projects))):
+        t = threading.Thread(target=worker)
+        t.start()
+        threads.append(t)
+
+    work_queue.join()
+    for _ in threads:
+        work_queue.put(None)
+    for t in threads:
+        t.join()
+
+    steps = []
+    for project in projects:
+        steps += results[project]
+    return steps, bool(profiled_projects)
 
 
 def upload_project_pipeline_step(
@@ -2537,7 +5003,7 @@ def bazel_build_step(
 
     return create_step(
         label=create_label(platform, project_name, build_only, test_only),
-        commands=[fetch_bazelcipy_command(), pipeline_command],
+        commands=[fetch_bazelcipy_command(platform), pipeline_command],
         platform=platform,
     )
 
@@ -2603,6 +5069,12 @@ def print_skip_task_annotations(annotations, pipeline_steps):
 
 
 def print_bazel_publish_binaries_pipeline(task_configs, http_config, file_config):
+    print_pipeline_steps(
+        create_bazel_publish_binaries_pipeline_steps(task_configs, http_config, file_config)
+    )
+
+
+def create_bazel_publish_binaries_pipeline_steps(task_configs, http_config, file_config):
     if not task_configs:
         raise BuildkiteException("Bazel publish binaries pipeline configuration is empty.")
 
@@ -2649,7 +5121,7 @@ def print_bazel_publish_binaries_pipeline(task_configs, http_config, file_config
         )
     )
 
-    print_pipeline_steps(pipeline_steps)
+    return pipeline_steps
 
 
 def should_publish_binaries_for_platform(platform):
@@ -2661,7 +5133,7 @@ def should_publish_binaries_for_platform(platform):
 
 def print_disabled_projects_info_box_step():
     info_text = ["Downstream testing is disabled for the following projects :sadpanda:"]
-    for project, config in DOWNSTREAM_PROJECTS.items():
+    for project, config in downstream_projects().items():
         disabled_reason = config.get("disabled_reason", None)
         if disabled_reason:
             info_text.append("* **%s**: %s" % (project, disabled_reason))
@@ -2743,7 +5215,35 @@ def get_bazel_major_version():
 
 
 def print_bazel_downstream_pipeline(
-    task_configs, http_config, file_config, test_incompatible_flags, test_disabled_projects, notify
+    task_configs,
+    http_config,
+    file_config,
+    test_incompatible_flags,
+    test_disabled_projects,
+    notify,
+    inline_project_pipelines=False,
+):
+    print_pipeline_steps(
+        create_bazel_downstream_pipeline_steps(
+            task_configs=task_configs,
+            http_config=http_config,
+            file_config=file_config,
+            test_incompatible_flags=test_incompatible_flags,
+            test_disabled_projects=test_disabled_projects,
+            notify=notify,
+            inline_project_pipelines=inline_project_pipelines,
+        )
+    )
+
+
+def create_bazel_downstream_pipeline_steps(
+    task_configs,
+    http_config,
+    file_config,
+    test_incompatible_flags,
+    test_disabled_projects,
+    notify,
+    inline_project_pipelines=False,
 ):
     if not task_configs:
         raise BuildkiteException("Bazel downstream pipeline configuration is empty.")
@@ -2784,13 +5284,23 @@ def print_bazel_downstream_pipeline(
             pipeline_steps.append(info_box_step)
         incompatible_flags = list(incompatible_flags_map.keys())
 
-    for project, config in DOWNSTREAM_PROJECTS.items():
-        disabled_reason = config.get("disabled_reason", None)
-        # If test_disabled_projects is true, we add configs for disabled projects.
-        # If test_disabled_projects is false, we add configs for not disabled projects.
-        if (test_disabled_projects and disabled_reason) or (
-            not test_disabled_projects and not disabled_reason
-        ):
+    # If test_disabled_projects is true, we add configs for disabled projects.
+    # If test_disabled_projects is false, we add configs for not disabled projects.
+    projects = [
+        project
+        for project, config in downstream_projects().items()
+        if bool(test_disabled_projects) == bool(config.get("disabled_reason", None))
+    ]
+    # The configurations of the projects are only known here if their steps are inlined.
+    compare_json_profiles = False
+    if inline_project_pipelines:
+        project_steps, compare_json_profiles = create_downstream_project_steps(
+            projects, incompatible_flags
+        )
+        pipeline_steps += project_steps
+    else:
+        for project in projects:
+            config = downstream_projects()[project]
             pipeline_steps.append(
                 upload_project_pipeline_step(
                     project_name=project,
@@ -2844,7 +5354,11 @@ def print_bazel_downstream_pipeline(
             )
         )
 
-    print_pipeline_steps(pipeline_steps)
+    # Added last, since a failed comparison must not allow the last green commit to be updated.
+    if compare_json_profiles and not test_incompatible_flags:
+        pipeline_steps += create_json_profile_comparison_steps()
+
+    return pipeline_steps
 
 
 def get_steps_for_aggregating_migration_results(current_build_number, notify):
@@ -2870,48 +5384,67 @@ def get_steps_for_aggregating_migration_results(current_build_number, notify):
 
 
 def bazelci_builds_download_url(platform, git_commit):
-    bucket_name = "bazel-testing-builds" if THIS_IS_TESTING else "bazel-builds"
+    bucket_name = "bazel-testing-builds" if this_is_testing() else "bazel-builds"
     return "https://storage.googleapis.com/{}/artifacts/{}/{}/bazel".format(
         bucket_name, platform, git_commit
     )
 
 
 def bazelci_builds_nojdk_download_url(platform, git_commit):
-    bucket_name = "bazel-testing-builds" if THIS_IS_TESTING else "bazel-builds"
+    bucket_name = "bazel-testing-builds" if this_is_testing() else "bazel-builds"
     return "https://storage.googleapis.com/{}/artifacts/{}/{}/bazel_nojdk".format(
         bucket_name, platform, git_commit
     )
 
 
 def bazelci_builds_gs_url(platform, git_commit):
-    bucket_name = "bazel-testing-builds" if THIS_IS_TESTING else "bazel-builds"
+    bucket_name = "bazel-testing-builds" if this_is_testing() else "bazel-builds"
     return "gs://{}/artifacts/{}/{}/bazel".format(bucket_name, platform, git_commit)
 
 
 def bazelci_builds_nojdk_gs_url(platform, git_commit):
-    bucket_name = "bazel-testing-builds" if THIS_IS_TESTING else "bazel-builds"
+    bucket_name = "bazel-testing-builds" if this_is_testing() else "bazel-builds"
     return "gs://{}/artifacts/{}/{}/bazel_nojdk".format(bucket_name, platform, git_commit)
 
 
 def bazelci_latest_build_metadata_url():
-    bucket_name = "bazel-testing-builds" if THIS_IS_TESTING else "bazel-builds"
+    bucket_name = "bazel-testing-builds" if this_is_testing() else "bazel-builds"
     return "gs://{}/metadata/latest.json".format(bucket_name)
 
 
 def bazelci_builds_metadata_url(git_commit):
-    bucket_name = "bazel-testing-builds" if THIS_IS_TESTING else "bazel-builds"
+    bucket_name = "bazel-testing-builds" if this_is_testing() else "bazel-builds"
     return "gs://{}/metadata/{}.json".format(bucket_name, git_commit)
 
 
 def bazelci_last_green_commit_url(git_repository, pipeline_slug):
-    bucket_name = "bazel-testing-builds" if THIS_IS_TESTING else "bazel-untrusted-builds"
+    bucket_name = "bazel-testing-builds" if this_is_testing() else "bazel-untrusted-builds"
     return "gs://{}/last_green_commit/{}/{}".format(
         bucket_name, git_repository[len("https://") :], pipeline_slug
     )
 
 
+def bazelci_downstream_result_url(result_key):
+    bucket_name = "bazel-testing-builds" if this_is_testing() else "bazel-untrusted-builds"
+    return "gs://{}/downstream_results/passed/{}.json".format(bucket_name, result_key)
+
+
+def bazelci_downstream_bazel_hash_url(bazel_git_commit, binary_platform):
+    bucket_name = "bazel-testing-builds" if this_is_testing() else "bazel-untrusted-builds"
+    return "gs://{}/downstream_results/bazel/{}/{}".format(
+        bucket_name, bazel_git_commit, binary_platform
+    )
+
+
+def bazelci_test_history_url(pipeline_slug, task_config_hash):
+    bucket_name = "bazel-testing-builds" if this_is_testing() else "bazel-untrusted-builds"
+    return "gs://{}/test_history/{}/{}.json".format(
+        bucket_name, pipeline_slug, task_config_hash.hex()
+    )
+
+
 def bazelci_last_green_downstream_commit_url():
-    bucket_name = "bazel-testing-builds" if THIS_IS_TESTING else "bazel-untrusted-builds"
+    bucket_name = "bazel-testing-builds" if this_is_testing() else "bazel-untrusted-builds"
     return "gs://{}/last_green_commit/downstream_pipeline".format(bucket_name)
 
 
@@ -3010,33 +5543,22 @@ def try_update_last_green_downstream_commit():
 
 
 def latest_generation_and_build_number():
-    generation = None
-    output = None
-    for attempt in range(5):
-        output = subprocess.check_output(
-            [gsutil_command(), "stat", bazelci_latest_build_metadata_url()], env=os.environ
-        )
-        match = re.search("Generation:[ ]*([0-9]+)", output.decode("utf-8"))
-        if not match:
-            raise BuildkiteException("Couldn't parse generation. gsutil output format changed?")
-        generation = match.group(1)
-
-        match = re.search(r"Hash \(md5\):[ ]*([^\s]+)", output.decode("utf-8"))
-        if not match:
-            raise BuildkiteException("Couldn't parse md5 hash. gsutil output format changed?")
-        expected_md5hash = base64.b64decode(match.group(1))
-
-        output = subprocess.check_output(
-            [gsutil_command(), "cat", bazelci_latest_build_metadata_url()], env=os.environ
-        )
-        hasher = hashlib.md5()
-        hasher.update(output)
-        actual_md5hash = hasher.digest()
-
-        if expected_md5hash == actual_md5hash:
-            break
-    info = json.loads(output.decode("utf-8"))
-    return generation, info["build_number"]
+    client = gcs_client()
+    for _ in range(5):
+        generation = client.get_metadata(bazelci_latest_build_metadata_url())["generation"]
+        try:
+            # Reading exactly the generation we just looked up guarantees that the content
+            # matches it, even if another build publishes its binaries in the meantime.
+            content = client.read(bazelci_latest_build_metadata_url(), generation=generation)
+        except GcsException as ex:
+            if ex.status_code == http.HTTPStatus.NOT_FOUND:
+                continue
+            raise
+        info = json.loads(content.decode("utf-8"))
+        return generation, info["build_number"]
+    raise BuildkiteException(
+        "Could not read {}, ran out of attempts.".format(bazelci_latest_build_metadata_url())
+    )
 
 
 def sha256_hexdigest(filename):
@@ -3051,49 +5573,92 @@ def upload_bazel_binaries():
     """
     Uploads all Bazel binaries to a deterministic URL based on the current Git commit.
 
+    The bazel and bazel_nojdk binaries of all platforms are downloaded, hashed and uploaded in
+    parallel.
+
     Returns maps of platform names to sha256 hashes of the corresponding bazel and bazel_nojdk binaries.
     """
+    git_commit = os.environ["BUILDKITE_COMMIT"]
     bazel_hashes = {}
     bazel_nojdk_hashes = {}
-    for platform_name, platform in PLATFORMS.items():
-        if not should_publish_binaries_for_platform(platform_name):
-            continue
+    failures = []
+    lock = threading.Lock()
+
+    def upload(platform_name, download_func, gs_url_func, hashes):
         tmpdir = tempfile.mkdtemp()
         try:
-            bazel_binary_path = download_bazel_binary(tmpdir, platform_name)
+            binary_path = download_func(tmpdir, platform_name)
             # One platform that we build on can generate binaries for multiple platforms, e.g.
             # the centos7 platform generates binaries for the "centos7" platform, but also
             # for the generic "linux" platform.
-            for target_platform_name in platform["publish_binary"]:
-                execute_command(
-                    [
-                        gsutil_command(),
-                        "cp",
-                        bazel_binary_path,
-                        bazelci_builds_gs_url(target_platform_name, os.environ["BUILDKITE_COMMIT"]),
-                    ]
-                )
-                bazel_hashes[target_platform_name] = sha256_hexdigest(bazel_binary_path)
-
-            # Also publish bazel_nojdk binaries.
-            bazel_nojdk_binary_path = download_bazel_nojdk_binary(tmpdir, platform_name)
-            for target_platform_name in platform["publish_binary"]:
-                execute_command(
-                    [
-                        gsutil_command(),
-                        "cp",
-                        bazel_nojdk_binary_path,
-                        bazelci_builds_nojdk_gs_url(
-                            target_platform_name, os.environ["BUILDKITE_COMMIT"]
-                        ),
-                    ]
-                )
-                bazel_nojdk_hashes[target_platform_name] = sha256_hexdigest(bazel_nojdk_binary_path)
+            target_platform_names = PLATFORMS[platform_name]["publish_binary"]
+            sha256 = upload_binary_to_gcs(
+                binary_path, [gs_url_func(t, git_commit) for t in target_platform_names]
+            )
+            with lock:
+                for target_platform_name in target_platform_names:
+                    hashes[target_platform_name] = sha256
+        except Exception as e:
+            # Exceptions must not escape the thread, since its hashes would be missing silently.
+            with lock:
+                failures.append("{} ({}): {}".format(platform_name, download_func.__name__, e))
         finally:
             shutil.rmtree(tmpdir)
+
+    threads = []
+    for platform_name in PLATFORMS:
+        if not should_publish_binaries_for_platform(platform_name):
+            continue
+        for download_func, gs_url_func, hashes in (
+            (download_bazel_binary, bazelci_builds_gs_url, bazel_hashes),
+            # Also publish bazel_nojdk binaries.
+            (download_bazel_nojdk_binary, bazelci_builds_nojdk_gs_url, bazel_nojdk_hashes),
+        ):
+            t = threading.Thread(
+                target=upload, args=(platform_name, download_func, gs_url_func, hashes)
+            )
+            t.start()
+            threads.append(t)
+
+    for t in threads:
+        t.join()
+
+    if failures:
+        raise BuildkiteException(
+            "Failed to upload Bazel binaries:\n{}".format("\n".join(sorted(failures)))
+        )
     return bazel_hashes, bazel_nojdk_hashes
 
 
+def upload_binary_to_gcs(binary_path, gs_urls):
+    """
+    Uploads the given binary to all GCS URLs and returns its sha256 hash.
+
+    The local file is only uploaded once, and its hash is computed while that upload is running.
+    All other URLs are then populated concurrently via server-side copies of the first object.
+    """
+    upload_process = execute_command_background([gsutil_command(), "cp", binary_path, gs_urls[0]])
+    try:
+        sha256 = sha256_hexdigest(binary_path)
+    finally:
+        wait_for_background_process(upload_process)
+
+    copy_processes = [
+        execute_command_background([gsutil_command(), "cp", gs_urls[0], url])
+        for url in gs_urls[1:]
+    ]
+    # Wait for all copies, so that no process outlives a failed upload.
+    error = None
+    for process in copy_processes:
+        try:
+            wait_for_background_process(process)
+        except subprocess.CalledProcessError as e:
+            error = error or e
+    if error:
+        raise error
+    return sha256
+
+
 def try_publish_binaries(bazel_hashes, bazel_nojdk_hashes, build_number, expected_generation):
     """
     Uploads the info.json file that contains information about the latest Bazel commit that was
@@ -3114,38 +5679,24 @@ def try_publish_binaries(bazel_hashes, bazel_nojdk_hashes, build_number, expecte
             "nojdk_url": bazelci_builds_nojdk_download_url(platform, git_commit),
             "nojdk_sha256": bazel_nojdk_hashes[platform],
         }
-    tmpdir = tempfile.mkdtemp()
+    client = gcs_client()
     try:
-        info_file = os.path.join(tmpdir, "info.json")
-        with open(info_file, mode="w", encoding="utf-8") as fp:
-            json.dump(info, fp, indent=2, sort_keys=True)
-
-        try:
-            execute_command(
-                [
-                    gsutil_command(),
-                    "-h",
-                    "x-goog-if-generation-match:" + expected_generation,
-                    "-h",
-                    "Content-Type:application/json",
-                    "cp",
-                    info_file,
-                    bazelci_latest_build_metadata_url(),
-                ]
-            )
-        except subprocess.CalledProcessError:
+        metadata = client.write(
+            bazelci_latest_build_metadata_url(),
+            json.dumps(info, indent=2, sort_keys=True).encode("utf-8"),
+            content_type="application/json",
+            if_generation_match=expected_generation,
+        )
+    except GcsException as ex:
+        if ex.status_code == http.HTTPStatus.PRECONDITION_FAILED:
             raise BinaryUploadRaceException()
+        raise
 
-        execute_command(
-            [
-                gsutil_command(),
-                "cp",
-                bazelci_latest_build_metadata_url(),
-                bazelci_builds_metadata_url(git_commit),
-            ]
-        )
-    finally:
-        shutil.rmtree(tmpdir)
+    client.copy(
+        bazelci_latest_build_metadata_url(),
+        bazelci_builds_metadata_url(git_commit),
+        source_generation=metadata["generation"],
+    )
 
 
 def publish_binaries():
@@ -3200,12 +5751,44 @@ def str_presenter(dumper, data):
     return dumper.represent_scalar("tag:yaml.org,2002:str", data)
 
 
+# Caches the YAML loader and dumper classes. PyYAML is only imported by the subcommands that read
+# configurations or emit pipelines.
+_YAML_CLASSES = {}
+
+
+def yaml_classes():
+    """
+    Returns the YAML loader and dumper classes. Uses the libyaml bindings if PyYAML was built
+    with them, since they are much faster when loading large configurations or emitting
+    pipelines with thousands of steps.
+    """
+    if not _YAML_CLASSES:
+        try:
+            from yaml import CSafeDumper as Dumper, CSafeLoader as Loader
+        except ImportError:
+            from yaml import SafeDumper as Dumper, SafeLoader as Loader
+
+        Dumper.add_representer(str, str_presenter)
+        _YAML_CLASSES.update(loader=Loader, dumper=Dumper)
+    return _YAML_CLASSES["loader"], _YAML_CLASSES["dumper"]
+
+
+def load_yaml(stream):
+    import yaml
+
+    return yaml.load(stream, Loader=yaml_classes()[0])
+
+
+def dump_yaml(data):
+    import yaml
+
+    return yaml.dump(data, Dumper=yaml_classes()[1])
+
+
 def main(argv=None):
     if argv is None:
         argv = sys.argv[1:]
 
-    yaml.add_representer(str, str_presenter)
-
     parser = argparse.ArgumentParser(description="Bazel Continuous Integration Script")
     parser.add_argument("--script", type=str)
 
@@ -3227,6 +5810,9 @@ def main(argv=None):
         "--test_disabled_projects", type=bool, nargs="?", const=True
     )
     bazel_downstream_pipeline.add_argument("--notify", type=bool, nargs="?", const=True)
+    bazel_downstream_pipeline.add_argument(
+        "--inline_project_pipelines", type=bool, nargs="?", const=True
+    )
 
     project_pipeline = subparsers.add_parser("project_pipeline")
     project_pipeline.add_argument("--project_name", type=str)
@@ -3262,6 +5848,20 @@ def main(argv=None):
     runner.add_argument("--monitor_flaky_tests", type=bool, nargs="?", const=True)
     runner.add_argument("--incompatible_flag", type=str, action="append")
 
+    collect_cache_metrics_parser = subparsers.add_parser("collect_cache_metrics")
+    collect_cache_metrics_parser.add_argument("--pipeline", type=str, action="append", required=True)
+    collect_cache_metrics_parser.add_argument("--builds", type=int, default=50)
+    collect_cache_metrics_parser.add_argument("--output", type=str, default="cache_metrics.csv")
+
+    collect_phase_timings_parser = subparsers.add_parser("collect_phase_timings")
+    collect_phase_timings_parser.add_argument("--pipeline", type=str, action="append", required=True)
+    collect_phase_timings_parser.add_argument("--builds", type=int, default=50)
+    collect_phase_timings_parser.add_argument("--output", type=str, default="phase_timings.csv")
+
+    compare_json_profiles_parser = subparsers.add_parser("compare_json_profiles")
+    compare_json_profiles_parser.add_argument("--build_number", type=int)
+    compare_json_profiles_parser.add_argument("--project_name", type=str)
+
     subparsers.add_parser("publish_binaries")
     subparsers.add_parser("try_update_last_green_commit")
     subparsers.add_parser("try_update_last_green_downstream_commit")
@@ -3269,8 +5869,9 @@ def main(argv=None):
     args = parser.parse_args(argv)
 
     if args.script:
-        global SCRIPT_URL
+        global SCRIPT_URL, PIN_SCRIPTS
         SCRIPT_URL = args.script
+        PIN_SCRIPTS = False
 
     try:
         if args.subparsers_name == "bazel_publish_binaries_pipeline":
@@ -3289,6 +5890,7 @@ def main(argv=None):
                 test_incompatible_flags=args.test_incompatible_flags,
                 test_disabled_projects=args.test_disabled_projects,
                 notify=args.notify,
+                inline_project_pipelines=args.inline_project_pipelines,
             )
         elif args.subparsers_name == "project_pipeline":
             configs = fetch_configs(args.http_config, args.file_config)
@@ -3331,7 +5933,23 @@ def main(argv=None):
                 monitor_flaky_tests=args.monitor_flaky_tests,
                 incompatible_flags=args.incompatible_flag,
                 bazel_version=task_config.get("bazel") or configs.get("bazel"),
+                task_config_hash=hash_task_config(args.task, task_config),
+            )
+        elif args.subparsers_name == "collect_cache_metrics":
+            regressions = collect_cache_metrics(
+                pipelines=args.pipeline, build_count=args.builds, output_file=args.output
+            )
+            if regressions:
+                return 1
+        elif args.subparsers_name == "collect_phase_timings":
+            collect_phase_timings(
+                pipelines=args.pipeline, build_count=args.builds, output_file=args.output
             )
+        elif args.subparsers_name == "compare_json_profiles":
+            build_number = args.build_number or os.getenv("BUILDKITE_BUILD_NUMBER")
+            if not build_number:
+                raise BuildkiteException("Not running inside Buildkite")
+            compare_json_profiles(build_number=int(build_number), project_name=args.project_name)
         elif args.subparsers_name == "publish_binaries":
             publish_binaries()
         elif args.subparsers_name == "try_update_last_green_commit":
@@ -0,0 +1,509 @@
+#!/usr/bin/env python3
+#
+# Copyright 2020 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Measures how long bazelci.py takes to start, to generate pipelines and to parse build event files.
+
+The benchmarks replay the downstream project configurations recorded in
+benchmark_fixtures/downstream_configs.json, and don't access the network. Only the startup
+benchmarks run subprocesses. Use the "record" command to update the fixtures.
+"""
+
+import argparse
+import contextlib
+import copy
+import datetime
+import gzip
+import hashlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from unittest import mock
+
+# Pipeline generation reads these.
+os.environ.setdefault("BUILDKITE_ORGANIZATION_SLUG", "bazel")
+os.environ.setdefault("BUILDKITE_PIPELINE_SLUG", "bazelci-benchmark")
+
+import bazelci  # noqa: E402
+import incompatible_flag_verbose_failures  # noqa: E402
+import yaml  # noqa: E402
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+FIXTURES_FILE = os.path.join(SCRIPT_DIR, "benchmark_fixtures", "downstream_configs.json")
+
+HTTP_CONFIG = "https://raw.githubusercontent.com/bazelbuild/bazel/master/.bazelci/presubmit.yml"
+
+LAST_GREEN_COMMIT = "0123456789abcdef0123456789abcdef01234567"
+
+
+class PurePythonDumper(yaml.SafeDumper):
+    pass
+
+
+PurePythonDumper.add_representer(str, bazelci.str_presenter)
+
+
+def measure(function, repeat):
+    """Returns the fastest of `repeat` runs of function in seconds."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def load_fixtures():
+    with open(FIXTURES_FILE, encoding="utf-8") as f:
+        return json.load(f)["configs"]
+
+
+def record_fixtures():
+    """Downloads the configurations (including imports) of all downstream projects."""
+    configs = {}
+
+    def fetch(http_url):
+        with urllib.request.urlopen(http_url) as resp:
+            configs[http_url] = resp.read().decode("utf-8")
+        return bazelci.load_yaml(configs[http_url])
+
+    with mock.patch.object(bazelci, "load_remote_yaml_file", side_effect=fetch):
+        for project, config in sorted(bazelci.downstream_projects().items()):
+            if not config.get("http_config"):
+                continue
+            try:
+                bazelci.load_config(config["http_config"], None)
+            except (urllib.error.URLError, yaml.YAMLError) as ex:
+                bazelci.eprint("Skipping {}: {}".format(project, ex))
+
+    with open(FIXTURES_FILE, mode="w", encoding="utf-8") as f:
+        json.dump(
+            {"recorded_at": datetime.date.today().isoformat(), "configs": configs},
+            f,
+            indent=2,
+            sort_keys=True,
+        )
+        f.write("\n")
+    bazelci.eprint("Recorded {} configurations in {}".format(len(configs), FIXTURES_FILE))
+
+
+@contextlib.contextmanager
+def replay(configs):
+    """Replaces all network and subprocess calls of pipeline generation with recorded data."""
+
+    def load_remote_yaml_file(http_url):
+        if http_url == bazelci.emergency_file_url():
+            return {}
+        if http_url not in configs:
+            raise urllib.error.HTTPError(http_url, 404, "Not recorded", None, None)
+        return bazelci.load_yaml(configs[http_url])
+
+    # Only projects whose configuration was recorded take part in the benchmarks.
+    projects = {
+        name: config
+        for name, config in bazelci.downstream_projects().items()
+        if config.get("http_config") in configs
+    }
+    env = {
+        "BUILDKITE": "true",
+        "BUILDKITE_BRANCH": "master",
+        "BUILDKITE_BUILD_NUMBER": "1",
+        "BUILDKITE_COMMIT": LAST_GREEN_COMMIT,
+        "BUILDKITE_REPO": "https://github.com/bazelbuild/bazel.git",
+    }
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(mock.patch.dict(os.environ, env))
+        stack.enter_context(
+            mock.patch.object(bazelci, "downstream_projects", return_value=projects)
+        )
+        stack.enter_context(
+            mock.patch.object(bazelci, "load_remote_yaml_file", side_effect=load_remote_yaml_file)
+        )
+        stack.enter_context(
+            mock.patch.object(bazelci, "get_last_green_commit", return_value=LAST_GREEN_COMMIT)
+        )
+        stack.enter_context(
+            mock.patch.object(bazelci, "execute_command_and_get_output", return_value="")
+        )
+        stack.enter_context(
+            mock.patch.object(bazelci, "pinned_script", side_effect=pinned_script)
+        )
+        bazelci._EMERGENCY_ANNOUNCEMENT_STEPS.clear()
+        yield projects
+
+
+def pinned_script(name):
+    url = bazelci.GITHUB_FILE_URL_TEMPLATE.format(LAST_GREEN_COMMIT, name)
+    return url, hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+
+def largest_task_configs(configs):
+    largest = {}
+    for http_url in configs:
+        try:
+            tasks = bazelci.load_config(http_url, None)["tasks"]
+        except bazelci.BuildkiteException:
+            continue
+        if len(tasks) > len(largest):
+            largest = tasks
+    return largest
+
+
+def scaled_task_configs(task_configs, count):
+    names = sorted(task_configs)
+    scaled = {}
+    for i in range(count):
+        name = names[i % len(names)]
+        task_config = copy.deepcopy(task_configs[name])
+        # The platform can no longer be derived from the task name.
+        task_config["platform"] = bazelci.get_platform_for_task(name, task_config)
+        scaled["{}_{}".format(name, i)] = task_config
+    return scaled
+
+
+def create_project_pipeline_steps(task_configs, project_name=None, git_repository=None):
+    return bazelci.create_project_pipeline_steps(
+        configs={"tasks": copy.deepcopy(task_configs)},
+        project_name=project_name,
+        http_config=HTTP_CONFIG,
+        file_config=None,
+        git_repository=git_repository,
+        monitor_flaky_tests=False,
+        use_but=bool(git_repository),
+        incompatible_flags=None,
+        notify=False,
+    )
+
+
+def benchmark_project_pipeline(configs, projects, repeat):
+    results = {}
+
+    def all_fixtures():
+        for http_url in configs:
+            try:
+                config = bazelci.load_config(http_url, None)
+                create_project_pipeline_steps(config["tasks"])
+            except bazelci.BuildkiteException:
+                # Some projects use task configurations that are no longer supported.
+                pass
+
+    results["project_pipeline_all_fixtures"] = measure(all_fixtures, repeat)
+
+    task_configs = largest_task_configs(configs)
+    for count in (10, 100, 1000):
+        scaled = scaled_task_configs(task_configs, count)
+        results["project_pipeline_{}_tasks".format(count)] = measure(
+            lambda: create_project_pipeline_steps(scaled), repeat
+        )
+        for name, config in sorted(projects.items())[:1]:
+            results["downstream_project_pipeline_{}_tasks".format(count)] = measure(
+                lambda: create_project_pipeline_steps(scaled, name, config["git_repository"]),
+                repeat,
+            )
+    return results
+
+
+def benchmark_downstream_pipeline(configs, projects, repeat):
+    results = {}
+    bazel_tasks = {p: {"build_targets": ["//src:bazel"]} for p in ("ubuntu1804", "macos")}
+
+    def downstream(test_incompatible_flags=False, inline_project_pipelines=False):
+        return bazelci.create_bazel_downstream_pipeline_steps(
+            task_configs=copy.deepcopy(bazel_tasks),
+            http_config=HTTP_CONFIG,
+            file_config=None,
+            test_incompatible_flags=test_incompatible_flags,
+            test_disabled_projects=False,
+            notify=False,
+            inline_project_pipelines=inline_project_pipelines,
+        )
+
+    for count in (len(projects), 4 * len(projects)):
+        scaled = {
+            "{} #{}".format(name, i): config
+            for i in range(count // max(1, len(projects)))
+            for name, config in projects.items()
+        }
+        with mock.patch.object(bazelci, "downstream_projects", return_value=scaled):
+            results["downstream_pipeline_{}_projects".format(count)] = measure(downstream, repeat)
+            results["downstream_pipeline_inline_{}_projects".format(count)] = measure(
+                lambda: downstream(inline_project_pipelines=True), repeat
+            )
+
+    for flag_count in (10, 50):
+        flags = " ".join("--incompatible_flag_{}".format(i) for i in range(flag_count))
+        with mock.patch.dict(os.environ, {"INCOMPATIBLE_FLAGS": flags}):
+            results["incompatible_flags_pipeline_{}_flags".format(flag_count)] = measure(
+                lambda: downstream(test_incompatible_flags=True), repeat
+            )
+    return results
+
+
+def benchmark_incompatible_flag_verbose_failures(configs, repeat):
+    results = {}
+    http_url = sorted(configs)[0]
+    tasks = bazelci.load_config(http_url, None)["tasks"]
+    for job_count, flag_count in ((10, 10), (30, 50)):
+        build_info = {
+            "jobs": [
+                {
+                    "name": "Job {}".format(i),
+                    "state": "failed",
+                    "command": bazelci.fetch_bazelcipy_command()
+                    + "\npython3.6 bazelci.py runner --task={} --http_config={} "
+                    "--incompatible_flag=--incompatible_foo".format(
+                        sorted(tasks)[i % len(tasks)], http_url
+                    ),
+                }
+                for i in range(job_count)
+            ]
+        }
+        flags = " ".join("--incompatible_flag_{}".format(i) for i in range(flag_count))
+
+        def expand():
+            with contextlib.redirect_stdout(io.StringIO()):
+                incompatible_flag_verbose_failures.print_steps_for_failing_jobs(build_info)
+
+        with mock.patch.dict(os.environ, {"INCOMPATIBLE_FLAGS": flags}):
+            name = "incompatible_flag_verbose_failures_{}_jobs_{}_flags"
+            results[name.format(job_count, flag_count)] = measure(expand, repeat)
+    return results
+
+
+def write_bep_file(path, target_count):
+    with open(path, mode="w", encoding="utf-8") as f:
+        for i in range(target_count):
+            status = "FLAKY" if i % 100 == 0 else "PASSED"
+            event = {
+                "id": {"testSummary": {"label": "//pkg{}:test".format(i)}},
+                "testSummary": {
+                    "overallStatus": status,
+                    "failed": [{"uri": "file:///tmp/pkg{}/test.log".format(i)}]
+                    if status == "FLAKY"
+                    else [],
+                },
+            }
+            f.write(json.dumps(event) + "\n")
+        metrics = {
+            "actionSummary": {
+                "runnerCount": [
+                    {"name": "total", "count": target_count * 10},
+                    {"name": "remote cache hit", "count": target_count * 5},
+                ]
+            }
+        }
+        f.write(json.dumps({"id": {"buildMetrics": {}}, "buildMetrics": metrics}) + "\n")
+
+
+def benchmark_bep_parsing(repeat):
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for target_count in (1000, 10000, 100000):
+            bep_file = os.path.join(tmpdir, "bep_{}.json".format(target_count))
+            write_bep_file(bep_file, target_count)
+            results["bep_test_logs_{}_targets".format(target_count)] = measure(
+                lambda: bazelci.test_logs_for_status(bep_file, ["FAILED", "TIMEOUT", "FLAKY"]),
+                repeat,
+            )
+            results["bep_cache_metrics_{}_targets".format(target_count)] = measure(
+                lambda: bazelci.cache_metrics_from_bep(bep_file), repeat
+            )
+    return results
+
+
+def write_json_profile(path, action_count):
+    with gzip.open(path, mode="wt", encoding="utf-8") as f:
+        f.write('{"otherData":{},"traceEvents":[\n')
+        for i in range(action_count):
+            event = {
+                "cat": "action processing",
+                "name": "Compiling pkg/file{}.cc".format(i),
+                "ph": "X",
+                "ts": i * 1000,
+                "dur": 5000,
+                "pid": 1,
+                "tid": i % 32,
+                "args": {"mnemonic": "CppCompile", "target": "//pkg:lib{}".format(i % 100)},
+            }
+            f.write(json.dumps(event) + ",\n")
+        f.write('{"name":"CPU usage (Bazel)","ph":"C","ts":0,"args":{"cpu":"1.0"}}\n]}\n')
+
+
+def benchmark_json_profile_parsing(repeat):
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for action_count in (10000, 100000):
+            profile = os.path.join(tmpdir, "{}.profile.gz".format(action_count))
+            write_json_profile(profile, action_count)
+            results["json_profile_{}_actions".format(action_count)] = measure(
+                lambda: bazelci.analyze_json_profile(profile), repeat
+            )
+    return results
+
+
+def create_steps(count):
+    platforms = sorted(bazelci.PLATFORMS)
+    steps = []
+    for i in range(count):
+        step = bazelci.runner_step(
+            platform=platforms[i % len(platforms)],
+            task="task_{}".format(i),
+            project_name="Project {}".format(i // 20),
+            http_config=HTTP_CONFIG,
+            git_repository="https://github.com/bazelbuild/bazel.git",
+            use_but=True,
+        )
+        if i % 10 == 0:
+            # Multi-line commands are emitted as YAML block strings.
+            step["command"].append("echo one\necho two")
+        steps.append(step)
+    return steps
+
+
+def benchmark_yaml(step_count, repeat):
+    pipeline = {"steps": create_steps(step_count)}
+    output = bazelci.dump_yaml(pipeline)
+    if output != yaml.dump(pipeline, Dumper=PurePythonDumper):
+        raise bazelci.BuildkiteException("libyaml and PyYAML emit different pipelines")
+
+    return {
+        "dump_{}_steps".format(step_count): measure(lambda: bazelci.dump_yaml(pipeline), repeat),
+        "dump_{}_steps_pure_python".format(step_count): measure(
+            lambda: yaml.dump(pipeline, Dumper=PurePythonDumper), repeat
+        ),
+        "load_{}_steps".format(step_count): measure(lambda: bazelci.load_yaml(output), repeat),
+        "load_{}_steps_pure_python".format(step_count): measure(
+            lambda: yaml.load(output, Loader=yaml.SafeLoader), repeat
+        ),
+    }
+
+
+def import_bazelci(*python_flags):
+    # Runs without the Buildkite environment, like `bazelci.py --help` on a developer machine.
+    env = {k: v for k, v in os.environ.items() if not k.startswith("BUILDKITE")}
+    return subprocess.run(
+        [sys.executable] + list(python_flags) + ["-c", "import bazelci"],
+        cwd=SCRIPT_DIR,
+        env=env,
+        check=True,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    ).stderr
+
+
+def import_time(importtime_output, module):
+    """Returns the cumulative import time of module from `python -X importtime` output."""
+    for line in importtime_output.splitlines():
+        fields = [f.strip() for f in line.split("|")]
+        if len(fields) == 3 and fields[2] == module:
+            return int(fields[1]) / 1e6
+    raise bazelci.BuildkiteException("No import time of {} found".format(module))
+
+
+def benchmark_startup(repeat):
+    return {
+        "startup_interpreter_with_bazelci": measure(import_bazelci, repeat),
+        "startup_import_bazelci": min(
+            import_time(import_bazelci("-X", "importtime"), "bazelci") for _ in range(repeat)
+        ),
+    }
+
+
+def run_benchmarks(steps, repeat):
+    configs = load_fixtures()
+    results = benchmark_startup(repeat)
+    with replay(configs) as projects:
+        results.update(benchmark_project_pipeline(configs, projects, repeat))
+        results.update(benchmark_downstream_pipeline(configs, projects, repeat))
+        results.update(benchmark_incompatible_flag_verbose_failures(configs, repeat))
+    results.update(benchmark_bep_parsing(repeat))
+    results.update(benchmark_json_profile_parsing(repeat))
+    results.update(benchmark_yaml(steps, repeat))
+    return {
+        "python": platform.python_version(),
+        "yaml_dumper": bazelci.yaml_classes()[1].__name__,
+        "recorded_configs": len(configs),
+        "downstream_projects": len(projects),
+        "results": results,
+    }
+
+
+def find_regressions(results, baseline, max_slowdown):
+    """Returns the benchmarks that are more than max_slowdown times slower than the baseline."""
+    regressions = []
+    for name, seconds in sorted(results["results"].items()):
+        baseline_seconds = baseline["results"].get(name)
+        if baseline_seconds and seconds > baseline_seconds * max_slowdown:
+            regressions.append((name, baseline_seconds, seconds))
+    return regressions
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    parser = argparse.ArgumentParser(description="Bazel CI pipeline generation benchmarks")
+    subparsers = parser.add_subparsers(dest="subparsers_name")
+
+    run_parser = subparsers.add_parser("run")
+    run_parser.add_argument("--steps", type=int, default=2000)
+    run_parser.add_argument("--repeat", type=int, default=5)
+    run_parser.add_argument("--output", type=str, default="benchmark_results.json")
+    run_parser.add_argument("--baseline", type=str)
+    run_parser.add_argument("--max_slowdown", type=float, default=1.5)
+
+    subparsers.add_parser("record")
+
+    args = parser.parse_args(argv)
+
+    if args.subparsers_name == "record":
+        record_fixtures()
+    elif args.subparsers_name == "run":
+        results = run_benchmarks(args.steps, args.repeat)
+        for name, seconds in sorted(results["results"].items()):
+            print("{:<60} {:10.1f} ms".format(name, seconds * 1000))
+        with open(args.output, mode="w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+        if args.baseline:
+            with open(args.baseline, encoding="utf-8") as f:
+                baseline = json.load(f)
+            regressions = find_regressions(results, baseline, args.max_slowdown)
+            for name, before, after in regressions:
+                bazelci.eprint(
+                    "{} regressed from {:.1f} ms to {:.1f} ms".format(
+                        name, before * 1000, after * 1000
+                    )
+                )
+            if regressions:
+                return 1
+    else:
+        parser.print_help()
+        return 2
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
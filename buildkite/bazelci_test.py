@@ -0,0 +1,1359 @@
+#!/usr/bin/env python3
+#
+# Copyright 2020 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+
+os.environ["BUILDKITE_ORGANIZATION_SLUG"] = "bazel"
+os.environ["BUILDKITE_PIPELINE_SLUG"] = "test"
+
+import bazelci as code_under_test  # noqa: E402
+import contextlib  # noqa: E402
+import csv  # noqa: E402
+import gzip  # noqa: E402
+import hashlib  # noqa: E402
+import json  # noqa: E402
+import shutil  # noqa: E402
+import subprocess  # noqa: E402
+import sys  # noqa: E402
+import tempfile  # noqa: E402
+import threading  # noqa: E402
+import time  # noqa: E402
+import unittest  # noqa: E402
+from unittest import mock  # noqa: E402
+
+
+class FakeGcsClient(object):
+    """An in-memory replacement for bazelci.GcsClient."""
+
+    def __init__(self):
+        # Maps gs:// URLs to a dict of generation -> content.
+        self.objects = {}
+        self._last_generation = 1000
+
+    def _current_generation(self, gs_url):
+        generations = self.objects.get(gs_url)
+        if not generations:
+            raise code_under_test.GcsException("{} not found".format(gs_url), 404)
+        return max(generations, key=int)
+
+    def get_metadata(self, gs_url):
+        return {"generation": self._current_generation(gs_url)}
+
+    def read(self, gs_url, generation=None):
+        generation = generation or self._current_generation(gs_url)
+        if generation not in self.objects.get(gs_url, {}):
+            raise code_under_test.GcsException("{}#{} not found".format(gs_url, generation), 404)
+        return self.objects[gs_url][generation]
+
+    def write(self, gs_url, data, content_type, if_generation_match=None):
+        if if_generation_match is not None:
+            current = self._current_generation(gs_url) if gs_url in self.objects else "0"
+            if current != if_generation_match:
+                raise code_under_test.GcsException("Precondition failed", 412)
+        self._last_generation += 1
+        generation = str(self._last_generation)
+        self.objects.setdefault(gs_url, {})[generation] = data
+        return {"generation": generation}
+
+    def copy(self, source_gs_url, dest_gs_url, source_generation=None):
+        return self.write(dest_gs_url, self.read(source_gs_url, source_generation), None)
+
+
+class PublishBinariesTest(unittest.TestCase):
+    def setUp(self):
+        self.client = FakeGcsClient()
+        self.client.write(
+            code_under_test.bazelci_latest_build_metadata_url(),
+            json.dumps({"build_number": 41}).encode("utf-8"),
+            "application/json",
+        )
+        patcher = mock.patch.object(code_under_test, "gcs_client", return_value=self.client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        env_patcher = mock.patch.dict(os.environ, {"BUILDKITE_COMMIT": "abcdef"})
+        env_patcher.start()
+        self.addCleanup(env_patcher.stop)
+
+    def testLatestGenerationAndBuildNumber(self):
+        generation, build_number = code_under_test.latest_generation_and_build_number()
+        self.assertEqual(generation, "1001")
+        self.assertEqual(build_number, 41)
+
+    def testTryPublishBinariesWritesLatestAndCommitMetadata(self):
+        code_under_test.try_publish_binaries({"linux": "123"}, {"linux": "456"}, 42, "1001")
+
+        latest = json.loads(self.client.read(code_under_test.bazelci_latest_build_metadata_url()))
+        self.assertEqual(latest["build_number"], 42)
+        self.assertEqual(latest["platforms"]["linux"]["sha256"], "123")
+        self.assertEqual(latest["platforms"]["linux"]["nojdk_sha256"], "456")
+        by_commit = self.client.read(code_under_test.bazelci_builds_metadata_url("abcdef"))
+        self.assertEqual(json.loads(by_commit), latest)
+
+    def testTryPublishBinariesDetectsRace(self):
+        with self.assertRaises(code_under_test.BinaryUploadRaceException):
+            code_under_test.try_publish_binaries({}, {}, 42, "1000")
+
+    def testUploadWaitsForAllCopies(self):
+        processes = [mock.Mock(args="cp", returncode=r) for r in (0, 1, 0)]
+        for p in processes:
+            p.wait.return_value = p.returncode
+        with tempfile.TemporaryDirectory() as tmpdir:
+            binary_path = os.path.join(tmpdir, "bazel")
+            with open(binary_path, "wb") as f:
+                f.write(b"bazel")
+            with mock.patch.object(
+                code_under_test, "execute_command_background", side_effect=processes
+            ), mock.patch.object(code_under_test, "gsutil_command", return_value="gsutil"):
+                with self.assertRaises(code_under_test.subprocess.CalledProcessError):
+                    code_under_test.upload_binary_to_gcs(
+                        binary_path, ["gs://a", "gs://b", "gs://c"]
+                    )
+        for p in processes:
+            p.wait.assert_called_once()
+
+    def testUploadFailuresInThreadsAreReported(self):
+        def download_bazel_binary(tmpdir, platform_name):
+            raise OSError("disk full")
+
+        platforms = {"ubuntu": {"publish_binary": ["linux"]}}
+        with mock.patch.object(code_under_test, "PLATFORMS", platforms), mock.patch.object(
+            code_under_test, "should_publish_binaries_for_platform", return_value=True
+        ), mock.patch.object(
+            code_under_test, "download_bazel_binary", download_bazel_binary
+        ), mock.patch.object(
+            code_under_test, "download_bazel_nojdk_binary", download_bazel_binary
+        ):
+            with self.assertRaisesRegex(code_under_test.BuildkiteException, "disk full"):
+                code_under_test.upload_bazel_binaries()
+
+
+class GcsClientTest(unittest.TestCase):
+    def setUp(self):
+        class Timeout(Exception):
+            pass
+
+        self.requests = mock.Mock(
+            Timeout=Timeout, ConnectionError=ConnectionError, codes=mock.Mock(ok=200)
+        )
+        self.client = code_under_test.GcsClient()
+        self.client._token = "token"
+        for patcher in (
+            mock.patch.dict(sys.modules, {"requests": self.requests}),
+            mock.patch.object(code_under_test.time, "sleep"),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def testRetriesRequestsThatTimeOut(self):
+        self.requests.request.side_effect = [
+            self.requests.Timeout("stalled"),
+            mock.Mock(status_code=200, content=b"data"),
+        ]
+        self.assertEqual(self.client.read("gs://bucket/file"), b"data")
+        self.assertEqual(self.requests.request.call_count, 2)
+        self.assertEqual(self.requests.request.call_args[1]["timeout"], 60)
+
+    def testRaisesGcsExceptionAfterLastAttempt(self):
+        self.requests.request.side_effect = self.requests.Timeout("stalled")
+        with self.assertRaises(code_under_test.GcsException):
+            self.client.read("gs://bucket/file")
+        self.assertEqual(self.requests.request.call_count, 3)
+
+
+class BazelInfoCacheTest(unittest.TestCase):
+
+    _INFO_OUTPUT = "\n".join(
+        [
+            "execution_root: /tmp/out/execroot/main",
+            "output_base: /tmp/out",
+            "release: release 3.7.0",
+            "server_log: /tmp/out/java.log",
+        ]
+    )
+
+    def setUp(self):
+        code_under_test._BAZEL_INFO_CACHE.clear()
+        patcher = mock.patch.object(
+            code_under_test, "execute_command_and_get_output", return_value=self._INFO_OUTPUT
+        )
+        self.execute = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def testVersionAndOutputBaseShareOneInvocation(self):
+        version = code_under_test.print_bazel_version_info("bazel", "ubuntu1804")
+        flags = ["--disk_cache=$OUTPUT_BASE/cache", "--repository_cache=$OUTPUT_BASE/repo"]
+        for _ in range(2):
+            aggregated_flags = code_under_test.compute_flags(
+                "ubuntu1804", list(flags), None, None, "bazel"
+            )
+
+        self.assertEqual(version, "3.7.0")
+        self.assertIn("--disk_cache=/tmp/out/cache", aggregated_flags)
+        self.assertIn("--repository_cache=/tmp/out/repo", aggregated_flags)
+        self.execute.assert_called_once()
+
+    def testUnreleasedBinary(self):
+        self.execute.return_value = "release: development version\n"
+        version = code_under_test.print_bazel_version_info("bazel", "ubuntu1804")
+        self.assertEqual(version, "unreleased binary")
+
+
+class XcodeVersionCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.home = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.home)
+        self.xcode_path = os.path.join(self.home, "Xcode.app")
+        os.mkdir(self.xcode_path)
+
+    def _xcode_version_output(self, xcode_path, home):
+        with mock.patch.dict(os.environ, {"HOME": home}), mock.patch.object(
+            code_under_test.subprocess, "check_output", return_value=b"Xcode 12.4\n"
+        ) as check_output:
+            output = code_under_test.xcode_version_output(xcode_path)
+        self.assertEqual(output, b"Xcode 12.4\n")
+        return check_output.call_count
+
+    def testCachesOutputPerXcodeInstallation(self):
+        self.assertEqual(self._xcode_version_output(self.xcode_path, self.home), 1)
+        self.assertEqual(self._xcode_version_output(self.xcode_path, self.home), 0)
+        os.utime(self.xcode_path, (0, 0))
+        self.assertEqual(self._xcode_version_output(self.xcode_path, self.home), 1)
+
+    def testUnknownCachePathIsACacheMiss(self):
+        with mock.patch.object(code_under_test.os.path, "expanduser", return_value="~"):
+            self.assertEqual(self._xcode_version_output(self.xcode_path, ""), 1)
+        missing = os.path.join(self.home, "missing.app")
+        self.assertEqual(self._xcode_version_output(missing, self.home), 1)
+        self.assertEqual(os.listdir(self.home), ["Xcode.app"])
+
+
+class PhaseRecorderTest(unittest.TestCase):
+    def testTraceAndSummary(self):
+        recorder = code_under_test.PhaseRecorder()
+        with recorder.phase("clone"):
+            pass
+        with recorder.phase("upload"):
+            pass
+        with self.assertRaises(code_under_test.BuildkiteException):
+            with recorder.phase("upload"):
+                raise code_under_test.BuildkiteException("failed")
+
+        self.assertEqual(list(recorder.durations()), ["clone", "upload"])
+        self.assertRegex(recorder.summary(), r"^clone \d+\.\ds, upload \d+\.\ds \(total ")
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "trace.json")
+            recorder.write_trace(path, {"platform": "ubuntu1804"})
+            with open(path) as f:
+                trace = json.load(f)
+
+        self.assertEqual(trace["otherData"]["platform"], "ubuntu1804")
+        phases = [e for e in trace["traceEvents"] if e["ph"] == "X"]
+        self.assertEqual([e["name"] for e in phases], ["clone", "upload", "upload"])
+        self.assertTrue(all(e["dur"] >= 0 and e["ts"] >= 0 for e in phases))
+
+
+class CollectPhaseTimingsTest(unittest.TestCase):
+    @staticmethod
+    def _trace(platform, **phases):
+        events = [
+            {"name": name, "ph": "X", "ts": 0, "dur": int(seconds * 1000000)}
+            for name, seconds in phases.items()
+        ]
+        return json.dumps({"otherData": {"platform": platform}, "traceEvents": events})
+
+    def testAggregatesAcrossBuilds(self):
+        traces = {
+            "1/a": self._trace("ubuntu1804", clone=10, build=30),
+            "1/b": self._trace("macos", clone=50),
+            "2/a": self._trace("ubuntu1804", clone=20, build=40),
+        }
+        client = mock.Mock()
+        client.get_build_info_list.return_value = [{"number": 1}, {"number": 2}]
+        client.get_build_artifacts.side_effect = lambda number: [
+            {"path": "test.log", "download_url": "log"}
+        ] + [
+            {"path": code_under_test.PHASE_TRACE_FILENAME, "download_url": key}
+            for key in sorted(traces)
+            if key.startswith("%d/" % number)
+        ]
+        client.get_artifact.side_effect = lambda artifact: traces[artifact["download_url"]]
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            output = os.path.join(tmpdir, "out.csv")
+            with mock.patch.object(code_under_test, "BuildkiteClient", return_value=client):
+                code_under_test.collect_phase_timings(["bazel"], 2, output)
+            with open(output) as f:
+                rows = {(r["platform"], r["phase"]): r for r in csv.DictReader(f)}
+
+        self.assertEqual(rows[("ubuntu1804", "clone")]["jobs"], "2")
+        self.assertEqual(rows[("ubuntu1804", "clone")]["total_seconds"], "30.0")
+        self.assertEqual(rows[("ubuntu1804", "clone")]["share_of_total"], "0.3000")
+        self.assertEqual(rows[("ubuntu1804", "build")]["p50_seconds"], "30.0")
+        self.assertEqual(rows[("ubuntu1804", "build")]["p95_seconds"], "40.0")
+        self.assertEqual(rows[("macos", "clone")]["share_of_total"], "1.0000")
+
+
+class CacheMetricsTest(unittest.TestCase):
+    def testCacheMetricsFromBep(self):
+        events = [
+            {"id": {"started": {}}, "started": {"uuid": "1"}},
+            {
+                "id": {"buildMetrics": {}},
+                "buildMetrics": {
+                    "actionSummary": {
+                        "runnerCount": [
+                            {"name": "total", "count": 110},
+                            {"name": "internal", "count": 10},
+                            {"name": "remote cache hit", "count": 75, "execKind": "Remote"},
+                            {"name": "linux-sandbox", "count": 25, "execKind": "Local"},
+                        ]
+                    },
+                    "networkMetrics": {"systemNetworkStats": {"bytesRecv": "2097152"}},
+                },
+            },
+        ]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            bep_file = os.path.join(tmpdir, "bep.json")
+            with open(bep_file, "w") as f:
+                f.write("\n".join(json.dumps(e) for e in events) + "\n")
+            metrics = code_under_test.cache_metrics_from_bep(bep_file)
+
+        self.assertEqual(
+            metrics, {"actions": 100, "remote_cache_hits": 75, "bytes_downloaded": 2097152}
+        )
+        self.assertEqual(
+            code_under_test.format_cache_metrics(metrics),
+            "75 of 100 actions were remote cache hits (75%), 2.0 MiB downloaded",
+        )
+
+    def testCollectFlagsRegressions(self):
+        def artifact(number, silo_key, hits):
+            return json.dumps(
+                {
+                    "platform": "ubuntu2004",
+                    "silo_key": silo_key,
+                    "steps": {
+                        "test": {"actions": 100, "remote_cache_hits": hits, "bytes_downloaded": 0}
+                    },
+                }
+            )
+
+        hits = {("a", 3): 10, ("a", 2): 90, ("a", 1): 80, ("b", 3): 85, ("b", 2): 90}
+        client = mock.Mock()
+        client.get_build_info_list.return_value = [
+            {"number": n, "created_at": "2020-10-0%d" % n} for n in (3, 2, 1)
+        ]
+        client.get_build_artifacts.side_effect = lambda number: [
+            {"path": "bazelci-cache-metrics.json", "download_url": (key, number)}
+            for key in "ab"
+            if (key, number) in hits
+        ]
+        client.get_artifact.side_effect = lambda a: artifact(
+            a["download_url"][1], a["download_url"][0], hits[a["download_url"]]
+        )
+        with tempfile.TemporaryDirectory() as tmpdir:
+            output = os.path.join(tmpdir, "out.csv")
+            with mock.patch.object(code_under_test, "BuildkiteClient", return_value=client):
+                regressions = code_under_test.collect_cache_metrics(["p"], 3, output)
+            with open(output) as f:
+                rows = list(csv.DictReader(f))
+
+        self.assertEqual(regressions, ["a"])
+        self.assertEqual([r["latest_hit_ratio"] for r in rows], ["0.1000", "0.8500"])
+        self.assertEqual(rows[0]["hit_ratio"], "0.6000")
+
+    def testCollectReadsMoreThanOnePageOfBuilds(self):
+        client = mock.Mock()
+        client.get_build_info_list.side_effect = lambda params: [
+            {"number": n, "created_at": ""} for n in range(100 if dict(params)["page"] == 1 else 50)
+        ]
+        client.get_build_artifacts.return_value = []
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with mock.patch.object(code_under_test, "BuildkiteClient", return_value=client):
+                code_under_test.collect_cache_metrics(["p"], 120, os.path.join(tmpdir, "out.csv"))
+        self.assertEqual(client.get_build_info_list.call_count, 2)
+        self.assertEqual(client.get_build_artifacts.call_count, 120)
+
+    def testPublishDoesNotRaise(self):
+        metrics = {"test": {"actions": 1, "remote_cache_hits": 1, "bytes_downloaded": 0}}
+        error = code_under_test.subprocess.CalledProcessError(1, "xcode-select")
+        with tempfile.TemporaryDirectory() as tmpdir, mock.patch.dict(
+            os.environ, {"BUILDKITE_JOB_ID": "1"}
+        ), mock.patch.object(
+            code_under_test, "cache_silo_key_for_metrics", side_effect=error
+        ), mock.patch.object(
+            code_under_test, "execute_command"
+        ) as execute_command:
+            code_under_test.publish_cache_metrics(metrics, "macos", tmpdir)
+        execute_command.assert_not_called()
+
+
+class YamlTest(unittest.TestCase):
+    def testMultiLineStringsAreBlockStrings(self):
+        data = {"steps": [{"command": ["echo one", "echo two\necho three"]}]}
+        output = code_under_test.dump_yaml(data)
+        self.assertIn("- |-\n    echo two\n    echo three\n", output)
+        self.assertEqual(code_under_test.load_yaml(output), data)
+
+
+class LazyInitTest(unittest.TestCase):
+    def testImportDoesNotNeedOrganizationOrHeavyModules(self):
+        env = dict(os.environ)
+        env.pop("BUILDKITE_ORGANIZATION_SLUG")
+        output = subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                "import sys, bazelci; print(sorted({'requests', 'yaml'} & set(sys.modules)))",
+            ],
+            cwd=os.path.dirname(os.path.abspath(code_under_test.__file__)),
+            env=env,
+            check=True,
+            stdout=subprocess.PIPE,
+            universal_newlines=True,
+        ).stdout
+        self.assertEqual(output.strip(), "[]")
+
+    def testOrganizationIsRequiredWhenUsed(self):
+        with mock.patch.dict(os.environ, {"BUILDKITE_ORGANIZATION_SLUG": ""}):
+            with self.assertRaises(code_under_test.BuildkiteException):
+                code_under_test.downstream_projects()
+        with mock.patch.dict(os.environ, {"BUILDKITE_ORGANIZATION_SLUG": "bazel-testing"}):
+            self.assertEqual(
+                code_under_test.docker_image("ubuntu1804"),
+                "gcr.io/bazel-public/testing/ubuntu1804-java11",
+            )
+
+
+class PrintPipelineStepsTest(unittest.TestCase):
+    def setUp(self):
+        code_under_test._EMERGENCY_ANNOUNCEMENT_STEPS.clear()
+        self.addCleanup(code_under_test._EMERGENCY_ANNOUNCEMENT_STEPS.clear)
+
+    def testEmergencyFileIsFetchedOnce(self):
+        steps = [{"label": "a"}]
+        with mock.patch.object(
+            code_under_test, "load_remote_yaml_file", return_value={"message": "Help"}
+        ) as load_remote_yaml_file:
+            with mock.patch("builtins.print") as print_mock:
+                code_under_test.print_pipeline_steps(steps)
+                code_under_test.print_pipeline_steps(steps)
+
+        load_remote_yaml_file.assert_called_once()
+        self.assertEqual(steps, [{"label": "a"}])
+        pipeline = code_under_test.load_yaml(print_mock.call_args[0][0])
+        self.assertEqual(len(pipeline["steps"]), 2)
+        self.assertIn("Emergency", pipeline["steps"][0]["label"])
+
+
+class DownstreamProjectStepsTest(unittest.TestCase):
+    def testGeneratesStepsInOrderAndFallsBackToSetupJobs(self):
+        projects = {
+            "A": {"git_repository": "https://a.git", "http_config": "https://a/presubmit.yml"},
+            "B": {"git_repository": "https://b.git", "http_config": "https://b/presubmit.yml"},
+            "C": {"git_repository": "https://c.git", "http_config": "https://c/presubmit.yml"},
+        }
+
+        def create_steps(configs, project_name, use_but, **kwargs):
+            if project_name == "B":
+                raise code_under_test.BuildkiteException("broken")
+            self.assertTrue(use_but)
+            return [{"label": "{} {}".format(project_name, configs["url"])}]
+
+        with mock.patch.object(code_under_test, "downstream_projects", return_value=projects):
+            with mock.patch.object(
+                code_under_test, "fetch_configs", side_effect=lambda url, _: {"url": url}
+            ):
+                with mock.patch.object(
+                    code_under_test, "create_project_pipeline_steps", side_effect=create_steps
+                ):
+                    steps, compare_json_profiles = code_under_test.create_downstream_project_steps(
+                        ["C", "B", "A"], incompatible_flags=None
+                    )
+
+        self.assertEqual(steps[0]["label"], "C https://c/presubmit.yml")
+        self.assertEqual(steps[1]["label"], "Setup B")
+        self.assertEqual(steps[2]["label"], "A https://a/presubmit.yml")
+        self.assertFalse(compare_json_profiles)
+
+    def testPinsScriptsBeforeStartingWorkers(self):
+        events = []
+        projects = {"A": {"git_repository": "https://a.git", "http_config": "https://a/x.yml"}}
+        with mock.patch.dict(os.environ, {"BUILDKITE": "true"}), mock.patch.object(
+            code_under_test, "downstream_projects", return_value=projects
+        ), mock.patch.object(
+            code_under_test, "fetch_configs", return_value={}
+        ), mock.patch.object(
+            code_under_test,
+            "pinned_script",
+            side_effect=lambda name: events.append(("pin", threading.current_thread())),
+        ), mock.patch.object(
+            code_under_test,
+            "create_project_pipeline_steps",
+            side_effect=lambda **kwargs: events.append(("steps", threading.current_thread()))
+            or [],
+        ):
+            code_under_test.create_downstream_project_steps(["A"], incompatible_flags=["--foo"])
+        self.assertEqual(events[0], ("pin", threading.main_thread()))
+        self.assertEqual(events[1][0], "steps")
+
+    def _downstream_pipeline_labels(self, compare_json_profiles):
+        projects = {"A": {"git_repository": "https://a.git"}}
+        with mock.patch.object(
+            code_under_test, "downstream_projects", return_value=projects
+        ), mock.patch.object(
+            code_under_test,
+            "create_downstream_project_steps",
+            return_value=([{"label": "A"}], compare_json_profiles),
+        ), mock.patch.object(
+            code_under_test, "fetch_bazelcipy_command", return_value="fetch"
+        ), mock.patch.dict(
+            os.environ, {"BUILDKITE_BRANCH": "master"}
+        ):
+            steps = code_under_test.create_bazel_downstream_pipeline_steps(
+                {"ubuntu1804": {}},
+                None,
+                None,
+                test_incompatible_flags=False,
+                test_disabled_projects=False,
+                notify=False,
+                inline_project_pipelines=True,
+            )
+        return [s.get("label", s) if isinstance(s, dict) else s for s in steps]
+
+    def testComparesJsonProfilesAfterUpdatingLastGreenCommit(self):
+        labels = self._downstream_pipeline_labels(compare_json_profiles=True)
+        last_green = labels.index("Try Update Last Green Downstream Commit")
+        self.assertEqual(labels[last_green - 1], "wait")
+        self.assertIn("Compare JSON profiles", labels[-1])
+        self.assertGreater(len(labels) - 1, last_green)
+
+    def testNoJsonProfileComparisonWithoutProfiles(self):
+        labels = self._downstream_pipeline_labels(compare_json_profiles=False)
+        self.assertFalse([label for label in labels if "Compare JSON profiles" in str(label)])
+
+
+class DownstreamResultReuseTest(unittest.TestCase):
+    def setUp(self):
+        code_under_test._BAZEL_BINARY_HASHES.clear()
+        self.addCleanup(code_under_test._BAZEL_BINARY_HASHES.clear)
+
+    def testKeyDependsOnAllInputs(self):
+        inputs = (b"config", "https://a.git", "abc", "123")
+        key = code_under_test.downstream_result_key(*inputs)
+        self.assertEqual(key, code_under_test.downstream_result_key(*inputs))
+        for i in range(1, len(inputs)):
+            changed = list(inputs)
+            changed[i] += "4"
+            self.assertNotEqual(key, code_under_test.downstream_result_key(*changed))
+
+    def testPassedTasksAreReplacedByAnnotation(self):
+        task_configs = {
+            "ubuntu1804": {"build_targets": ["//..."]},
+            "macos": {"build_targets": ["//..."]},
+        }
+        passed_key = code_under_test.downstream_result_key(
+            code_under_test.hash_task_config("ubuntu1804", task_configs["ubuntu1804"]),
+            "https://a.git",
+            "abc",
+            "bazel-sha",
+        )
+        hash_url = code_under_test.bazelci_downstream_bazel_hash_url(
+            "bazel-commit", code_under_test.LINUX_BINARY_PLATFORM
+        )
+        objects = {
+            hash_url: "bazel-sha",
+            code_under_test.bazelci_downstream_result_url(passed_key): json.dumps(
+                {"pipeline": "a", "build_number": "7", "job_url": "https://buildkite/a/7#job"}
+            ),
+        }
+        env = {"REUSE_DOWNSTREAM_RESULTS": "1", "BUILDKITE_COMMIT": "bazel-commit"}
+        projects = {"A": {"git_repository": "https://a.git", "pipeline_slug": "a"}}
+        with contextlib.ExitStack() as stack:
+            stack.enter_context(mock.patch.dict(os.environ, env))
+            stack.enter_context(
+                mock.patch.object(code_under_test, "downstream_projects", return_value=projects)
+            )
+            stack.enter_context(
+                mock.patch.object(code_under_test, "get_last_green_commit", return_value="abc")
+            )
+            stack.enter_context(
+                mock.patch.object(code_under_test, "read_gcs_text", side_effect=objects.get)
+            )
+            steps = code_under_test.create_project_pipeline_steps(
+                configs={"tasks": task_configs},
+                project_name="A",
+                http_config="https://a/presubmit.yml",
+                file_config=None,
+                git_repository="https://a.git",
+                monitor_flaky_tests=False,
+                use_but=True,
+                incompatible_flags=None,
+                notify=False,
+            )
+
+        self.assertEqual(len(steps), 2)
+        self.assertIn(":darwin:", steps[0]["label"])
+        self.assertIn("Reused results of 1 tasks", steps[1]["label"])
+        self.assertIn("https://buildkite/a/7#job", steps[1]["command"][0])
+
+
+class AffectedTargetsTest(unittest.TestCase):
+    def setUp(self):
+        # Tests run in a temporary workspace with the given files.
+        cwd = os.getcwd()
+        workspace = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, workspace)
+        self.addCleanup(os.chdir, cwd)
+        os.chdir(workspace)
+
+    def _create_files(self, files):
+        for path, content in files.items():
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as f:
+                f.write(content)
+
+    def _changed_files_since(self, diff, global_file_patterns=()):
+        with mock.patch.object(
+            code_under_test, "execute_command_and_get_output", side_effect=["sub/\n", diff]
+        ):
+            return code_under_test.changed_files_since("abc", global_file_patterns)
+
+    def testChangedFilesAreRelativeToWorkspace(self):
+        self._create_files({"a/foo.cc": "", "a/BUILD": ""})
+        changed_files, reason = self._changed_files_since("sub/a/foo.cc\nother/x.cc\nsub/a/BUILD\n")
+        self.assertIsNone(reason)
+        self.assertEqual(changed_files, ["a/foo.cc", "a/BUILD"])
+
+    def testGlobalChangesAffectAllTargets(self):
+        for path in ("sub/defs.bzl", "sub/WORKSPACE", ".bazelci/presubmit.yml"):
+            changed_files, reason = self._changed_files_since(path)
+            self.assertIsNone(changed_files)
+            self.assertTrue(reason)
+
+    def testDeletedFilesAffectAllTargets(self):
+        self._create_files({"a/BUILD": ""})
+        changed_files, reason = self._changed_files_since("sub/a/BUILD\nsub/a/deleted.cc\n")
+        self.assertIsNone(changed_files)
+        self.assertEqual(reason, "a/deleted.cc was deleted")
+
+    def testRepositoryRuleInputsAffectAllTargets(self):
+        self._create_files(
+            {
+                "MODULE.bazel": 'pip.parse(requirements_lock = "//third_party:requirements.txt")',
+                "third_party/requirements.txt": "",
+                "third_party/BUILD": "",
+                "go.mod": "",
+            }
+        )
+        changed_files, reason = self._changed_files_since("sub/third_party/requirements.txt")
+        self.assertEqual(reason, "third_party/requirements.txt changed")
+        changed_files, reason = self._changed_files_since("sub/go.mod", ["go.*"])
+        self.assertEqual(reason, "go.mod changed")
+        changed_files, reason = self._changed_files_since("sub/go.mod")
+        self.assertEqual(changed_files, ["go.mod"])
+
+    def testQueriesReverseDependenciesOfChangedFiles(self):
+        self._create_files({"a/foo.cc": "", "a/BUILD": "", "README.md": ""})
+        process = mock.Mock(returncode=0, stdout="//a:foo_test\n")
+        with mock.patch.object(code_under_test.subprocess, "run", return_value=process) as run:
+            targets = code_under_test.query_affected_targets(
+                "bazel",
+                "ubuntu1804",
+                ["//...", "-//b/..."],
+                ["a/foo.cc", "a/BUILD", "README.md"],
+                True,
+            )
+        self.assertEqual(targets, ["//a:foo_test"])
+        query = run.call_args[0][0][-1]
+        self.assertTrue(
+            query.startswith(
+                "tests(kind(rule, rdeps(set('//...') except set('//b/...'), "
+                "set('a/foo.cc' '//a:all'))))"
+            )
+        )
+
+    def testPartialQueryResultsAreRejected(self):
+        self._create_files({"a/BUILD": "", "a/unused.txt": ""})
+        process = mock.Mock(returncode=3, stdout="")
+        with mock.patch.object(code_under_test.subprocess, "run", return_value=process):
+            with self.assertRaises(code_under_test.subprocess.CalledProcessError):
+                code_under_test.query_affected_targets(
+                    "bazel", "ubuntu1804", ["//..."], ["a/unused.txt"], False
+                )
+
+    def testFallsBackToAllTargetsWithoutBaseCommit(self):
+        with mock.patch.object(
+            code_under_test, "skips_incompatible_explicit_targets", return_value=True
+        ), mock.patch.object(
+            code_under_test, "affected_targets_base_commit", return_value=None
+        ), mock.patch.object(
+            code_under_test, "execute_command"
+        ):
+            self.assertEqual(
+                code_under_test.select_affected_targets("bazel", "ubuntu1804", ["//..."], ["//a"]),
+                (["//..."], ["//a"]),
+            )
+
+    def testShardsCompareToTheBaseCommitOfTheBuild(self):
+        env = {
+            "BUILDKITE_JOB_ID": "1",
+            "BUILDKITE_REPO": "https://a.git",
+            "BUILDKITE_PIPELINE_SLUG": "a",
+            "BUILDKITE_PARALLEL_JOB_COUNT": "2",
+        }
+        metadata = {}
+        # The last green commit changes between the pipeline generation and the second shard.
+        last_green_commits = iter(["green-1", "green-2", "green-3"])
+        with mock.patch.dict(os.environ, env), mock.patch.object(
+            code_under_test, "get_last_green_commit", side_effect=lambda _: next(last_green_commits)
+        ), mock.patch.object(
+            code_under_test, "set_build_metadata", side_effect=metadata.__setitem__
+        ), mock.patch.object(
+            code_under_test, "get_build_metadata", side_effect=metadata.get
+        ):
+            code_under_test.store_affected_targets_base_commit()
+            base_commits = []
+            for shard in ("0", "1"):
+                os.environ["BUILDKITE_PARALLEL_JOB"] = shard
+                base_commits.append(code_under_test.affected_targets_base_commit())
+            self.assertEqual(base_commits, ["green-1", "green-1"])
+
+            # Without a base commit of the build, shards use all targets.
+            metadata.clear()
+            self.assertIsNone(code_under_test.affected_targets_base_commit())
+
+    def testRequiresBazelThatSkipsIncompatibleExplicitTargets(self):
+        for release, supported in (
+            ("release 6.4.0", False),
+            ("release 7.0.0", True),
+            ("development version", True),
+        ):
+            with mock.patch.object(
+                code_under_test, "get_bazel_info", return_value={"release": release}
+            ):
+                self.assertEqual(
+                    code_under_test.skips_incompatible_explicit_targets("bazel", "macos"),
+                    supported,
+                )
+
+        with mock.patch.object(
+            code_under_test, "get_bazel_info", return_value={"release": "release 6.4.0"}
+        ), mock.patch.object(
+            code_under_test, "affected_targets_base_commit"
+        ) as base_commit, mock.patch.object(
+            code_under_test, "execute_command"
+        ):
+            self.assertEqual(
+                code_under_test.select_affected_targets("bazel", "macos", ["//..."], ["//a"]),
+                (["//..."], ["//a"]),
+            )
+        base_commit.assert_not_called()
+
+
+class TestHistoryTest(unittest.TestCase):
+    def testRecentlyFailedTestsComeFirst(self):
+        now = 1000000
+        history = {
+            "//:slow": {"duration": 100},
+            "//:fast": {"duration": 1},
+            "//:failed": {"duration": 5, "last_failure": now - 60},
+            "//:failed_long_ago": {"duration": 2, "last_failure": 0},
+        }
+        targets = ["//:failed", "//:failed_long_ago", "//:fast", "//:new", "//:slow"]
+        first, rest = code_under_test.split_test_targets_by_history(targets, history, now)
+        self.assertEqual(first, ["//:failed"])
+        self.assertEqual(rest, ["//:failed_long_ago", "//:fast", "//:new", "//:slow"])
+
+    def testUploadsTestLogsOfBothBatches(self):
+        def summary(target):
+            return {
+                "id": {"testSummary": {"label": target}},
+                "testSummary": {
+                    "overallStatus": "FAILED",
+                    "failed": [{"uri": "file:///logs/{}/test.log".format(target[3:])}],
+                },
+            }
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            bep_file = os.path.join(tmpdir, "test_bep.json")
+            second_bep_file = code_under_test.second_batch_bep_file(bep_file)
+            for path, targets in ((bep_file, ["//:a"]), (second_bep_file, ["//:a", "//:b"])):
+                with open(path, "w") as f:
+                    f.write("\n".join(json.dumps(summary(t)) for t in targets) + "\n")
+            stop_request = code_under_test.threading.Event()
+            stop_request.set()
+            with mock.patch.object(
+                code_under_test, "rename_test_logs_for_upload", return_value=[]
+            ) as rename, mock.patch.object(code_under_test, "execute_command"):
+                code_under_test.upload_test_logs_from_bep(
+                    [bep_file, second_bep_file], tmpdir, stop_request
+                )
+        self.assertEqual([t for t, _ in rename.call_args[0][0]], ["//:a", "//:b"])
+
+    def testMergeRecordsFailuresAndDropsOldTargets(self):
+        now = code_under_test.TEST_HISTORY_MAX_AGE_SECONDS * 2
+        history = {"//:gone": {"duration": 1, "last_seen": 0}}
+        results = {"//:a": ("FAILED", 3.5), "//:b": ("PASSED", 1.0)}
+        code_under_test.merge_test_history(history, results, now)
+        self.assertEqual(
+            history,
+            {
+                "//:a": {"duration": 3.5, "last_seen": now, "last_failure": now},
+                "//:b": {"duration": 1.0, "last_seen": now},
+            },
+        )
+
+    def testReadsDurationsFromBep(self):
+        events = [
+            {
+                "id": {"testSummary": {"label": "//:a"}},
+                "testSummary": {"overallStatus": "PASSED", "totalRunDuration": "2.500s"},
+            },
+            {
+                "id": {"testSummary": {"label": "//:b"}},
+                "testSummary": {"overallStatus": "FAILED", "totalRunDurationMillis": "1500"},
+            },
+        ]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            bep_file = os.path.join(tmpdir, "bep.json")
+            with open(bep_file, "w") as f:
+                f.write("\n".join(json.dumps(e) for e in events) + "\n")
+            self.assertEqual(
+                code_under_test.test_results_from_bep(bep_file),
+                {"//:a": ("PASSED", 2.5), "//:b": ("FAILED", 1.5)},
+            )
+
+    def testBatchesWriteSeparateJsonProfiles(self):
+        flags = ["--build_event_json_file=bep.json", "--profile=/tmp/test.profile.gz"]
+        with tempfile.TemporaryDirectory() as tmpdir, mock.patch.object(
+            code_under_test, "compute_flags", return_value=flags
+        ), mock.patch.object(code_under_test, "execute_bazel_command") as execute_bazel_command:
+            code_under_test.execute_bazel_test(
+                "1.0",
+                "bazel",
+                "ubuntu1804",
+                [],
+                ["//:b"],
+                os.path.join(tmpdir, "bep.json"),
+                False,
+                None,
+                first_targets=["//:a"],
+            )
+        first, second = [c[0][0] for c in execute_bazel_command.call_args_list]
+        self.assertIn("--profile=/tmp/test.profile.gz", first)
+        self.assertIn("--profile=/tmp/test-rest.profile.gz", second)
+        self.assertNotIn("--profile=/tmp/test.profile.gz", second)
+
+    def testFailFastSkipsRemainingTests(self):
+        failure = code_under_test.subprocess.CalledProcessError(3, "bazel")
+        fail_fast = mock.Mock(spec=code_under_test.FailFast)
+        fail_fast.execute_command.side_effect = failure
+        execute_command = fail_fast.execute_command
+        with mock.patch.object(
+            code_under_test, "compute_flags", return_value=["--build_event_json_file=bep.json"]
+        ):
+            with self.assertRaises(code_under_test.BuildkiteException):
+                code_under_test.execute_bazel_test(
+                    "1.0",
+                    "bazel",
+                    "ubuntu1804",
+                    [],
+                    ["//:b"],
+                    "bep.json",
+                    False,
+                    None,
+                    first_targets=["//:a"],
+                    fail_fast=fail_fast,
+                )
+        execute_command.assert_called_once()
+        self.assertEqual(execute_command.call_args[0][0][-1], "//:a")
+
+
+class FailFastTest(unittest.TestCase):
+    def setUp(self):
+        self.env = mock.patch.dict(
+            os.environ, {"BUILDKITE_JOB_ID": "job-1", "BUILDKITE_RETRY_COUNT": "0"}
+        )
+        self.env.start()
+        self.addCleanup(self.env.stop)
+
+    def _metadata(self, failure):
+        stdout = json.dumps(failure) if failure else ""
+        return mock.patch.object(
+            code_under_test.subprocess,
+            "run",
+            return_value=subprocess.CompletedProcess([], 0, stdout=stdout),
+        )
+
+    def testStopsOnFailureOfOtherJob(self):
+        failure = {"job_id": "job-2", "label": "Ubuntu", "target": "//:a"}
+        with self._metadata(failure):
+            with self.assertRaisesRegex(
+                code_under_test.BuildkiteException, "//:a failed in Ubuntu"
+            ):
+                code_under_test.FailFast().check()
+
+    def testIgnoresOwnFailure(self):
+        with self._metadata({"job_id": "job-1", "label": "Ubuntu", "target": "//:a"}):
+            self.assertIsNone(code_under_test.FailFast().failure_of_other_job())
+        with self._metadata(None):
+            self.assertIsNone(code_under_test.FailFast().failure_of_other_job())
+
+    def testRetriedJobsIgnoreOtherJobs(self):
+        os.environ["BUILDKITE_RETRY_COUNT"] = "1"
+        with self._metadata({"job_id": "job-2", "label": "Ubuntu", "target": "//:a"}) as run:
+            code_under_test.FailFast().check()
+        run.assert_not_called()
+
+    def testReportsFirstDefinitiveFailureOnce(self):
+        events = [
+            {
+                "id": {"testSummary": {"label": "//:flaky"}},
+                "testSummary": {"overallStatus": "FLAKY"},
+            },
+            {"id": {"testSummary": {"label": "//:a"}}, "testSummary": {"overallStatus": "FAILED"}},
+        ]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            bep_file = os.path.join(tmpdir, "bep.json")
+            with open(bep_file, "w") as f:
+                f.write("\n".join(json.dumps(e) for e in events) + "\n")
+            fail_fast = code_under_test.FailFast()
+            with mock.patch.object(code_under_test, "execute_command") as execute_command:
+                fail_fast.report_failures(bep_file)
+                fail_fast.report_failures(bep_file)
+        execute_command.assert_called_once()
+        args = execute_command.call_args[0][0]
+        self.assertEqual(args[:4], ["buildkite-agent", "meta-data", "set", "bazelci-fail-fast"])
+        self.assertEqual(json.loads(args[4])["target"], "//:a")
+
+
+class MergeBuildAndTestTest(unittest.TestCase):
+    def testOnlyMergesEquivalentSteps(self):
+        config = {"merge_build_and_test": True, "build_flags": ["--foo"], "test_flags": ["--foo"]}
+        targets = ["//...", "-//bar/..."]
+        merge = code_under_test.can_merge_build_and_test
+        self.assertTrue(merge(config, targets, list(targets), False, False))
+        # Negative patterns only exclude targets that are matched by earlier patterns.
+        self.assertFalse(merge(config, targets, list(reversed(targets)), False, False))
+        self.assertFalse(merge(config, targets, targets, False, True))
+        self.assertFalse(merge(config, targets, ["//..."], False, False))
+        self.assertFalse(merge(config, targets, targets, True, False))
+        self.assertFalse(merge(dict(config, test_flags=["--bar"]), targets, targets, False, False))
+        self.assertFalse(
+            merge(dict(config, include_json_profile=["test"]), targets, targets, False, False)
+        )
+        self.assertFalse(merge({}, targets, targets, False, False))
+
+
+class WorktreePoolTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.clone_path = os.path.join(self.tmpdir, "repo")
+        self.pool_dir = self.clone_path + "-worktrees"
+
+    def _checkout(self, slots, git_commit, distances, sizes=None):
+        """Checks out git_commit with a pool that contains the given slots (name -> state)."""
+        os.makedirs(self.pool_dir, exist_ok=True)
+        for name in slots:
+            os.makedirs(os.path.join(self.pool_dir, name), exist_ok=True)
+        with open(os.path.join(self.pool_dir, "pool.json"), "w") as f:
+            json.dump(slots, f)
+        sizes = sizes or {}
+        with mock.patch.object(code_under_test, "execute_command"), mock.patch.object(
+            code_under_test,
+            "commit_distance",
+            side_effect=lambda _, commit, target: distances.get(commit),
+        ), mock.patch.object(
+            code_under_test,
+            "worktree_size",
+            side_effect=lambda path: sizes.get(os.path.basename(path), 0),
+        ), mock.patch.object(
+            code_under_test, "remove_worktree"
+        ) as remove_worktree:
+            path = code_under_test.checkout_worktree_from_pool(self.clone_path, git_commit)
+        with open(os.path.join(self.pool_dir, "pool.json")) as f:
+            state = json.load(f)
+        removed = sorted(os.path.basename(c[0][1]) for c in remove_worktree.call_args_list)
+        return os.path.basename(path), state, removed
+
+    def testRebuildsPoolWithCorruptState(self):
+        os.makedirs(os.path.join(self.pool_dir, "slot-0"))
+        with open(os.path.join(self.pool_dir, "pool.json"), "w") as f:
+            f.write('{"slot-0": {"commit": "a", "la')
+        with mock.patch.object(code_under_test, "execute_command"), mock.patch.object(
+            code_under_test, "worktree_size", return_value=0
+        ), mock.patch.object(code_under_test, "remove_worktree") as remove_worktree:
+            path = code_under_test.checkout_worktree_from_pool(self.clone_path, "c")
+        remove_worktree.assert_called_once_with(
+            self.clone_path, os.path.join(self.pool_dir, "slot-0")
+        )
+        self.assertEqual(os.path.basename(path), "slot-0")
+        with open(os.path.join(self.pool_dir, "pool.json")) as f:
+            self.assertEqual(json.load(f)["slot-0"]["commit"], "c")
+
+    def testReusesClosestSlot(self):
+        slots = {
+            "slot-0": {"commit": "a", "last_used": 1},
+            "slot-1": {"commit": "b", "last_used": 2},
+        }
+        name, state, removed = self._checkout(slots, "c", {"a": 5, "b": 100})
+        self.assertEqual(name, "slot-0")
+        self.assertEqual(state["slot-0"]["commit"], "c")
+        self.assertEqual(removed, [])
+
+    def testAddsSlotIfClosestSlotIsTooFarAway(self):
+        slots = {"slot-0": {"commit": "a", "last_used": 1}}
+        distance = code_under_test.WORKTREE_POOL_MAX_REUSE_DISTANCE + 1
+        name, state, removed = self._checkout(slots, "c", {"a": distance})
+        self.assertEqual(name, "slot-1")
+        self.assertEqual(sorted(state), ["slot-0", "slot-1"])
+        self.assertEqual(removed, [])
+
+    def testEvictsLeastRecentlyUsedSlotIfPoolIsFull(self):
+        slots = {
+            "slot-%d" % i: {"commit": "c%d" % i, "last_used": 10 - i}
+            for i in range(code_under_test.WORKTREE_POOL_MAX_SLOTS)
+        }
+        # No slot shares history with the target commit, e.g. after a force push.
+        name, state, removed = self._checkout(slots, "x", {})
+        last_slot = "slot-%d" % (code_under_test.WORKTREE_POOL_MAX_SLOTS - 1)
+        self.assertEqual(removed, [last_slot])
+        self.assertEqual(name, last_slot)
+        self.assertEqual(state[name]["commit"], "x")
+
+    def testEvictsLeastRecentlyUsedSlotsToFitIntoBudget(self):
+        budget = code_under_test.WORKTREE_POOL_DISK_BUDGET_BYTES
+        slots = {
+            "slot-0": {"commit": "a", "last_used": 1},
+            "slot-1": {"commit": "b", "last_used": 2},
+            "slot-2": {"commit": "c", "last_used": 3},
+        }
+        sizes = {"slot-0": budget // 2, "slot-1": budget // 2, "slot-2": budget // 2}
+        name, state, removed = self._checkout(slots, "d", {"a": 1, "b": 2, "c": 3}, sizes)
+        self.assertEqual(name, "slot-0")
+        self.assertEqual(removed, ["slot-1"])
+        self.assertEqual(sorted(state), ["slot-0", "slot-2"])
+
+    def testOutputBasesCountTowardsSizeAndAreRemoved(self):
+        worktree = os.path.join(self.tmpdir, "slot-0")
+        output_base = os.path.join(self.tmpdir, "output_base")
+        bazel_out = os.path.join(output_base, "execroot", "ws", "bazel-out")
+        os.makedirs(os.path.join(worktree, "sub"))
+        os.makedirs(bazel_out)
+        with open(os.path.join(worktree, "sub", "BUILD"), "w") as f:
+            f.write("x" * 10)
+        with open(os.path.join(bazel_out, "lib.a"), "w") as f:
+            f.write("x" * 1000)
+        os.chmod(bazel_out, 0o555)
+        os.symlink(bazel_out, os.path.join(worktree, "sub", "bazel-out"))
+
+        self.assertEqual(code_under_test.worktree_output_bases(worktree), {output_base})
+        self.assertEqual(code_under_test.worktree_size(worktree), 1010)
+        with mock.patch.object(code_under_test, "execute_command", return_value=1):
+            code_under_test.remove_worktree(self.clone_path, worktree)
+        self.assertFalse(os.path.exists(output_base))
+
+
+class SauceConnectTest(unittest.TestCase):
+    def testWaitFailsIfProxyExits(self):
+        process = mock.Mock(returncode=1)
+        process.poll.return_value = 1
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with self.assertRaises(code_under_test.BuildkiteException):
+                code_under_test.wait_for_sauce_connect_proxy(process, tmpdir)
+
+    def testWaitReturnsOnceReady(self):
+        process = mock.Mock()
+        process.poll.return_value = None
+        with tempfile.TemporaryDirectory() as tmpdir:
+            open(os.path.join(tmpdir, "sc_is_ready"), "w").close()
+            code_under_test.wait_for_sauce_connect_proxy(process, tmpdir)
+
+
+class FetchScriptTest(unittest.TestCase):
+    def testFallsBackToCurlOutsideOfBuildkite(self):
+        with mock.patch.dict(os.environ, {"BUILDKITE": ""}):
+            self.assertEqual(
+                code_under_test.fetch_script_command("foo.py", "https://x/foo.py", "ubuntu1804"),
+                "curl -sS https://x/foo.py -o foo.py",
+            )
+
+    def testUsesCachedPinnedScript(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            source = os.path.join(tmpdir, "source.py")
+            with open(source, "wb") as f:
+                f.write(b"print('hi')\n")
+            with open(source, "rb") as f:
+                sha256 = hashlib.sha256(f.read()).hexdigest()
+            url = "file://" + source
+
+            with mock.patch.dict(os.environ, {"BUILDKITE": "true"}), mock.patch.object(
+                code_under_test, "pinned_script", return_value=(url, sha256)
+            ):
+                command = code_under_test.fetch_script_command("foo.py", "unused", "ubuntu1804")
+
+            command = command.replace("python3.6", sys.executable, 1)
+            env = dict(os.environ, HOME=tmpdir)
+            workdir = os.path.join(tmpdir, "work")
+            os.mkdir(workdir)
+            subprocess.run(command, shell=True, check=True, cwd=workdir, env=env)
+            with open(os.path.join(workdir, "foo.py"), "rb") as f:
+                self.assertEqual(f.read(), b"print('hi')\n")
+            cached = os.path.join(tmpdir, ".cache", "bazelci", "scripts", sha256)
+            self.assertTrue(os.path.exists(cached))
+
+            # The second run must not download the script again.
+            os.remove(source)
+            os.remove(os.path.join(workdir, "foo.py"))
+            subprocess.run(command, shell=True, check=True, cwd=workdir, env=env)
+            self.assertTrue(os.path.exists(os.path.join(workdir, "foo.py")))
+
+
+class ScriptsCommitTest(unittest.TestCase):
+    def setUp(self):
+        for cache in (code_under_test._SCRIPTS_COMMITS, code_under_test._PINNED_SCRIPTS):
+            patcher = mock.patch.dict(cache, clear=True)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(code_under_test, "github_branch", return_value="master")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def testUsesCommitOfBuild(self):
+        commit = "a" * 40
+        with mock.patch.object(
+            code_under_test, "get_build_metadata", return_value=commit
+        ), mock.patch.object(
+            code_under_test, "resolve_scripts_commit"
+        ) as resolve, mock.patch.object(
+            code_under_test, "execute_command"
+        ):
+            self.assertEqual(code_under_test.scripts_commit(), commit)
+        resolve.assert_not_called()
+
+    def testStoresResolvedCommitForLaterJobs(self):
+        commit = "b" * 40
+        with mock.patch.object(
+            code_under_test, "get_build_metadata", return_value=None
+        ), mock.patch.object(
+            code_under_test, "resolve_scripts_commit", return_value=commit
+        ), mock.patch.object(
+            code_under_test, "execute_command"
+        ) as execute_command:
+            self.assertEqual(code_under_test.scripts_commit(), commit)
+        execute_command.assert_called_once_with(
+            ["buildkite-agent", "meta-data", "set", "bazelci-scripts-commit", commit],
+            fail_if_nonzero=False,
+        )
+
+    def testAnnotatesUnpinnedScripts(self):
+        with mock.patch.object(
+            code_under_test, "get_build_metadata", return_value=None
+        ), mock.patch.object(
+            code_under_test, "resolve_scripts_commit", return_value=None
+        ), mock.patch.object(
+            code_under_test, "execute_command"
+        ) as execute_command:
+            self.assertIsNone(code_under_test.pinned_script("bazelci.py"))
+        self.assertIn("--style=warning", execute_command.call_args[0][0])
+
+    def testConcurrentCallersResolveTheCommitOnce(self):
+        commits = iter(["d" * 40, "e" * 40])
+
+        def resolve(url):
+            time.sleep(0.05)
+            return next(commits)
+
+        with mock.patch.object(
+            code_under_test, "get_build_metadata", return_value=None
+        ), mock.patch.object(
+            code_under_test, "resolve_scripts_commit", side_effect=resolve
+        ) as resolve_scripts_commit, mock.patch.object(
+            code_under_test, "execute_command"
+        ):
+            results = []
+            threads = [
+                threading.Thread(target=lambda: results.append(code_under_test.scripts_commit()))
+                for _ in range(8)
+            ]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        resolve_scripts_commit.assert_called_once()
+        self.assertEqual(results, ["d" * 40] * 8)
+
+    def testFailsIfScriptCannotBeFetchedAtPinnedCommit(self):
+        with mock.patch.object(
+            code_under_test, "scripts_commit", return_value="c" * 40
+        ), mock.patch.object(
+            code_under_test.urllib.request, "urlopen", side_effect=OSError("throttled")
+        ):
+            with self.assertRaises(code_under_test.BuildkiteException):
+                code_under_test.pinned_script("bazelci.py")
+
+
+class FailedActionsTest(unittest.TestCase):
+    def testAnnotation(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            stderr_file = os.path.join(tmpdir, "stderr-1")
+            with open(stderr_file, "w") as f:
+                f.write("x" * 5000 + "\nfoo.cc:1: \x1b[31merror:\x1b[0m expected ';'\n")
+            events = [
+                {
+                    "id": {"actionCompleted": {"primaryOutput": "bazel-out/foo.o"}},
+                    "action": {
+                        "success": False,
+                        "label": "//:foo",
+                        "type": "CppCompile",
+                        "exitCode": 1,
+                        "stderr": {"name": "stderr", "uri": "file://" + stderr_file},
+                    },
+                },
+                {
+                    "id": {"actionCompleted": {"label": "//:bar"}},
+                    "action": {"success": False, "type": "Genrule", "exitCode": 2},
+                },
+            ]
+            bep_file = os.path.join(tmpdir, "build_bep.json")
+            with open(bep_file, "w") as f:
+                f.write("\n".join(json.dumps(e) for e in events) + "\n")
+
+            with mock.patch.dict(os.environ, {"BUILDKITE_JOB_ID": "1", "BUILDKITE_LABEL": "L"}):
+                with mock.patch.object(code_under_test, "execute_command") as execute_command:
+                    code_under_test.annotate_failed_actions(bep_file, "build")
+
+        args = execute_command.call_args[0][0]
+        self.assertIn("--context=ctx-failed-actions-1", args)
+        self.assertEqual(
+            args[-1],
+            "**L** build: `CppCompile` action for `//:foo` failed with exit code 1\n\n"
+            "```\n[...]\nfoo.cc:1: error: expected ';'\n```\n\n"
+            "**L** build: `Genrule` action for `//:bar` failed with exit code 2\n",
+        )
+
+
+class AnalyzeJsonProfileTest(unittest.TestCase):
+    def _write_profile(self, tmpdir, events):
+        path = os.path.join(tmpdir, "build.profile.gz")
+        # Bazel writes one event per line.
+        with gzip.open(path, "wt", encoding="utf-8") as f:
+            f.write('{"otherData":{"build_id":"1"},"traceEvents":[\n')
+            f.write(",\n".join(json.dumps(e) for e in events))
+            f.write("\n]}\n")
+        return path
+
+    def testSummary(self):
+        events = []
+        for i in range(3000):
+            events.append(
+                {
+                    "cat": "action processing",
+                    "name": "Compiling foo%d.cc" % i,
+                    "ph": "X",
+                    "ts": i * 1000,
+                    "dur": 3000000 if i % 2 else 1000000,
+                    "args": {"mnemonic": "CppCompile"} if i % 2 else {},
+                }
+            )
+            events.append({"cat": "remote action cache check", "ph": "X", "ts": i, "dur": 1})
+        events += [
+            {"cat": "critical path component", "name": "a", "ph": "X", "ts": 0, "dur": 3000000},
+            {"cat": "critical path component", "name": "b", "ph": "X", "ts": 0, "dur": 1000000},
+            {"name": "CPU usage (Bazel)", "ph": "C", "ts": 0, "args": {"cpu": "2.0"}},
+            {"name": "CPU usage (Bazel)", "ph": "C", "ts": 1, "args": {"cpu": "4.0"}},
+        ]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            summary = code_under_test.analyze_json_profile(self._write_profile(tmpdir, events))
+
+        self.assertEqual(summary["critical_path_seconds"], 4)
+        self.assertEqual(summary["critical_path"], [(3, "a"), (1, "b")])
+        self.assertEqual(
+            summary["mnemonics"], [("CppCompile", 1500, 4500), ("Compiling", 1500, 1500)]
+        )
+        self.assertEqual(summary["remote_cache_checks"], 3000)
+        self.assertEqual(summary["cpu_average"], 3)
+        self.assertEqual(summary["cpu_max"], 4)
+        self.assertAlmostEqual(summary["wall_seconds"], 3.0 + 2.999)
+
+        text = code_under_test.format_json_profile_summary("Test (build)", summary)
+        self.assertIn("critical path 4s", text)
+        self.assertIn("3000 remote cache lookups", text)
+
+    def testCompareWithLastGreenBuild(self):
+        def profile(link_seconds):
+            return [
+                {"cat": "build phase marker", "name": "Launch Blaze", "ph": "i", "ts": 0},
+                {"cat": "build phase marker", "name": "Execution", "ph": "i", "ts": 1000000},
+                {
+                    "cat": "action processing",
+                    "name": "Linking //:bin",
+                    "ph": "X",
+                    "ts": 1000000,
+                    "dur": link_seconds * 1000000,
+                    "args": {"mnemonic": "CppLink", "target": "//:bin"},
+                },
+            ]
+
+        def build(number, state):
+            return {
+                "number": number,
+                "jobs": [{"id": "job%d" % number, "name": "Project (:ubuntu:)", "state": state}],
+            }
+
+        def artifacts(number):
+            return [
+                {"job_id": "job%d" % number, "path": "build.profile.gz", "download_url": number}
+            ]
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.makedirs(os.path.join(tmpdir, "old"))
+            paths = {
+                1: self._write_profile(os.path.join(tmpdir, "old"), profile(5)),
+                3: self._write_profile(tmpdir, profile(2)),
+            }
+
+            client = mock.Mock()
+            client.get_build_info.return_value = build(3, "failed")
+            client.get_build_info_list.return_value = [
+                build(3, "failed"),
+                build(2, "failed"),
+                build(1, "passed"),
+            ]
+            client.get_build_artifacts.side_effect = artifacts
+            client.download_artifact.side_effect = lambda a, dest: shutil.copy(
+                paths[a["download_url"]], dest
+            )
+            with mock.patch.object(code_under_test, "BuildkiteClient", return_value=client):
+                with mock.patch.object(code_under_test, "execute_command") as execute_command:
+                    code_under_test.compare_json_profiles(3, project_name="Project")
+
+        # Build 2 failed, so the profile of build 3 is compared with that of build 1.
+        self.assertEqual(
+            [c[0][0]["download_url"] for c in client.download_artifact.call_args_list], [1, 3]
+        )
+        text = execute_command.call_args[0][0][-1]
+        self.assertIn("| Phase | Execution | 5.0s | 2.0s | -3.0s |", text)
+        self.assertIn("| Mnemonic | CppLink | 5.0s | 2.0s | -3.0s |", text)
+        self.assertIn("| Target | //:bin | 5.0s | 2.0s | -3.0s |", text)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -19,7 +19,6 @@ import os
 import sys
 import subprocess
 import time
-import yaml
 import bazelci
 
 BAZEL_REPO_DIR = os.getcwd()
@@ -33,8 +32,8 @@ SCRIPT_URL = {
 }[BUILDKITE_ORG] + "?{}".format(int(time.time()))
 
 
-def fetch_culprit_finder_py_command():
-    return "curl -s {0} -o culprit_finder.py".format(SCRIPT_URL)
+def fetch_culprit_finder_py_command(platform_name):
+    return bazelci.fetch_script_command("culprit_finder.py", SCRIPT_URL, platform_name)
 
 
 def get_bazel_commits_between(first_commit, second_commit):
@@ -57,7 +56,7 @@ def get_bazel_commits_between(first_commit, second_commit):
 
 
 def get_configs(project_name):
-    http_config = bazelci.DOWNSTREAM_PROJECTS[project_name]["http_config"]
+    http_config = bazelci.downstream_projects()[project_name]["http_config"]
     configs = bazelci.fetch_configs(http_config, None)
     return configs
 
@@ -76,7 +75,7 @@ def get_tasks(project_name):
 def test_with_bazel_at_commit(
     project_name, task_name, git_repo_location, bazel_commit, needs_clean, repeat_times
 ):
-    http_config = bazelci.DOWNSTREAM_PROJECTS[project_name]["http_config"]
+    http_config = bazelci.downstream_projects()[project_name]["http_config"]
     for i in range(1, repeat_times + 1):
         if repeat_times > 1:
             bazelci.print_collapsed_group(":bazel: Try %s time" % i)
@@ -101,9 +100,9 @@ def test_with_bazel_at_commit(
 
 def clone_git_repository(project_name, task_name):
     platform_name = get_platform(project_name, task_name)
-    git_repository = bazelci.DOWNSTREAM_PROJECTS[project_name]["git_repository"]
+    git_repository = bazelci.downstream_projects()[project_name]["git_repository"]
     last_green_commit_url = bazelci.bazelci_last_green_commit_url(
-        git_repository, bazelci.DOWNSTREAM_PROJECTS[project_name]["pipeline_slug"]
+        git_repository, bazelci.downstream_projects()[project_name]["pipeline_slug"]
     )
     git_commit = bazelci.get_last_green_commit(last_green_commit_url)
     return bazelci.clone_git_repository(git_repository, platform_name, git_commit)
@@ -161,9 +160,13 @@ def print_culprit_finder_pipeline(
                 ("--repeat_times=" + str(repeat_times)) if repeat_times else "",
             )
         )
-        commands = [bazelci.fetch_bazelcipy_command(), fetch_culprit_finder_py_command(), command]
+        commands = [
+            bazelci.fetch_bazelcipy_command(platform_name),
+            fetch_culprit_finder_py_command(platform_name),
+            command,
+        ]
         pipeline_steps.append(bazelci.create_step(label, commands, platform_name))
-    print(yaml.dump({"steps": pipeline_steps}))
+    print(bazelci.dump_yaml({"steps": pipeline_steps}))
 
 
 def main(argv=None):
@@ -221,10 +224,10 @@ def main(argv=None):
         if "REPEAT_TIMES" in os.environ:
             repeat_times = int(os.environ["REPEAT_TIMES"])
 
-        if project_name not in bazelci.DOWNSTREAM_PROJECTS:
+        if project_name not in bazelci.downstream_projects():
             raise Exception(
                 "Project name '%s' not recognized, available projects are %s"
-                % (project_name, str((bazelci.DOWNSTREAM_PROJECTS.keys())))
+                % (project_name, str((bazelci.downstream_projects().keys())))
             )
 
         print_culprit_finder_pipeline(
@@ -17,7 +17,6 @@
 import argparse
 import os
 import sys
-import yaml
 
 import bazelci
 from bazelci import BuildkiteException
@@ -119,7 +118,7 @@ def print_steps_for_failing_jobs(build_info):
             + str(counter - BUILDKITE_MAX_JOBS_LIMIT)
             + " jobs."
         )
-    print(yaml.dump({"steps": pipeline_steps}))
+    print(bazelci.dump_yaml({"steps": pipeline_steps}))
 
 
 def main(argv=None):